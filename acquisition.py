@@ -0,0 +1,290 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Run scripted acquisitions of a C12880 without a GUI.  The spectra are streamed from the
+device at full speed and written to a csv file, stdout, or a time course recording. """
+
+# standard libraries
+import collections
+import itertools
+import logging
+import time
+# installed libraries
+import numpy as np
+# local files
+import averaging
+import hotplug
+import processing_pool
+import psoc_spectrometer
+import recording
+import spectrum_buffer
+
+__author__ = 'Kyle Vitautas Lopin'
+
+INTEGRATION_UNITS = {'us': 1, 'ms': 1000, 's': 1000000}
+FRAME_WAIT_TIMEOUT = 0.5  # seconds to wait for a frame before checking if the stream stopped
+
+
+def parse_integration_time(text: str) -> int:
+    """ Convert an integration time such as '40ms', '108us' or '1.5s' to microseconds, a number
+    without a unit is taken as microseconds
+
+    :param text: integration time with an optional unit of us, ms or s
+    :return: integration time in microseconds
+    """
+    text = text.strip().lower()
+    for unit in sorted(INTEGRATION_UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(round(float(text[:-len(unit)]) * INTEGRATION_UNITS[unit]))
+    return int(round(float(text)))
+
+
+class AcquisitionPlan(object):
+    """ Settings of a scripted acquisition """
+
+    def __init__(self, integration_time: int, num_reads: int = 1, count: int = None,
+                 duration: float = None, lights: dict = None, flash: list = None):
+        """
+        :param integration_time: integration time in microseconds
+        :param num_reads: number of reads the PSoC sums for each spectrum
+        :param count: number of spectra to take
+        :param duration: seconds to take spectra for, runs until count is reached if None,
+        or forever if count is also None
+        :param lights: name of light source: mA to run it at, the light sources listed are turned on
+        :param flash: names of the light sources to flash
+        """
+        self.integration_time = integration_time
+        self.num_reads = num_reads
+        self.count = count
+        self.duration = duration
+        self.lights = lights or {}
+        self.flash = flash or []
+
+
+class CSVSpectrumWriter(object):
+    """ Write a row for each spectrum with its time, integration time and number of reads before
+    the counts """
+
+    def __init__(self, _file, wavelengths, count_format: str = "%d"):
+        """
+        :param _file: open text file to write to
+        :param wavelengths: wavelength of each pixel, for the header
+        :param count_format: printf style format of each pixel, i.e. "%.3f" for processed spectra
+        """
+        self.file = _file
+        header = ["timestamp", "integration time", "num reads", "light state"]
+        header.extend(["{0:.2f}".format(wavelength) for wavelength in wavelengths])
+        self.file.write(", ".join(header) + "\n")
+        self.row_format = ", ".join(["%.6f", "%d", "%d", "%d"] + [count_format] * len(wavelengths))
+
+    def write_batch(self, batch: spectrum_buffer.SpectrumBatch, integration_time: int,
+                    light_state: int = 0):
+        num_frames = len(batch.timestamps)
+        rows = np.column_stack((batch.timestamps, np.full(num_frames, integration_time),
+                                batch.num_reads, np.full(num_frames, light_state), batch.counts))
+        np.savetxt(self.file, rows, fmt=self.row_format)
+        self.file.flush()
+
+    def close(self):
+        self.file.flush()
+
+
+class RecordingSpectrumWriter(object):
+    """ Write the spectra to a memory mapped time course recording """
+
+    def __init__(self, time_course: recording.TimeCourseRecording):
+        self.time_course = time_course
+
+    def write_batch(self, batch: spectrum_buffer.SpectrumBatch, integration_time: int,
+                    light_state: int = 0):
+        self.time_course.append_batch(batch.counts, batch.timestamps, integration_time,
+                                      batch.num_reads, light_state)
+
+    def close(self):
+        self.time_course.close()
+
+
+class ProcessingSpectrumWriter(object):
+    """ Run the spectra through a ProcessingPool before passing them to another writer.  The
+    frames are processed on the pool's worker processes while the next ones are read, and are
+    written in the order they were taken. """
+
+    def __init__(self, writer, pool: processing_pool.ProcessingPool):
+        self.writer = writer
+        self.pool = pool
+        self._pending = collections.deque()  # (sequence, timestamp, light state) of frames in the pool
+
+    def write_batch(self, batch: spectrum_buffer.SpectrumBatch, integration_time: int,
+                    light_state: int = 0):
+        num_reads = np.broadcast_to(batch.num_reads, batch.sequences.shape)
+        for i, sequence in enumerate(batch.sequences):
+            if self.pool.pending >= self.pool.num_slots:
+                self._write_finished(wait=True)
+            self.pool.submit(batch.counts[i], int(num_reads[i]), integration_time)
+            self._pending.append((sequence, batch.timestamps[i], light_state))
+        self._write_finished(wait=False)
+
+    def _write_finished(self, wait: bool):
+        """ Write the processed frames that are done, or wait for at least the oldest one """
+        frames = []
+        while self.pool.pending:
+            frame = self.pool.get(timeout=None if wait and not frames else 0)
+            if frame is None:
+                break
+            frames.append((frame, self._pending.popleft()))
+        # frames with the same settings are written together
+        for (integration_time, light_state), group in itertools.groupby(
+                frames, key=lambda item: (item[0].integration_time, item[1][2])):
+            group = list(group)
+            batch = spectrum_buffer.SpectrumBatch(np.array([info[0] for _, info in group]),
+                                                  np.array([info[1] for _, info in group]),
+                                                  np.array([frame.num_reads for frame, _ in group]),
+                                                  np.array([frame.data for frame, _ in group]))
+            self.writer.write_batch(batch, integration_time, light_state)
+
+    def close(self):
+        while self.pool.pending:
+            self._write_finished(wait=True)
+        self.pool.close()
+        self.writer.close()
+
+
+class HeadlessSpectrometer(object):
+    """ Driver for a PSoC controlled C12880 that does not need a display """
+
+    def __init__(self, device: psoc_spectrometer.PSoC = None, reconnect: bool = False):
+        """
+        :param device: PSoC to use, one is connected to if None
+        :param reconnect: watch for the device being unplugged, and when it comes back put its
+        settings back and carry on with the acquisition
+        """
+        if device is None:
+            device = psoc_spectrometer.PSoC()
+        self.device = device
+        self.spectrometer = device.spectrometer
+        self.monitor = None  # type: hotplug.DeviceMonitor
+        if reconnect:
+            self.monitor = hotplug.DeviceMonitor(device)
+            self.monitor.start()
+
+    @property
+    def connected(self) -> bool:
+        return self.device.usb.connected
+
+    def stream_running(self) -> bool:
+        """ Check if the stream is going, or will be resumed by the device monitor """
+        stream = self.spectrometer.stream
+        if stream is None:
+            return False
+        if stream.is_alive():
+            return True
+        return (self.monitor is not None and self.monitor.is_alive() and stream.error is not None
+                and stream is not self.monitor.failed_stream)
+
+    def apply_lights(self, plan: AcquisitionPlan):
+        """ Set the power and flash of the light sources and turn on the ones in the plan """
+        with self.device.usb.batch():
+            for light_source in self.device.light_sources:
+                if light_source.name in plan.lights:
+                    light_source.set_power_milliamps(plan.lights[light_source.name])
+                light_source.set_flash(light_source.name in plan.flash)
+                light_source.turn_on(light_source.name in plan.lights)
+
+    def run(self, plan: AcquisitionPlan, writer, stop_event=None) -> int:
+        """ Stream spectra from the device to a writer until the plan is done
+
+        :param plan: settings of the acquisition
+        :param writer: object with a write_batch(batch, integration_time, light_state) method
+        :param stop_event: threading.Event that ends the acquisition early when set
+        :return: number of spectra written
+        """
+        self.apply_lights(plan)
+        light_state = self.device.light_state()
+        ring_buffer = self.spectrometer.start_streaming(plan.integration_time, plan.num_reads,
+                                                        max_frames=plan.count)
+        if ring_buffer is None:
+            raise ValueError("Could not start streaming with the acquisition settings")
+        end_time = None
+        if plan.duration:
+            end_time = time.time() + plan.duration
+        frames_written = 0
+        last_sequence = -1
+        try:
+            while True:
+                if stop_event and stop_event.is_set():
+                    break
+                if end_time and time.time() > end_time:
+                    break
+                if not ring_buffer.wait_for_frame(last_sequence, FRAME_WAIT_TIMEOUT):
+                    if not self.stream_running():
+                        break
+                    continue
+                batch = ring_buffer.get_batch(last_sequence)
+                if batch.sequences[0] != last_sequence + 1:
+                    logging.warning("Writer fell behind, lost {0} spectra".format(
+                        batch.sequences[0] - last_sequence - 1))
+                if plan.count:
+                    batch = spectrum_buffer.SpectrumBatch(*[field[:plan.count - frames_written]
+                                                            for field in batch])
+                writer.write_batch(batch, self.spectrometer.integration_time, light_state)
+                frames_written += len(batch.sequences)
+                last_sequence = int(batch.sequences[-1])
+                if plan.count and frames_written >= plan.count:
+                    break
+        finally:
+            stream = self.spectrometer.stream
+            self.spectrometer.stop_streaming()
+        if stream.error:
+            logging.error("Stream stopped: {0}".format(stream.error))
+        return frames_written
+
+    def average(self, integration_time: int, num_reads: int = 1, target_snr: float = None,
+                max_reads: int = None, timeout: float = None, dark=None,
+                accumulator: averaging.SpectrumAccumulator = None) -> averaging.SpectrumAccumulator:
+        """ Stream frames into a running average until the signal to noise ratio is reached, or
+        the number of reads or time runs out
+
+        :param integration_time: integration time in microseconds
+        :param num_reads: number of reads the PSoC sums for each frame
+        :param target_snr: stop once the pixels with signal reach this signal to noise ratio
+        :param max_reads: stop after this many reads in total
+        :param timeout: stop after this many seconds
+        :param dark: dark spectrum per read to subtract before working out the signal to noise
+        :param accumulator: average to add to, a new one is made if None
+        :return: the SpectrumAccumulator with the mean, variance and standard error
+        """
+        if target_snr is None and max_reads is None and timeout is None:
+            raise ValueError("Averaging needs a target SNR, a number of reads or a timeout to stop")
+        if accumulator is None:
+            accumulator = averaging.SpectrumAccumulator()
+        max_frames = None
+        if max_reads:
+            max_frames = -(-max_reads // num_reads)
+        ring_buffer = self.spectrometer.start_streaming(integration_time, num_reads,
+                                                        max_frames=max_frames)
+        if ring_buffer is None:
+            raise ValueError("Could not start streaming with the averaging settings")
+        end_time = time.time() + timeout if timeout else None
+        last_sequence = -1
+        try:
+            while not (end_time and time.time() > end_time):
+                if not ring_buffer.wait_for_frame(last_sequence, FRAME_WAIT_TIMEOUT):
+                    if not self.stream_running():
+                        break
+                    continue
+                batch = ring_buffer.get_batch(last_sequence)
+                accumulator.add_batch(batch.counts, batch.num_reads)
+                last_sequence = int(batch.sequences[-1])
+                if target_snr and accumulator.snr_reached(target_snr, dark):
+                    break
+        finally:
+            self.spectrometer.stop_streaming()
+        logging.info("averaged {0} reads".format(accumulator.total_reads))
+        return accumulator
+
+    def close(self):
+        if self.monitor:
+            self.monitor.stop()
+        self.spectrometer.stop_streaming()
+        self.device.stop_state_log()
+        for light_source in self.device.light_sources:
+            light_source.turn_on(False)
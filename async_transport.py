@@ -0,0 +1,338 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" asyncio transport for the PSoC.  Commands return awaitables instead of blocking the caller,
+and one I/O task owns the device.  The PSoC answers commands in the order they are sent, so the
+I/O task writes new commands while earlier ones still wait for their responses, up to
+max_outstanding of them, and hands each response to the oldest waiting request.  pyUSB calls
+block, so the I/O task runs them on a single worker thread of its own; an event loop can drive
+several devices with one such thread for each.
+
+    async with AsyncPSoCTransport.from_psoc_usb(psoc.usb) as transport:
+        spectrometer = AsyncC12880(transport)
+        await spectrometer.set_integration_time(10000)
+        counts = await spectrometer.read(num_reads=4)
+"""
+
+# standard libraries
+import array
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+# installed libraries
+import numpy as np
+import usb.core
+# local files
+import psoc_spectrometer
+import readiness
+import usb_comm
+import usb_stats
+
+__author__ = 'Kyle Vitautas Lopin'
+
+DEFAULT_MAX_OUTSTANDING = 4  # commands written before the oldest response has to be read
+QUERY_BYTES = 9  # the C12880|QUERY_RUN response is 9 characters
+
+
+class _Request(object):
+    """ A command and how to read its response, if it has one """
+
+    def __init__(self, message: str, future: asyncio.Future, num_bytes: int = None,
+                 typecode: str = None, verb: str = None):
+        self.message = message
+        self.future = future
+        self.num_bytes = num_bytes  # bytes to read for a message response
+        self.typecode = typecode  # array typecode for a frame response
+        self.verb = verb
+
+    @property
+    def has_response(self) -> bool:
+        return bool(self.num_bytes or self.typecode)
+
+
+class AsyncPSoCTransport(object):
+    """ Send commands to a PSoC and get their responses through awaitables """
+
+    def __init__(self, device, lock=None, stats: usb_stats.TransportStats = None,
+                 max_outstanding: int = DEFAULT_MAX_OUTSTANDING, timeout: int = 3000,
+                 out_endpoint=usb_comm.OUT_ENDPOINT, in_endpoint=usb_comm.IN_ENDPOINT,
+                 write_callback=None):
+        """
+        :param device: pyUSB device, or an object with the same read and write calls
+        :param lock: lock shared with other users of the device, i.e. PSoC_USB.lock, it is held
+        while any response is outstanding so other threads can not take the responses
+        :param stats: TransportStats to record the commands in
+        :param max_outstanding: commands that can wait for a response at once, 1 turns off pipelining
+        :param timeout: milliseconds to wait for each response
+        :param write_callback: function called with the message and error=True or False after
+        each write, from the I/O thread, i.e. PSoC_USB.note_write to keep its shadow right
+        """
+        self.device = device
+        self.lock = lock
+        self.stats = stats or usb_stats.TransportStats()
+        self.max_outstanding = max(1, max_outstanding)
+        self.timeout = timeout
+        self.out_endpoint = out_endpoint
+        self.in_endpoint = in_endpoint
+        self.write_callback = write_callback or (lambda message, error=False: None)
+        self._requests = None  # asyncio.Queue, made in start so it is on the running loop
+        self._io_task = None
+        self._executor = None
+        self._frame_readers = {}  # typecode: usb_comm.BulkFrameReader
+        # only used from the worker thread
+        self._lock_held = False
+        self._num_outstanding = 0
+
+    @classmethod
+    def from_psoc_usb(cls, psoc_usb: usb_comm.PSoC_USB, **kwargs):
+        """ Make a transport that shares the device, lock and stats of a PSoC_USB, the settings it
+        writes are noted in the PSoC_USB's shadow so write_setting does not skip them """
+        return cls(psoc_usb.device, lock=psoc_usb.lock, stats=psoc_usb.stats,
+                   write_callback=psoc_usb.note_write, **kwargs)
+
+    @property
+    def running(self) -> bool:
+        return self._io_task is not None and not self._io_task.done()
+
+    async def start(self):
+        if self.running:
+            return
+        self._requests = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PSoC I/O")
+        self._io_task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """ Finish the commands already sent and stop the I/O task """
+        if self.running:
+            await self._requests.put(None)
+            await self._io_task
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    # commands
+    def send(self, message: str) -> asyncio.Future:
+        """ Send a command that has no response
+
+        :return: awaitable that is done when the command is written
+        """
+        return self._submit(_Request(message, self._new_future()))
+
+    def query(self, message: str, num_bytes: int = usb_comm.USB_DATA_BYTE_SIZE) -> asyncio.Future:
+        """ Send a command and read its response
+
+        :return: awaitable of the bytes the device answered with
+        """
+        return self._submit(_Request(message, self._new_future(), num_bytes=num_bytes))
+
+    def read_frame(self, message: str, typecode: str) -> asyncio.Future:
+        """ Send a command and read the frame of NUM_PIXELS elements the device answers with
+
+        :param typecode: array typecode of each element, 'H' for uint16 or 'I' for uint32
+        :return: awaitable of a numpy array of the frame, the array is not reused
+        """
+        return self._submit(_Request(message, self._new_future(), typecode=typecode,
+                                     verb=self.stats.verb(message)))
+
+    def _new_future(self) -> asyncio.Future:
+        if not self.running:
+            raise RuntimeError("The transport has to be started before sending commands")
+        return asyncio.get_event_loop().create_future()
+
+    def _submit(self, request: _Request) -> asyncio.Future:
+        self._requests.put_nowait(request)
+        return request.future
+
+    # I/O task
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        outstanding = collections.deque()  # requests written that wait for their response
+        closing = False
+        while not closing or outstanding:
+            if not closing and len(outstanding) < self.max_outstanding and \
+                    (not outstanding or not self._requests.empty()):
+                request = await self._requests.get()
+                if request is None:
+                    closing = True
+                    continue
+                try:
+                    await loop.run_in_executor(self._executor, self._write, request)
+                except Exception as error:
+                    _set_exception(request.future, error)
+                    continue
+                if request.has_response:
+                    outstanding.append(request)
+                else:
+                    _set_result(request.future, None)
+                continue
+
+            request = outstanding.popleft()
+            try:
+                response = await loop.run_in_executor(self._executor, self._read, request)
+            except Exception as error:
+                _set_exception(request.future, error)
+                # the responses still waiting can not be matched to their requests any more
+                lost = IOError("Response lost after an earlier failed read: {0}".format(error))
+                while outstanding:
+                    _set_exception(outstanding.popleft().future, lost)
+                await loop.run_in_executor(self._executor, self._reset_outstanding)
+                continue
+            _set_result(request.future, response)
+        await loop.run_in_executor(self._executor, self._release_lock)
+
+    # worker thread calls
+    def _write(self, request: _Request):
+        if self.lock is not None and not self._lock_held:
+            self.lock.acquire()
+            self._lock_held = True
+        start = time.perf_counter()
+        try:
+            self.device.write(self.out_endpoint, request.message)
+        except Exception:
+            self.stats.record_write(request.message, len(request.message),
+                                    time.perf_counter() - start, error=True)
+            self.write_callback(request.message, error=True)
+            self._release_lock_if_idle()
+            raise
+        self.stats.record_write(request.message, len(request.message), time.perf_counter() - start)
+        self.write_callback(request.message)
+        if request.has_response:
+            self._num_outstanding += 1
+        else:
+            self._release_lock_if_idle()
+
+    def _read(self, request: _Request):
+        start = time.perf_counter()
+        verb = request.verb or self.stats.verb(request.message)
+        try:
+            if request.typecode:
+                reader = self._frame_readers.get(request.typecode)
+                if reader is None:
+                    reader = usb_comm.BulkFrameReader(self.device, request.typecode,
+                                                      usb_comm.NUM_PIXELS, self.in_endpoint,
+                                                      timeout=self.timeout)
+                    self._frame_readers[request.typecode] = reader
+                response = np.array(reader.read())
+                num_bytes = reader.frame_bytes
+            else:
+                response = self.device.read(self.in_endpoint, request.num_bytes, self.timeout)
+                if isinstance(response, array.array):
+                    response = response.tobytes()
+                num_bytes = len(response)
+        except Exception as error:
+            self.stats.record_read(0, time.perf_counter() - start, error=True, verb=verb,
+                                   timed_out=isinstance(error, usb.core.USBTimeoutError))
+            raise
+        self.stats.record_read(num_bytes, time.perf_counter() - start, verb=verb)
+        self._num_outstanding -= 1
+        self._release_lock_if_idle()
+        return response
+
+    def _reset_outstanding(self):
+        self._num_outstanding = 0
+        self._release_lock()
+
+    def _release_lock_if_idle(self):
+        if self._num_outstanding == 0:
+            self._release_lock()
+
+    def _release_lock(self):
+        if self._lock_held:
+            self._lock_held = False
+            self.lock.release()
+
+
+def _set_result(future: asyncio.Future, result):
+    if not future.done():  # the caller may have cancelled it
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, error: Exception):
+    if not future.done():
+        future.set_exception(error)
+
+
+class AsyncC12880(object):
+    """ C12880 commands on an AsyncPSoCTransport """
+
+    def __init__(self, transport: AsyncPSoCTransport, predictor: readiness.ReadinessPredictor = None):
+        self.transport = transport
+        self.readiness = predictor or readiness.ReadinessPredictor()
+        self.integration_time = None
+        self.st_clock_divider = None
+        # held from a read's trigger to its export so reads of this sensor do not interleave
+        self._read_lock = asyncio.Lock()
+
+    async def set_integration_time(self, integration_time: int) -> bool:
+        """ Send the clock divider and period for an integration time, both are written without
+        waiting on each other """
+        settings = psoc_spectrometer.integration_settings(integration_time)
+        if settings is None:
+            logging.error("Integration time out of bounds: {0}".format(integration_time))
+            return False
+        divider, period = settings
+        async with self._read_lock:  # do not change the settings in the middle of a read
+            await asyncio.gather(
+                self.transport.send("C12880|ST_DIVIDER|{0}".format(str(divider).zfill(5))),
+                self.transport.send("C12880|ST_PERIOD|{0}".format(str(period).zfill(5))))
+            self.integration_time = integration_time
+            self.st_clock_divider = divider
+        return True
+
+    async def query_data_readiness(self) -> str:
+        message = await self.transport.query("C12880|QUERY_RUN", QUERY_BYTES)
+        return message.decode('ascii', 'replace')
+
+    async def read(self, num_reads: int = 1) -> np.ndarray:
+        """ Trigger a read, wait for the PSoC to finish it and export the data
+
+        :param num_reads: number of reads the PSoC sums
+        :return: array of 288 counts, uint16 for a single read or uint32 for summed reads
+        """
+        if self.integration_time is None:
+            raise RuntimeError("Set the integration time before reading")
+        read_command = psoc_spectrometer.C12880.get_read_command(num_reads)
+        if not read_command:
+            raise ValueError("Can not read {0} times".format(num_reads))
+        async with self._read_lock:
+            await self.transport.send(read_command)
+            trigger_time = time.time()
+            await self.wait_for_data(num_reads, trigger_time)
+            if num_reads == 1:
+                return await self.transport.read_frame("C12880|EXPORT_DATA|SINGLE", 'H')
+            return await self.transport.read_frame("C12880|EXPORT_DATA|MULTI", 'I')
+
+    async def wait_for_data(self, num_reads: int, trigger_time: float):
+        """ Poll the PSoC on the predictor's schedule until the read is done, the same way as
+        C12880.wait_for_data
+
+        :raise IOError: if the C12880 has no data or the deadline is passed
+        """
+        predicted_time = self.readiness.predict(self.integration_time, self.st_clock_divider, num_reads)
+        deadline = trigger_time + 2 * predicted_time + psoc_spectrometer.QUERY_TIMEOUT_PADDING
+        await asyncio.sleep(max(0., trigger_time + self.readiness.first_poll_time(predicted_time) -
+                                time.time()))
+
+        last_not_ready = None
+        for interval in self.readiness.poll_intervals():
+            query_time = time.time()
+            message = await self.query_data_readiness()
+            if message == psoc_spectrometer.QUERY_NO_DATA:
+                raise IOError("The C12880 has no data")
+            if message != psoc_spectrometer.QUERY_NOT_DONE:
+                break
+            last_not_ready = query_time
+            if query_time > deadline:
+                raise IOError("Timed out waiting for data after {0:.3f} sec".format(
+                    query_time - trigger_time))
+            await asyncio.sleep(interval)
+        self.readiness.record_polls(self.integration_time, self.st_clock_divider, num_reads,
+                                    trigger_time, last_not_ready, query_time)
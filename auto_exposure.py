@@ -0,0 +1,113 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Find the integration time that puts the peak of a spectrum at a target count below
+saturation.  A read at the shortest integration time gives the offset of each pixel, and as the
+signal above the offset grows linearly with the integration time one probe read is usually
+enough to predict the answer; a second read checks it and corrects for any nonlinearity.
+Saturated probes are cut by a large factor instead, as they say nothing about the signal. """
+
+# standard libraries
+import collections
+import logging
+# installed libraries
+import numpy as np
+# local files
+import psoc_spectrometer
+
+__author__ = 'Kyle Vitautas Lopin'
+
+SATURATION_COUNT = 4095  # 12 bit ADC
+SATURATION_LEVEL = 0.98  # fraction of the full count a peak is taken as saturated at
+TARGET_FRACTION = 0.75  # fraction of the full count to aim the peak at
+TOLERANCE = 0.08  # fraction of the target the peak can be off by and still be done
+SATURATED_STEP = 10.  # factor to cut the integration time by after a saturated read
+MAX_STEP = 100.  # most the integration time is changed by in one step
+MIN_SIGNAL = 20.  # counts above the offset needed to trust a prediction
+DEFAULT_START_TIME = 10000  # microseconds
+MAX_STEPS = 8
+
+ExposureResult = collections.namedtuple('ExposureResult', ['integration_time', 'peak', 'converged',
+                                                           'steps', 'history'])
+
+
+def realizable_integration_time(integration_time: float) -> int:
+    """ Round an integration time to one the PSoC's ST clock can make in its divider band
+
+    :param integration_time: integration time in microseconds
+    :return: the closest integration time the PSoC can make, clipped to the allowed range
+    """
+    integration_time = min(max(integration_time, psoc_spectrometer.MIN_INTEGRATION_TIME),
+                           psoc_spectrometer.MAX_INTEGRATION_TIME)
+    divider = psoc_spectrometer.st_clock_divider(integration_time)
+    clock_period = divider / 24.  # microseconds per ST clock cycle
+    cycles = max(1, int(integration_time / clock_period))  # the PSoC truncates to whole cycles
+    realizable = int(round(cycles * clock_period))
+    # rounding can move the time across a band edge or out of range, the next band is fine too
+    return min(max(realizable, psoc_spectrometer.MIN_INTEGRATION_TIME),
+               psoc_spectrometer.MAX_INTEGRATION_TIME)
+
+
+def find_integration_time(read_counts, start_time: int = DEFAULT_START_TIME,
+                          target_fraction: float = TARGET_FRACTION, tolerance: float = TOLERANCE,
+                          max_steps: int = MAX_STEPS, max_time: int = psoc_spectrometer.MAX_INTEGRATION_TIME,
+                          saturation_count: int = SATURATION_COUNT, offset=None) -> ExposureResult:
+    """ Search for the integration time that puts the peak count at a target
+
+    :param read_counts: function that takes an integration time in microseconds and returns the
+    counts of a single read, i.e. C12880.read_counts
+    :param start_time: integration time of the first probe, in microseconds
+    :param target_fraction: fraction of the saturation count to put the peak at
+    :param tolerance: fraction of the target the peak can be off by
+    :param max_steps: most probe reads to make, not counting the offset read
+    :param max_time: longest integration time to use, in microseconds
+    :param saturation_count: full scale count of the ADC
+    :param offset: counts of each pixel with no integration, read at the shortest integration
+    time if None
+    :return: ExposureResult with the integration time, the peak count it gave, if the peak is
+    within the tolerance, the number of probe reads, and a list of (integration time, peak)
+    """
+    if offset is None:
+        offset = np.asarray(read_counts(psoc_spectrometer.MIN_INTEGRATION_TIME), dtype=np.float64)
+    saturated_level = SATURATION_LEVEL * saturation_count
+    target = target_fraction * saturation_count
+    max_time = min(max_time, psoc_spectrometer.MAX_INTEGRATION_TIME)
+    integration_time = realizable_integration_time(min(start_time, max_time))
+    history = []
+    best = None  # (integration time, peak) of the best unsaturated read
+    for step in range(1, max_steps + 1):
+        counts = np.asarray(read_counts(integration_time), dtype=np.float64)
+        peak = float(counts.max())
+        history.append((integration_time, peak))
+        logging.debug("auto exposure {0} usec: peak {1:.0f}".format(integration_time, peak))
+
+        if peak >= saturated_level:
+            if integration_time <= psoc_spectrometer.MIN_INTEGRATION_TIME:
+                logging.warning("Saturated at the shortest integration time")
+                return ExposureResult(integration_time, peak, False, step, history)
+            next_time = integration_time / SATURATED_STEP
+        else:
+            if best is None or abs(peak - target) < abs(best[1] - target):
+                best = (integration_time, peak)
+            if abs(peak - target) <= tolerance * target:
+                return ExposureResult(integration_time, peak, True, step, history)
+            # signal above the offset is proportional to the integration time
+            signal = counts - offset
+            peak_pixel = int(np.argmax(signal))
+            peak_signal = signal[peak_pixel]
+            if peak_signal < MIN_SIGNAL:
+                next_time = integration_time * MAX_STEP
+            else:
+                next_time = integration_time * (target - offset[peak_pixel]) / peak_signal
+            if integration_time >= max_time and next_time >= max_time:
+                logging.warning("Peak is still low at the longest integration time")
+                break
+        next_time = integration_time * min(max(next_time / integration_time, 1. / MAX_STEP), MAX_STEP)
+        next_time = realizable_integration_time(min(next_time, max_time))
+        if next_time == integration_time:
+            break  # can not get any closer in the divider band
+        integration_time = next_time
+
+    if best is None:
+        return ExposureResult(integration_time, history[-1][1], False, len(history), history)
+    return ExposureResult(best[0], best[1], abs(best[1] - target) <= tolerance * target,
+                          len(history), history)
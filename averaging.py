@@ -0,0 +1,121 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Average any number of frames on the computer, past the MAX_NUM_READS the PSoC can sum,
+while keeping a running per pixel variance so the noise of the average is known.  Frames that
+are the sum of several reads are weighted by their number of reads, using the weighted form of
+Welford's running mean and variance, so single and multi read frames can be mixed. """
+
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+NUM_PIXELS = 288
+SNR_SIGNAL_FRACTION = 0.1  # pixels below this fraction of the peak are left out of the SNR check
+
+
+class SpectrumAccumulator(object):
+    """ Running weighted mean and variance of the counts of each pixel.  Memory use does not
+    grow with the number of frames added. """
+
+    def __init__(self, num_pixels: int = NUM_PIXELS):
+        self.num_pixels = num_pixels
+        self._mean = np.zeros(num_pixels)  # mean counts per read
+        self._m2 = np.zeros(num_pixels)  # weighted sum of squared differences from the mean
+        self._delta = np.empty(num_pixels)  # scratch space
+        self.num_frames = 0
+        self.total_reads = 0
+
+    def reset(self):
+        self._mean[:] = 0
+        self._m2[:] = 0
+        self.num_frames = 0
+        self.total_reads = 0
+
+    def add(self, counts, num_reads: int = 1):
+        """ Add a frame
+
+        :param counts: counts of a frame, the sum of num_reads reads
+        :param num_reads: number of reads the frame is the sum of, the frame's weight
+        """
+        new_total = self.total_reads + num_reads
+        delta = self._delta
+        # delta = counts / num_reads - mean
+        np.divide(counts, num_reads, out=delta)
+        np.subtract(delta, self._mean, out=delta)
+        # m2 += num_reads * delta * (x - new mean), where x - new mean = delta * (1 - w / W)
+        self._m2 += (num_reads * (1. - num_reads / new_total)) * delta * delta
+        delta *= num_reads / new_total
+        self._mean += delta
+        self.num_frames += 1
+        self.total_reads = new_total
+
+    def add_batch(self, counts, num_reads=1):
+        """ Add N frames at once, their statistics are worked out together and then combined
+        with the running ones
+
+        :param counts: N x num_pixels array of counts
+        :param num_reads: number of reads of all the frames, or an array of N values
+        """
+        counts = np.asarray(counts, dtype=np.float64)
+        if counts.ndim == 1:
+            self.add(counts, num_reads)
+            return
+        weights = np.broadcast_to(np.asarray(num_reads, dtype=np.float64), (counts.shape[0],))
+        batch_reads = weights.sum()
+        means = counts / weights[:, np.newaxis]
+        batch_mean = counts.sum(axis=0) / batch_reads
+        batch_m2 = (weights[:, np.newaxis] * (means - batch_mean) ** 2).sum(axis=0)
+
+        # combine the two sets, Chan et al. parallel variance
+        new_total = self.total_reads + batch_reads
+        delta = batch_mean - self._mean
+        self._m2 += batch_m2 + delta ** 2 * (self.total_reads * batch_reads / new_total)
+        self._mean += delta * (batch_reads / new_total)
+        self.num_frames += counts.shape[0]
+        self.total_reads = new_total
+
+    @property
+    def mean(self) -> np.ndarray:
+        """ Mean counts of a single read for each pixel """
+        return self._mean.copy()
+
+    @property
+    def variance(self) -> np.ndarray:
+        """ Estimated variance of a single read for each pixel, NaN until 2 frames are added """
+        if self.num_frames < 2:
+            return np.full(self.num_pixels, np.nan)
+        return self._m2 / (self.num_frames - 1)
+
+    @property
+    def standard_error(self) -> np.ndarray:
+        """ Standard error of the mean of each pixel """
+        return np.sqrt(self.variance / self.total_reads)
+
+    def snr(self, dark=None) -> np.ndarray:
+        """ Signal to noise ratio of the mean of each pixel
+
+        :param dark: dark spectrum per read to subtract from the mean first, so the offset of
+        the sensor is not counted as signal
+        """
+        signal = self._mean if dark is None else self._mean - dark
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return signal / self.standard_error
+
+    def snr_reached(self, target_snr: float, dark=None, pixels=None) -> bool:
+        """ Check if the average is good enough to stop
+
+        :param target_snr: signal to noise ratio every checked pixel has to reach
+        :param dark: dark spectrum per read to subtract from the signal
+        :param pixels: index or boolean mask of the pixels to check, if None the pixels with at
+        least SNR_SIGNAL_FRACTION of the peak signal are checked
+        :return: True if all the checked pixels have reached the target
+        """
+        if self.num_frames < 2:
+            return False
+        snr = self.snr(dark)
+        if pixels is None:
+            signal = self._mean if dark is None else self._mean - dark
+            pixels = signal >= SNR_SIGNAL_FRACTION * signal.max()
+        checked = snr[pixels]
+        return bool(checked.size) and bool(np.all(checked >= target_snr))
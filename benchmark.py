@@ -0,0 +1,224 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Benchmark the acquisition pipeline against the simulated device.  Each frame goes through
+the same steps as a read from the GUI:
+
+C12880.send_read_message -> C12880.wait_for_data -> PSoC_USB.read_single_data / read_multi_data
+-> SpectrometerData.update_data -> graph update
+
+and the time of each stage, the trigger to display latency, and the memory allocated are
+measured for every integration time and number of reads asked for.  The free running stream
+is also timed.  The results are saved as json so runs can be compared, i.e.
+
+python benchmark.py --integration-times 108 1000 40000 --reads 1 4 --output bench.json
+"""
+
+# standard libraries
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+# installed libraries
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
+# local files
+import calibration
+import data_class
+import device_simulator
+import graph_scale
+import psoc_spectrometer
+
+__author__ = 'Kyle Vitautas Lopin'
+
+STAGES = ["trigger", "wait", "readout", "processing", "display"]
+LATENCY_PERCENTILES = [50, 90, 99]
+DEFAULT_INTEGRATION_TIMES = [108, 1000, 10000, 40000]  # microseconds
+DEFAULT_NUM_READS = [1, 4]
+DEFAULT_FRAMES = 50
+DEFAULT_STREAM_SECONDS = 2.
+ALLOCATION_FRAMES = 10  # frames to trace memory allocations for, tracing slows everything down
+
+
+class AggDisplay(object):
+    """ Off screen version of the SpectroPlotter render step, so the cost of drawing the line
+    can be measured without a display """
+
+    def __init__(self, wavelengths):
+        self.figure = Figure(figsize=(6, 3))
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axis = self.figure.add_subplot(111)
+        self.axis.set_xlim([300, 850])
+        self.scale_index = 3
+        self.axis.set_ylim([0, graph_scale.COUNT_SCALE[self.scale_index]])
+        self.line, = self.axis.plot(wavelengths, np.zeros(len(wavelengths)), animated=True)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.axis.bbox)
+
+    def update(self, display_data):
+        self.line.set_ydata(display_data)
+        scale_index = graph_scale.select_scale_index(display_data.max(), self.scale_index)
+        if scale_index != self.scale_index:
+            self.scale_index = scale_index
+            self.axis.set_ylim([0, graph_scale.COUNT_SCALE[self.scale_index]])
+            self.canvas.draw()
+            self.background = self.canvas.copy_from_bbox(self.axis.bbox)
+        self.canvas.restore_region(self.background)
+        self.axis.draw_artist(self.line)
+        self.canvas.blit(self.axis.bbox)
+
+
+def read_frame(spectrometer: psoc_spectrometer.C12880, data: data_class.SpectrometerData,
+               display, integration_time: int, num_reads: int) -> dict:
+    """ Put one frame through the pipeline
+
+    :return: seconds each stage took, and the total from trigger to display
+    """
+    times = {}
+    start = time.perf_counter()
+    if not spectrometer.send_read_message(integration_time, num_reads):
+        raise IOError("Could not send the read message")
+    trigger_time = time.time()
+    stage_end = time.perf_counter()
+    times["trigger"] = stage_end - start
+
+    query_message = spectrometer.wait_for_data(num_reads, trigger_time)
+    if query_message != device_simulator.QUERY_DONE.decode('ascii'):
+        raise IOError("Data was not ready: {0}".format(query_message))
+    times["wait"] = time.perf_counter() - stage_end
+    stage_end = time.perf_counter()
+
+    if num_reads == 1:
+        counts = spectrometer.usb.read_single_data()
+    else:
+        counts = spectrometer.usb.read_multi_data()
+    if counts is None:
+        raise IOError("Failed reading data")
+    times["readout"] = time.perf_counter() - stage_end
+    stage_end = time.perf_counter()
+
+    data.update_data(counts, num_reads, integration_time)
+    times["processing"] = time.perf_counter() - stage_end
+    stage_end = time.perf_counter()
+
+    if display:
+        display.update(data.current_data)
+    times["display"] = time.perf_counter() - stage_end
+    times["latency"] = time.perf_counter() - start
+    return times
+
+
+def benchmark_reads(device: psoc_spectrometer.PSoC, data, display, integration_time: int,
+                    num_reads: int, num_frames: int) -> dict:
+    """ Time single triggered reads, then trace the memory of a few more """
+    spectrometer = device.spectrometer
+    read_frame(spectrometer, data, display, integration_time, num_reads)  # warm up the buffers
+    frame_times = []
+    start = time.perf_counter()
+    for _ in range(num_frames):
+        frame_times.append(read_frame(spectrometer, data, display, integration_time, num_reads))
+    run_time = time.perf_counter() - start
+
+    tracemalloc.start()
+    peak_bytes = []
+    start_blocks = sys.getallocatedblocks()
+    for _ in range(ALLOCATION_FRAMES):
+        tracemalloc.reset_peak()
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        read_frame(spectrometer, data, display, integration_time, num_reads)
+        peak_bytes.append(tracemalloc.get_traced_memory()[1] - start_bytes)
+    net_blocks = sys.getallocatedblocks() - start_blocks
+    tracemalloc.stop()
+
+    latencies = np.array([frame["latency"] for frame in frame_times])
+    result = {"mode": "triggered", "integration_time": integration_time, "num_reads": num_reads,
+              "frames": num_frames, "spectra_per_second": num_frames / run_time,
+              "latency_ms": {"p{0}".format(percentile): 1000 * np.percentile(latencies, percentile)
+                             for percentile in LATENCY_PERCENTILES},
+              "stage_ms": {stage: 1000 * np.mean([frame[stage] for frame in frame_times])
+                           for stage in STAGES},
+              "peak_bytes_allocated_per_frame": float(np.mean(peak_bytes)),
+              "net_blocks_per_frame": net_blocks / ALLOCATION_FRAMES}
+    result["latency_ms"]["max"] = 1000 * latencies.max()
+    return result
+
+
+def benchmark_stream(device: psoc_spectrometer.PSoC, integration_time: int, num_reads: int,
+                     seconds: float) -> dict:
+    """ Count the frames the pipelined stream gets in a set time """
+    spectrometer = device.spectrometer
+    ring_buffer = spectrometer.start_streaming(integration_time, num_reads)
+    if ring_buffer is None:
+        raise IOError("Could not start streaming")
+    ring_buffer.wait_for_frame(-1, 5.)
+    first_sequence = ring_buffer.next_sequence
+    start = time.perf_counter()
+    time.sleep(seconds)
+    num_frames = ring_buffer.next_sequence - first_sequence
+    run_time = time.perf_counter() - start
+    spectrometer.stop_streaming()
+    return {"mode": "stream", "integration_time": integration_time, "num_reads": num_reads,
+            "frames": num_frames, "spectra_per_second": num_frames / run_time}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run(integration_times, num_reads_list, num_frames, stream_seconds, use_display=True) -> dict:
+    device = psoc_spectrometer.PSoC(device=device_simulator.SimulatedPSoC(seed=0))
+    wavelengths = calibration.get_calibration(device.communication.usb.device.serial).wavelengths
+    data = data_class.SpectrometerData(wavelengths)
+    display = AggDisplay(wavelengths) if use_display else None
+    results = []
+    for integration_time in integration_times:
+        for num_reads in num_reads_list:
+            logging.info("benchmarking {0} usec, {1} reads".format(integration_time, num_reads))
+            results.append(benchmark_reads(device, data, display, integration_time, num_reads,
+                                           num_frames))
+            if stream_seconds:
+                results.append(benchmark_stream(device, integration_time, num_reads, stream_seconds))
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(),
+            "python": platform.python_version(), "numpy": np.__version__,
+            "matplotlib": matplotlib.__version__, "platform": platform.platform(),
+            "device": "simulated", "results": results,
+            "usb": device.usb.stats.snapshot()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the C12880 acquisition pipeline")
+    parser.add_argument('--integration-times', type=int, nargs='+', default=DEFAULT_INTEGRATION_TIMES,
+                        help="integration times in microseconds")
+    parser.add_argument('--reads', type=int, nargs='+', default=DEFAULT_NUM_READS,
+                        help="number of reads to average")
+    parser.add_argument('--frames', type=int, default=DEFAULT_FRAMES,
+                        help="triggered reads to time for each setting")
+    parser.add_argument('--stream-seconds', type=float, default=DEFAULT_STREAM_SECONDS,
+                        help="seconds to stream for each setting, 0 to skip streaming")
+    parser.add_argument('--no-display', action='store_true', help="leave out the graph update")
+    parser.add_argument('--output', default='benchmark_results.json', help="json file for the results")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log the progress")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(module)s: %(message)s')
+
+    report = run(args.integration_times, args.reads, args.frames, args.stream_seconds,
+                 not args.no_display)
+    with open(args.output, 'w') as _file:
+        json.dump(report, _file, indent=2)
+    for result in report["results"]:
+        print("{mode:>9} {integration_time:>8} us x{num_reads:<3} {spectra_per_second:8.1f} spectra/s".format(
+            **result))
+
+
+if __name__ == '__main__':
+    main()
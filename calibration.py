@@ -0,0 +1,163 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Wavelength calibrations of C12880 sensors.  Each sensor comes with its own 5th order
+polynomial that converts the pixel number to a wavelength.  The wavelengths of each sensor are
+calculated once, saved to disk, and shared by everything that uses that sensor. """
+
+# standard libraries
+import logging
+import os
+import threading
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+NUM_PIXELS = 288
+DEFAULT_SERIAL = "17D00042"
+CACHE_DIRECTORY = 'calibration/'
+UNIFORM_GRID_STEP = 1.0  # nm between points of the evenly spaced wavelengths
+
+# A_0, B_1, B_2, B_3, B_4, B_5 from the calibration sheet that comes with each sensor
+CALIBRATION_COEFFICIENTS = {
+    "17D00042": (3.056675765e+2, 2.718285424, -1.550742501e-3,
+                 -3.975858137e-6, -5.463349212e-9, -2.634533143e-11),
+}
+
+
+class WavelengthCalibration(object):
+    """ Pixel to wavelength conversion of one C12880 sensor, and the weights to linearly
+    interpolate its data onto evenly spaced wavelengths.  The arrays are only calculated, or
+    loaded from the disk cache, the first time they are used. """
+
+    def __init__(self, serial: str, coefficients, num_pixels: int = NUM_PIXELS,
+                 grid_step: float = UNIFORM_GRID_STEP, cache_directory: str = CACHE_DIRECTORY):
+        """
+        :param serial: serial number of the sensor
+        :param coefficients: A_0, B_1 ... B_5 of the calibration polynomial
+        :param num_pixels: number of pixels of the sensor
+        :param grid_step: nm between the points of the uniform wavelengths
+        :param cache_directory: folder to save the calculated arrays to, None to not use a cache
+        """
+        self.serial = serial
+        self.coefficients = np.asarray(coefficients, dtype=np.float64)
+        self.num_pixels = num_pixels
+        self.grid_step = grid_step
+        self.cache_directory = cache_directory
+        self._wavelengths = None
+        self._uniform_wavelengths = None
+        self._grid_index = None  # index of the pixel below each uniform wavelength
+        self._grid_weight = None  # weight of the pixel above each uniform wavelength
+        self._lock = threading.Lock()
+
+    @property
+    def wavelengths(self) -> np.ndarray:
+        """ Wavelength in nm of each pixel """
+        self._make_arrays()
+        return self._wavelengths
+
+    @property
+    def uniform_wavelengths(self) -> np.ndarray:
+        """ Evenly spaced wavelengths that resample puts the data on """
+        self._make_arrays()
+        return self._uniform_wavelengths
+
+    def resample(self, counts, out=None) -> np.ndarray:
+        """ Linearly interpolate data onto the uniform wavelengths
+
+        :param counts: array of num_pixels values, or N x num_pixels frames
+        :param out: array to put the results in, a new array is made if None
+        :return: array of the data at the uniform wavelengths
+        """
+        self._make_arrays()
+        counts = np.asarray(counts, dtype=np.float64)
+        lower = counts[..., self._grid_index]
+        upper = counts[..., self._grid_index + 1]
+        if out is None:
+            out = np.empty(lower.shape, dtype=np.float64)
+        np.subtract(upper, lower, out=out)
+        np.multiply(out, self._grid_weight, out=out)
+        np.add(out, lower, out=out)
+        return out
+
+    def _make_arrays(self):
+        if self._wavelengths is not None:
+            return
+        with self._lock:
+            if self._wavelengths is not None:
+                return
+            if not self._load_cache():
+                self._calculate()
+                self._save_cache()
+
+    def _calculate(self):
+        pixels = np.arange(1, self.num_pixels + 1, dtype=np.float64)
+        # np.polyval wants the highest order coefficient first
+        wavelengths = np.polyval(self.coefficients[::-1], pixels)
+        uniform = np.arange(np.ceil(wavelengths[0]), np.floor(wavelengths[-1]) + self.grid_step / 2.,
+                            self.grid_step)
+        grid_index = np.searchsorted(wavelengths, uniform, side='right') - 1
+        np.clip(grid_index, 0, self.num_pixels - 2, out=grid_index)
+        grid_weight = ((uniform - wavelengths[grid_index]) /
+                       (wavelengths[grid_index + 1] - wavelengths[grid_index]))
+        self._uniform_wavelengths = uniform
+        self._grid_index = grid_index
+        self._grid_weight = grid_weight
+        self._wavelengths = wavelengths
+
+    def _cache_filename(self):
+        return os.path.join(self.cache_directory, "{0}.npz".format(self.serial))
+
+    def _load_cache(self) -> bool:
+        if not self.cache_directory or not os.path.exists(self._cache_filename()):
+            return False
+        try:
+            with np.load(self._cache_filename()) as cache:
+                if (not np.array_equal(cache['coefficients'], self.coefficients) or
+                        float(cache['grid_step']) != self.grid_step or
+                        cache['wavelengths'].size != self.num_pixels):
+                    logging.info("Calibration cache of {0} is out of date".format(self.serial))
+                    return False
+                self._uniform_wavelengths = cache['uniform_wavelengths']
+                self._grid_index = cache['grid_index']
+                self._grid_weight = cache['grid_weight']
+                self._wavelengths = cache['wavelengths']
+        except Exception as error:
+            logging.error("Could not load calibration cache: {0}".format(error))
+            return False
+        return True
+
+    def _save_cache(self):
+        if not self.cache_directory:
+            return
+        try:
+            if not os.path.exists(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            np.savez(self._cache_filename(), coefficients=self.coefficients,
+                     grid_step=self.grid_step, wavelengths=self._wavelengths,
+                     uniform_wavelengths=self._uniform_wavelengths,
+                     grid_index=self._grid_index, grid_weight=self._grid_weight)
+        except Exception as error:
+            logging.error("Could not save calibration cache: {0}".format(error))
+
+
+_calibrations = {}
+_calibrations_lock = threading.Lock()
+
+
+def get_calibration(serial: str = DEFAULT_SERIAL, coefficients=None) -> WavelengthCalibration:
+    """ Get the shared calibration of a sensor, it is only made once for each serial number
+
+    :param serial: serial number of the sensor
+    :param coefficients: calibration polynomial to use if the serial number is not in
+    CALIBRATION_COEFFICIENTS
+    :return: WavelengthCalibration of the sensor
+    """
+    with _calibrations_lock:
+        if serial not in _calibrations:
+            if coefficients is None:
+                if serial not in CALIBRATION_COEFFICIENTS:
+                    raise KeyError("No calibration for C12880 serial: {0}".format(serial))
+                coefficients = CALIBRATION_COEFFICIENTS[serial]
+            _calibrations[serial] = WavelengthCalibration(serial, coefficients)
+        return _calibrations[serial]
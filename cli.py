@@ -0,0 +1,119 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Command line program to take spectra with a C12880 without the GUI, i.e.
+
+python cli.py --integration 40ms --count 100 --output spectra.csv
+python cli.py -i 108us --duration 60 --light LED=25 --flash LED --record run_1/
+"""
+
+# standard libraries
+import argparse
+import logging
+import sys
+# local files
+import acquisition
+import calibration
+import device_simulator
+import processing_pool
+import psoc_spectrometer
+import recording
+import state_log
+
+__author__ = 'Kyle Vitautas Lopin'
+
+
+def parse_light(text: str):
+    """ Split a light setting of NAME=MILLIAMPS """
+    name, _, milliamps = text.partition('=')
+    if not milliamps:
+        raise argparse.ArgumentTypeError("light has to be given as NAME=MILLIAMPS: {0}".format(text))
+    return name, float(milliamps)
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Take spectra with a PSoC controlled C12880")
+    parser.add_argument('-i', '--integration', type=acquisition.parse_integration_time,
+                        default=40000, help="integration time, i.e. 40ms, 108us or 1.5s")
+    parser.add_argument('-n', '--reads', type=int, default=1,
+                        help="number of reads the PSoC sums for each spectrum")
+    parser.add_argument('-c', '--count', type=int, help="number of spectra to take")
+    parser.add_argument('-d', '--duration', type=float, help="seconds to take spectra for")
+    parser.add_argument('--light', type=parse_light, action='append', default=[],
+                        help="turn on a light source at a current, i.e. LED=25")
+    parser.add_argument('--flash', action='append', default=[],
+                        help="name of a light source to flash during the reads")
+    parser.add_argument('-o', '--output', default='-',
+                        help="csv file to write the spectra to, - for stdout")
+    parser.add_argument('--record', help="folder to save a time course recording in instead of a csv")
+    parser.add_argument('--smooth', type=int, default=1, metavar='PIXELS',
+                        help="smooth the spectra with a moving average this many pixels wide")
+    parser.add_argument('--counts-per-second', action='store_true',
+                        help="save the spectra as counts per second instead of summed counts")
+    parser.add_argument('--workers', type=int,
+                        help="processes to smooth and normalize the spectra on, one per core if not given")
+    parser.add_argument('--serial', default=calibration.DEFAULT_SERIAL,
+                        help="serial number of the C12880 for the wavelength calibration")
+    parser.add_argument('--simulate', action='store_true',
+                        help="use a simulated spectrometer instead of the USB device")
+    parser.add_argument('--reconnect', action='store_true',
+                        help="reconnect and carry on if the spectrometer is unplugged")
+    parser.add_argument('--usb-stats', help="json file to save the USB command counts and timings to")
+    parser.add_argument('--state-log', type=int, metavar='N',
+                        help="log the C12880 state registers every N spectra to {0}".format(
+                            state_log.LOG_FILE))
+    parser.add_argument('-v', '--verbose', action='store_true', help="log debug messages to stderr")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = make_parser().parse_args(argv)
+    logging.basicConfig(format='%(asctime)s %(module)s %(lineno)d: %(levelname)s %(message)s',
+                        level=logging.DEBUG if args.verbose else logging.WARNING, stream=sys.stderr)
+    if not args.count and not args.duration:
+        logging.warning("No count or duration given, taking spectra until stopped")
+
+    plan = acquisition.AcquisitionPlan(args.integration, args.reads, args.count, args.duration,
+                                       dict(args.light), args.flash)
+    device = None
+    if args.simulate:
+        device = psoc_spectrometer.PSoC(device=device_simulator.SimulatedPSoC(args.serial))
+    spectrometer = acquisition.HeadlessSpectrometer(device, reconnect=args.reconnect)
+    if not spectrometer.connected:
+        logging.error("No spectrometer connected")
+        return 1
+
+    if args.state_log:
+        spectrometer.device.start_state_log(args.state_log)
+
+    output_file = None
+    processed = args.smooth > 1 or args.counts_per_second
+    if args.record:
+        writer = acquisition.RecordingSpectrumWriter(recording.TimeCourseRecording(args.record))
+    else:
+        output_file = sys.stdout if args.output == '-' else open(args.output, 'w')
+        writer = acquisition.CSVSpectrumWriter(output_file,
+                                               calibration.get_calibration(args.serial).wavelengths,
+                                               "%.3f" if processed else "%d")
+    if processed:
+        pool = processing_pool.ProcessingPool(processing_pool.correct_and_smooth,
+                                              {'window': args.smooth,
+                                               'counts_per_second': args.counts_per_second},
+                                              num_workers=args.workers)
+        writer = acquisition.ProcessingSpectrumWriter(writer, pool)
+    try:
+        num_spectra = spectrometer.run(plan, writer)
+        logging.info("took {0} spectra".format(num_spectra))
+    except KeyboardInterrupt:
+        logging.info("acquisition stopped")
+    finally:
+        writer.close()
+        spectrometer.close()
+        if args.usb_stats:
+            spectrometer.device.usb.stats.dump(args.usb_stats)
+        if output_file and output_file is not sys.stdout:
+            output_file.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Library of dark spectra measured at different integration times.  The dark counts of a
+pixel are an offset plus dark current that grows with the integration time, so a dark spectrum
+for an integration time between two measured ones is interpolated linearly instead of being
+measured again.  Only spectra taken with the same ST clock divider are interpolated between,
+as the divider changes the sensor's timing.  Old spectra are dropped, as the dark current
+drifts with temperature, and the library is saved to disk for the next session. """
+
+# standard libraries
+import bisect
+import collections
+import logging
+import os
+import threading
+import time
+# installed libraries
+import numpy as np
+# local files
+import psoc_spectrometer
+
+__author__ = 'Kyle Vitautas Lopin'
+
+CACHE_DIRECTORY = 'calibration/'
+NUM_PIXELS = 288
+MAX_ENTRIES = 64
+MAX_AGE = 4 * 3600.  # seconds a dark spectrum is used for
+
+DarkFrame = collections.namedtuple('DarkFrame', ['integration_time', 'divider', 'spectrum',
+                                                 'num_reads', 'timestamp'])
+
+
+class DarkLibrary(object):
+    """ Dark spectra, in counts per read, keyed by integration time and clock divider """
+
+    def __init__(self, name: str = 'default', directory: str = CACHE_DIRECTORY,
+                 max_entries: int = MAX_ENTRIES, max_age: float = MAX_AGE,
+                 num_pixels: int = NUM_PIXELS):
+        """
+        :param name: name of the sensor, i.e. the USB serial number, the file is named after it
+        :param directory: folder to save the library in, None to keep it in memory only
+        :param max_entries: most dark spectra to keep, the oldest are dropped first
+        :param max_age: seconds before a dark spectrum is dropped
+        :param num_pixels: number of pixels of the sensor
+        """
+        self.filename = None
+        if directory is not None:
+            self.filename = os.path.join(directory, "dark_{0}.npz".format(name))
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.num_pixels = num_pixels
+        self.frames = {}  # (integration time, divider): DarkFrame
+        self._lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, integration_time: int, spectrum, num_reads: int = 1, divider: int = None,
+            timestamp: float = None):
+        """ Put a dark spectrum in the library, replacing any at the same settings
+
+        :param integration_time: integration time in microseconds
+        :param spectrum: dark counts of each pixel summed over num_reads reads
+        :param num_reads: number of reads the spectrum is the sum of
+        :param divider: ST clock divider the spectrum was read with, the one used for the
+        integration time if None
+        :param timestamp: time.time() the spectrum was read, now if None
+        """
+        if divider is None:
+            divider = psoc_spectrometer.st_clock_divider(integration_time)
+        per_read = np.asarray(spectrum, dtype=np.float64) / num_reads
+        frame = DarkFrame(int(integration_time), int(divider), per_read, num_reads,
+                          timestamp or time.time())
+        with self._lock:
+            self.frames[(frame.integration_time, frame.divider)] = frame
+            self._evict()
+
+    def get(self, integration_time: int, divider: int = None) -> np.ndarray:
+        """ Get the dark spectrum for an integration time, measured or interpolated
+
+        :param integration_time: integration time in microseconds
+        :param divider: ST clock divider, the one used for the integration time if None
+        :return: dark counts per read of each pixel, or None if there is no spectrum at these
+        settings and none on both sides of it to interpolate between
+        """
+        if divider is None:
+            divider = psoc_spectrometer.st_clock_divider(integration_time)
+        with self._lock:
+            self._evict()
+            frame = self.frames.get((integration_time, divider))
+            if frame is not None:
+                return frame.spectrum.copy()
+            times = sorted(key[0] for key in self.frames if key[1] == divider)
+            index = bisect.bisect_left(times, integration_time)
+            if index == 0 or index == len(times):
+                return None
+            below = self.frames[(times[index - 1], divider)]
+            above = self.frames[(times[index], divider)]
+        fraction = (integration_time - below.integration_time) / (above.integration_time - below.integration_time)
+        return below.spectrum + fraction * (above.spectrum - below.spectrum)
+
+    def get_or_measure(self, spectrometer: psoc_spectrometer.C12880, integration_time: int) -> np.ndarray:
+        """ Get the dark spectrum for an integration time, reading one if it is not in the
+        library.  A measured spectrum is saved to disk
+
+        :return: dark counts per read of each pixel
+        """
+        spectrum = self.get(integration_time)
+        if spectrum is not None:
+            return spectrum
+        logging.info("measuring dark spectrum at {0} usec".format(integration_time))
+        counts = spectrometer.read_counts(integration_time, background=True)
+        num_reads = psoc_spectrometer.BACKGROUND_NUM_READS
+        self.add(integration_time, counts, num_reads, spectrometer.st_clock_divider)
+        self.save()
+        return counts / num_reads
+
+    def clear(self):
+        with self._lock:
+            self.frames = {}
+
+    def _evict(self):
+        """ Drop spectra that are too old, then the oldest ones if there are too many """
+        oldest_allowed = time.time() - self.max_age
+        for key in [key for key, frame in self.frames.items() if frame.timestamp < oldest_allowed]:
+            del self.frames[key]
+        if len(self.frames) > self.max_entries:
+            by_age = sorted(self.frames, key=lambda key: self.frames[key].timestamp)
+            for key in by_age[:len(self.frames) - self.max_entries]:
+                del self.frames[key]
+
+    def save(self):
+        if not self.filename:
+            return
+        with self._lock:
+            frames = list(self.frames.values())
+        try:
+            os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+            spectra = np.array([frame.spectrum for frame in frames]).reshape(len(frames), self.num_pixels)
+            np.savez(self.filename,
+                     integration_times=np.array([frame.integration_time for frame in frames]),
+                     dividers=np.array([frame.divider for frame in frames]),
+                     spectra=spectra,
+                     num_reads=np.array([frame.num_reads for frame in frames]),
+                     timestamps=np.array([frame.timestamp for frame in frames]))
+        except (OSError, ValueError) as error:
+            logging.error("Could not save the dark spectra: {0}".format(error))
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            with np.load(self.filename) as saved:
+                frames = [DarkFrame(int(integration_time), int(divider), spectrum, int(num_reads),
+                                    float(timestamp))
+                          for integration_time, divider, spectrum, num_reads, timestamp in
+                          zip(saved['integration_times'], saved['dividers'], saved['spectra'],
+                              saved['num_reads'], saved['timestamps'])]
+        except (OSError, KeyError, ValueError) as error:
+            logging.error("Could not load the dark spectra: {0}".format(error))
+            return
+        with self._lock:
+            for frame in frames:
+                if len(frame.spectrum) == self.num_pixels:
+                    self.frames[(frame.integration_time, frame.divider)] = frame
+            self._evict()
+        logging.debug("loaded {0} dark spectra".format(len(self.frames)))
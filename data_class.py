@@ -10,53 +10,153 @@ import os
 from tkinter import messagebox
 import tkinter as tk
 from tkinter import filedialog
+# installed libraries
+import numpy as np
 # local files
+import data_export
+import recording
 
 
 __author__ = 'Kyle V. Lopin'
 
+EXPORT_CHECK_PERIOD = 100  # milliseconds between checks of the export progress
+
 
 class SpectrometerData(object):
+    """ Hold the last spectrum read and the per pixel dark spectrum.  The data is kept in
+    preallocated numpy arrays that are updated in place for each new frame.  The processing is
+    vectorized so it works on a single frame of 288 pixels or a batch of N x 288 frames. """
+
     def __init__(self, wavelengths):
-        self.current_data = None
-        self.background_count = None
-        self.use_background = False
         self.wavelengths = wavelengths
+        self.num_pixels = len(wavelengths)
+        self.current_data = np.zeros(self.num_pixels, dtype=np.float64)
+        self.has_data = False
+        # per pixel counts of a single read with no light, to subtract from the data
+        self.dark_spectrum = np.zeros(self.num_pixels, dtype=np.float64)
+        self.has_dark_spectrum = False
+        self.dark_integration_time = None  # microseconds the dark spectrum is for, if known
+        # dark_library.DarkLibrary to get the dark spectrum from when the integration time changes
+        self.dark_library = None
+        self._unmatched_dark_time = None  # integration time the missing dark spectrum was warned about
+        self.use_background = False
+        self.normalize_integration = False  # flag to convert counts to counts per second
         self.num_reads = 1
+        self.integration_time = None  # microseconds of the current data
+        self.is_rate = False  # current_data came in as counts per second, i.e. a high dynamic range spectrum
 
-    def update_data(self, data, num_data_reads):
+    def update_data(self, data, num_data_reads, integration_time=None, counts_per_second=False):
+        """ Process a new frame into current_data
+
+        :param data: counts summed over num_data_reads reads from the device
+        :param num_data_reads: number of reads the data is the sum of
+        :param integration_time: integration time of the read in microseconds, only needed to
+        normalize the data
+        :param counts_per_second: the data is already dark subtracted counts per second and is
+        used as it is, i.e. a merged high dynamic range spectrum
+        """
         self.num_reads = num_data_reads
-        if self.use_background:
-            logging.debug("using background data")
-            self.current_data = [(x - self.background_count) / num_data_reads for x in data]
+        self.integration_time = integration_time
+        self.is_rate = counts_per_second
+        if counts_per_second:
+            self.current_data[:] = data
         else:
-            logging.debug("not using background data")
-            self.current_data = [x / num_data_reads for x in data]
-        logging.debug("test2")
+            subtract_dark = True
+            if self.use_background and self.has_dark_spectrum:
+                logging.debug("using background data")
+                if integration_time and self.dark_integration_time and \
+                        integration_time != self.dark_integration_time:
+                    dark_spectrum = None
+                    if self.dark_library:
+                        dark_spectrum = self.dark_library.get(integration_time)
+                    if dark_spectrum is not None:
+                        self.set_dark_spectrum(dark_spectrum, 1, integration_time)
+                    else:
+                        # a dark spectrum at another integration time and divider is wrong
+                        if integration_time != self._unmatched_dark_time:
+                            logging.warning("No dark spectrum for {0} usec, the data is shown without "
+                                            "one subtracted".format(integration_time))
+                            self._unmatched_dark_time = integration_time
+                        subtract_dark = False
+            self.process(data, num_data_reads, integration_time, out=self.current_data,
+                         subtract_dark=subtract_dark)
+        self.has_data = True
+
+    @property
+    def units(self) -> str:
+        """ Units of current_data """
+        if self.is_rate or (self.normalize_integration and self.integration_time):
+            return "counts / s"
+        return "counts"
+
+    def process(self, data, num_reads, integration_time=None, out=None, subtract_dark=True):
+        """ Average, dark subtract and normalize spectra.
+
+        :param data: array of counts, either 1 frame of num_pixels or N x num_pixels frames
+        :param num_reads: number of reads each frame is the sum of, a number or an array of N values
+        :param integration_time: microseconds, a number or an array of N values, the data is
+        only normalized to counts per second if normalize_integration is set
+        :param out: array to put the results in, a new array is made if None
+        :param subtract_dark: set False to leave out the dark spectrum even if use_background is set
+        :return: array with the processed data, out if it was given
+        """
+        counts = np.asarray(data)
+        if out is None:
+            out = np.empty(counts.shape, dtype=np.float64)
+        np.divide(counts, _per_frame(num_reads, counts.ndim), out=out)
+        if subtract_dark and self.use_background and self.has_dark_spectrum:
+            np.subtract(out, self.dark_spectrum, out=out)
+        if self.normalize_integration and integration_time:
+            np.divide(out, _per_frame(integration_time, counts.ndim) / 1000000., out=out)
+        return out
+
+    def set_dark_spectrum(self, data, num_reads, integration_time=None):
+        """ Save the counts of a read with no light to subtract from later data
+
+        :param data: summed counts of num_reads dark reads, either 1 frame or N x num_pixels frames
+        that are all averaged together
+        :param num_reads: number of reads each frame is the sum of
+        :param integration_time: integration time of the dark reads in microseconds, if known
+        """
+        self.dark_integration_time = integration_time
+        counts = np.asarray(data, dtype=np.float64)
+        if counts.ndim == 2:
+            np.divide(counts.sum(axis=0), counts.shape[0] * num_reads, out=self.dark_spectrum)
+        else:
+            np.divide(counts, num_reads, out=self.dark_spectrum)
+        self.has_dark_spectrum = True
+
+    def save_data(self, time_course: recording.TimeCourseRecording = None):
+        """ Open a window to save the current spectrum, or all the spectra of a recording
+
+        :param time_course: recording to save instead of the current spectrum
+        """
+        SaveTopLevel(self.wavelengths, self.current_data, self.num_reads, time_course)
 
-    def save_data(self):
-        SaveTopLevel(self.wavelengths, self.current_data, self.num_reads)
+
+def _per_frame(values, num_dimensions):
+    """ Shape a number or an array of values for each frame so it broadcasts over the pixels """
+    values = np.asarray(values, dtype=np.float64)
+    if num_dimensions == 2 and values.ndim == 1:
+        return values[:, np.newaxis]
+    return values
 
 
 class SaveTopLevel(tk.Toplevel):
-    def __init__(self, wavelength_data, light_data, num_reads):
+    def __init__(self, wavelength_data, light_data, num_reads, time_course=None):
         tk.Toplevel.__init__(self, master=None)
         self.geometry('400x300')
         self.title("Save data")
-        self.data_string = tk.StringVar()
-
-        self.data_string = "Wavelength, counts\n"
-        for i, _data in enumerate(wavelength_data):
-
-            if num_reads == 1:
-                self.data_string += "{0:.2f}, {1:d}\n".format(_data, int(light_data[i]))
-            else:
-                self.data_string += "{0:.2f}, {0:.2f}\n".format(_data, light_data[i])
+        self.wavelengths = wavelength_data
+        self.light_data = light_data
+        self.num_reads = num_reads
+        self.time_course = time_course  # type: recording.TimeCourseRecording
+        self.export_job = None  # type: data_export.ExportJob
 
         text_frame = tk.Frame(self)
         text_frame.pack(side='top')
         text_box = tk.Text(text_frame, width=40, height=8)
-        text_box.insert(tk.END, self.data_string)
+        text_box.insert(tk.END, self.make_preview())
         text_box.pack(side='left')
 
         scrollbar = tk.Scrollbar(text_frame, command=text_box.yview)
@@ -68,42 +168,76 @@ class SaveTopLevel(tk.Toplevel):
         self.comment = tk.Text(self, width=40, height=3)
         self.comment.pack(side='top', pady=6)
 
+        self.progress_label = tk.Label(self, text="")
+        self.progress_label.pack(side='top')
+
         button_frame = tk.Frame(self)
         button_frame.pack(side='top', pady=6)
-        tk.Button(button_frame, text="Save Data", command=self.save_data).pack(side='left', padx=10)
-        tk.Button(button_frame, text="Close", command=self.destroy).pack(side='left', padx=10)
+        self.save_button = tk.Button(button_frame, text="Save Data", command=self.save_data)
+        self.save_button.pack(side='left', padx=10)
+        tk.Button(button_frame, text="Close", command=self.close).pack(side='left', padx=10)
+
+    def make_preview(self) -> str:
+        if self.time_course is not None:
+            return "{0} spectra recorded in:\n{1}\n".format(len(self.time_course),
+                                                          self.time_course.directory)
+        lines = ["Wavelength, counts"]
+        for wavelength, counts in zip(self.wavelengths, self.light_data):
+            if self.num_reads == 1:
+                lines.append("{0:.2f}, {1:d}".format(wavelength, int(counts)))
+            else:
+                lines.append("{0:.2f}, {1:.2f}".format(wavelength, counts))
+        return "\n".join(lines) + "\n"
 
     def save_data(self):
         logging.debug("saving data")
         self.attributes('-topmost', 'false')
-        _file = None
+        filename = None
         try:
-            _file = open_file('saveas')  # open the file
-            logging.debug("saving data: 4; file: {0}".format(_file))
+            filename = open_file('saveas_name')
+            logging.debug("saving data to file: {0}".format(filename))
         except Exception as error:
             messagebox.showerror(title="Error", message=error)
         self.attributes('-topmost', 'true')
 
-        if _file:
-            if self.comment.get(1.0, tk.END):
-                logging.debug("saving data: 5")
-                self.data_string += self.comment.get(1.0, tk.END)
-                logging.debug("saving data: 6; string: {0}".format(self.data_string))
-            try:
-
-                _file.write(self.data_string)
-                logging.debug("saving data: 7")
-                _file.close()
-                self.destroy()
-
-            except Exception as error:
-
-                messagebox.showerror(title="Error", message=error)
-                self.lift()
+        if not filename:
+            self.destroy()
+            return
+        comment = self.comment.get(1.0, tk.END)
+        if not comment.strip():
+            comment = None
+        if self.time_course is not None:
+            frame_info = {name: self.time_course.fields[name][:len(self.time_course)]
+                          for name, _ in recording.FRAME_FIELDS}
+            self.export_job = data_export.ExportJob(filename, self.wavelengths, self.time_course[:],
+                                                    frame_info, comment=comment)
+        else:
+            self.export_job = data_export.ExportJob(filename, self.wavelengths, self.light_data.copy(),
+                                                    num_reads=self.num_reads, comment=comment)
+        self.save_button.config(state=tk.DISABLED)
+        self.export_job.start()
+        self.check_export()
 
+    def check_export(self):
+        """ Show the progress of the export until it is done, the export runs on another thread
+        so the GUI keeps working """
+        job = self.export_job
+        if job.is_alive():
+            self.progress_label.config(text="Saved {0} of {1} spectra".format(job.rows_written,
+                                                                           job.total_rows))
+            self.after(EXPORT_CHECK_PERIOD, self.check_export)
+        elif job.error:
+            messagebox.showerror(title="Error", message=job.error)
+            self.save_button.config(state=tk.ACTIVE)
+            self.lift()
         else:
             self.destroy()
 
+    def close(self):
+        if self.export_job and self.export_job.is_alive():
+            self.export_job.cancel()
+        self.destroy()
+
 
 def open_file(_type):
     """
@@ -117,7 +251,11 @@ def open_file(_type):
     # options['filetypes'] = [('All files', '*.*'), ("Comma separate values", "*.csv")]
     options['filetypes'] = [("Comma separate values", "*.csv")]
     logging.debug("saving data: 1")
-    if _type == 'saveas':
+    if _type == 'saveas_name':
+        """ Ask the user what name to save the file as, and let the exporter open it """
+        options['filetypes'] = data_export.EXPORT_FORMATS
+        return filedialog.asksaveasfilename(**file_opt)
+    elif _type == 'saveas':
         """ Ask the user what name to save the file as """
         logging.debug("saving data: 2")
         _file = filedialog.asksaveasfile(mode='a', confirmoverwrite=False, **file_opt)
@@ -130,7 +268,7 @@ def open_file(_type):
 
 if __name__ == '__main__':
     data = SpectrometerData([450, 500, 550, 570, 600, 650])
-    app = SaveTopLevel([450, 500, 550, 570, 600, 650], [1, 2, 3, 4, 5, 6])
+    app = SaveTopLevel([450, 500, 550, 570, 600, 650], np.array([1, 2, 3, 4, 5, 6]), 1)
     app.title("Spectrograph")
     app.geometry("900x650")
     app.mainloop()
\ No newline at end of file
@@ -0,0 +1,148 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Export spectra to files on a worker thread.  The rows are written to the file in chunks as
+they are formatted so a long time course never has to be held in memory as one string, and the
+GUI thread only has to check on the progress. """
+
+# standard libraries
+import logging
+import os
+import threading
+import zipfile
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+CHUNK_ROWS = 1024  # number of rows formatted and written at a time
+CSV = 'csv'
+BINARY = 'npz'  # numpy zip file, can be opened with numpy.load
+EXPORT_FORMATS = [("Comma separate values", "*.csv"), ("Numpy binary", "*.npz")]
+PARTIAL_SUFFIX = '.part'  # added to the file name until the export is finished
+
+
+def format_from_filename(filename: str) -> str:
+    """ Pick the export format from the file extension, csv is used for unknown extensions """
+    if filename.lower().endswith("." + BINARY):
+        return BINARY
+    return CSV
+
+
+class ExportJob(threading.Thread):
+    """ Write one spectrum, or a set of spectra, to a file on a separate thread.
+
+    A single spectrum is saved as a column of wavelengths and counts.  A set of spectra is saved
+    with a row for each spectrum, with the information of each frame before the counts. """
+
+    def __init__(self, filename: str, wavelengths, counts, frame_info: dict = None,
+                 num_reads: int = 1, comment: str = None, export_format: str = None):
+        """
+        :param filename: name of the file to save to, it is overwritten
+        :param wavelengths: wavelength of each pixel
+        :param counts: array of 1 spectrum, or N x pixels array of spectra i.e. a memory mapped recording
+        :param frame_info: names and arrays of N values to save with each spectrum, i.e. timestamps
+        :param num_reads: number of reads a single spectrum is the average of, 1 saves integer counts
+        :param comment: text to add at the end of a csv file, or as an entry of a binary file
+        :param export_format: CSV or BINARY, chosen from the filename if None
+        """
+        threading.Thread.__init__(self, name="Data export", daemon=True)
+        self.filename = filename
+        self.wavelengths = np.asarray(wavelengths)
+        self.counts = counts
+        self.frame_info = frame_info or {}
+        self.num_reads = num_reads
+        self.comment = comment
+        self.export_format = export_format or format_from_filename(filename)
+        self.total_rows = len(counts) if np.ndim(counts) == 2 else 1
+        self.rows_written = 0
+        self.error = None  # exception that stopped the export
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def run(self):
+        # write to a temporary file so a cancelled or failed export does not leave a truncated
+        # file, or overwrite a good one, under the name the user picked
+        partial_filename = self.filename + PARTIAL_SUFFIX
+        try:
+            if self.export_format == BINARY:
+                self.write_binary(partial_filename)
+            else:
+                self.write_csv(partial_filename)
+            if self.cancelled:
+                logging.info("Export to {0} cancelled".format(self.filename))
+                return
+            os.replace(partial_filename, self.filename)
+            logging.debug("exported {0} rows to {1}".format(self.rows_written, self.filename))
+        except Exception as error:
+            logging.error("Export failed: {0}".format(error))
+            self.error = error
+        finally:
+            if os.path.exists(partial_filename):
+                try:
+                    os.remove(partial_filename)
+                except OSError as error:
+                    logging.error("Could not remove {0}: {1}".format(partial_filename, error))
+
+    def write_csv(self, filename: str):
+        with open(filename, 'w') as _file:
+            if np.ndim(self.counts) == 1:
+                _file.write("Wavelength, counts\n")
+                if self.num_reads == 1:
+                    row_format = "%.2f, %d"
+                else:
+                    row_format = "%.2f, %.2f"
+                np.savetxt(_file, np.column_stack((self.wavelengths, self.counts)), fmt=row_format)
+                self.rows_written = 1
+            else:
+                info_names = list(self.frame_info.keys())
+                header = info_names + ["{0:.2f}".format(wavelength) for wavelength in self.wavelengths]
+                _file.write(", ".join(header) + "\n")
+                row_format = ", ".join(["%.6f"] * len(info_names) + ["%.2f"] * len(self.wavelengths))
+                for start in range(0, self.total_rows, CHUNK_ROWS):
+                    if self.cancelled:
+                        return
+                    end = min(start + CHUNK_ROWS, self.total_rows)
+                    columns = [np.asarray(self.frame_info[name][start:end], dtype=np.float64)[:, np.newaxis]
+                               for name in info_names]
+                    columns.append(self.counts[start:end])
+                    np.savetxt(_file, np.hstack(columns), fmt=row_format)
+                    self.rows_written = end
+            if self.comment:
+                _file.write(self.comment)
+
+    def write_binary(self, filename: str):
+        counts = np.asarray(self.counts)
+        with zipfile.ZipFile(filename, 'w', allowZip64=True) as archive:
+            _write_npy(archive, 'wavelengths', self.wavelengths)
+            for name, values in self.frame_info.items():
+                _write_npy(archive, name, np.asarray(values))
+            if self.comment:
+                _write_npy(archive, 'comment', np.array(self.comment))
+            # write the counts in chunks so a memory mapped recording is never fully loaded
+            dtype = counts.dtype.newbyteorder('<')
+            header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                      'shape': counts.shape}
+            with archive.open('counts.npy', 'w', force_zip64=True) as entry:
+                np.lib.format.write_array_header_2_0(entry, header)
+                if counts.ndim == 1:
+                    entry.write(counts.astype(dtype).tobytes())
+                    self.rows_written = 1
+                    return
+                for start in range(0, self.total_rows, CHUNK_ROWS):
+                    if self.cancelled:
+                        return
+                    end = min(start + CHUNK_ROWS, self.total_rows)
+                    entry.write(np.ascontiguousarray(counts[start:end], dtype=dtype).tobytes())
+                    self.rows_written = end
+
+
+def _write_npy(archive: zipfile.ZipFile, name: str, array: np.ndarray):
+    """ Save a small array as an entry of a numpy zip file """
+    with archive.open(name + '.npy', 'w') as entry:
+        np.lib.format.write_array(entry, array, allow_pickle=False)
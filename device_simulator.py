@@ -0,0 +1,293 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Simulated PSoC with a C12880 attached.  SimulatedPSoC answers the same text commands as the
+PSoC firmware, through the same write / read calls as a pyUSB device, so it can be given to
+usb_comm.PSoC_USB in place of the real device.  Exposures and USB transfers take as long as
+they would on the hardware and the spectra are made up of a dark signal, the light sources
+that are on, and shot noise. """
+
+# standard libraries
+import array
+import logging
+import struct
+import threading
+import time
+# installed libraries
+import numpy as np
+import usb.core
+# local files
+import calibration
+
+__author__ = 'Kyle Vitautas Lopin'
+
+NUM_PIXELS = 288
+PSOC_CLOCK_CYCLES_PER_US = 24
+INTEGRATION_CLOCK_OFFSET = 48  # the C12880 integrates for 48 clock cycles more than ST is high
+READOUT_CLOCK_CYCLES = 88 + 288 + 12  # clock cycles after the integration until the end of scan
+DEFAULT_PACKET_SIZE = 64  # bytes the simulated firmware puts in each USB packet
+USB_BYTES_PER_SECOND = 800000.  # rough speed of full speed bulk transfers
+COMMAND_LATENCY = 0.0002  # seconds for the PSoC to handle a command
+SATURATION_COUNT = 4095  # 12 bit ADC
+DARK_OFFSET = 180.  # counts with no light and no integration time
+DARK_RATE = 400.  # counts per second of integration from dark current
+READ_NOISE = 3.  # standard deviation of the counts from the read electronics
+
+# name of the light source: center wavelength (nm), width (nm), counts per second at full power
+LIGHT_SPECTRA = {"LED": (450., 20., 60000.),
+                 "Laser": (650., 1.5, 250000.),
+                 "Light 1": (560., 120., 30000.)}
+AMBIENT_LIGHT = (550., 150., 2000.)
+
+COMMAND_SEPARATOR = ";"
+QUERY_DONE = b"DONE     "
+QUERY_NOT_DONE = b"NOT DONE "
+QUERY_NO_DATA = b"NO DATA  "
+MAX_POWER_LEVEL = 5  # CAT4004 power levels go from 0, full power, to 5
+
+
+class SimulatedLight(object):
+    def __init__(self, wavelengths, center, width, rate):
+        self.profile = rate * np.exp(-0.5 * ((wavelengths - center) / width) ** 2)
+        self.on = False
+        self.power_fraction = 1.0
+        self.flash = False
+
+
+class SimulatedPSoC(object):
+    """ Stand in for the pyUSB device of a PSoC running the spectrometer firmware """
+
+    def __init__(self, serial: str = calibration.DEFAULT_SERIAL,
+                 packet_size: int = DEFAULT_PACKET_SIZE, time_scale: float = 1.0, seed=None,
+                 supports_batches: bool = True, serial_number: str = None):
+        """
+        :param serial: serial number of the C12880, picks the wavelength calibration
+        :param packet_size: bytes in each data packet the firmware sends, the old firmware used 48
+        :param time_scale: multiply all simulated exposure and transfer times by this
+        :param seed: seed for the random noise
+        :param supports_batches: run commands joined by COMMAND_SEPARATOR as separate commands,
+        set False to act like firmware that takes one command per transfer
+        :param serial_number: USB serial number of the simulated PSoC, the C12880 serial if None
+        """
+        self.serial = serial
+        self.serial_number = serial_number or serial
+        self.packet_size = packet_size
+        self.time_scale = time_scale
+        self.random = np.random.RandomState(seed)
+        wavelengths = calibration.get_calibration(serial).wavelengths
+        self.ambient = SimulatedLight(wavelengths, *AMBIENT_LIGHT).profile
+        self.lights = {name: SimulatedLight(wavelengths, *spectrum)
+                       for name, spectrum in LIGHT_SPECTRA.items()}
+
+        self.commands_received = 0
+        self.transfers_received = 0
+        self.supports_batches = supports_batches  # run several commands sent in one transfer
+        self.attached = True  # False while the simulated USB cable is unplugged
+
+        self._condition = threading.Condition()
+        self._power_on()
+
+    def _power_on(self):
+        """ Put the firmware in the state it starts up in """
+        self.st_divider = 48
+        self.st_period = 1952
+        self.read_done_time = None  # time the running or last read is done
+        self.reads_pending = 0
+        self.reads_dark = False
+        self.single_data = np.zeros(NUM_PIXELS, dtype='<u2')
+        self.multi_data = np.zeros(NUM_PIXELS, dtype='<u4')
+        for light in self.lights.values():
+            light.on = False
+            light.power_fraction = 1.0
+            light.flash = False
+        self._responses = []  # list of [bytes, time it is ready] waiting to be read
+
+    def unplug(self):
+        """ Act like the USB cable was pulled out, reads and writes fail until plug_in """
+        with self._condition:
+            self.attached = False
+            self._condition.notify_all()
+
+    def plug_in(self):
+        """ Reattach the device, the firmware restarts with its default settings """
+        with self._condition:
+            self._power_on()
+            self.attached = True
+
+    @property
+    def integration_time(self) -> float:
+        """ Integration time in microseconds set by the ST divider and period """
+        clock_period = self.st_divider / PSOC_CLOCK_CYCLES_PER_US
+        return (self.st_period + INTEGRATION_CLOCK_OFFSET) * clock_period
+
+    def read_time(self) -> float:
+        """ Seconds a single read takes """
+        clock_period = self.st_divider / PSOC_CLOCK_CYCLES_PER_US
+        return (self.integration_time + READOUT_CLOCK_CYCLES * clock_period) / 1000000.
+
+    # pyUSB device calls
+    def set_configuration(self):
+        pass
+
+    def write(self, endpoint, data, timeout=None) -> int:
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        data = bytes(data)
+        with self._condition:
+            if not self.attached:
+                raise usb.core.USBError("No such device", errno=19)
+            self.transfers_received += 1
+            commands = [data.decode('ascii', 'replace')]
+            if self.supports_batches:
+                commands = commands[0].split(COMMAND_SEPARATOR)
+            for command in commands:
+                self.commands_received += 1
+                self._handle_command(command)
+            self._condition.notify_all()
+        return len(data)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        """ Read the next response the same way as a pyUSB bulk read, whole packets are returned
+        until the size asked for is filled or a short packet ends the transfer """
+        if isinstance(size_or_buffer, array.array):
+            buffer = size_or_buffer
+            size = len(buffer) * buffer.itemsize
+        else:
+            buffer = None
+            size = size_or_buffer
+        deadline = time.time() + (timeout or 1000) / 1000.
+        with self._condition:
+            while not self._responses or self._responses[0][1] > time.time():
+                if not self.attached:
+                    raise usb.core.USBError("No such device", errno=19)
+                if time.time() > deadline:
+                    raise usb.core.USBTimeoutError("Operation timed out", errno=110)
+                wait_time = deadline - time.time()
+                if self._responses:
+                    wait_time = min(wait_time, self._responses[0][1] - time.time())
+                self._condition.wait(max(0., wait_time))
+            response = self._responses[0]
+            data = response[0]
+            num_bytes = min(size, len(data))
+            if num_bytes < len(data) and num_bytes % self.packet_size:
+                raise usb.core.USBError("Overflow", errno=75)
+            chunk = data[:num_bytes]
+            if num_bytes == len(data):
+                self._responses.pop(0)
+            else:
+                response[0] = data[num_bytes:]
+        if buffer is not None:
+            memoryview(buffer).cast('B')[:num_bytes] = chunk
+            return num_bytes
+        return array.array('B', chunk)
+
+    # firmware
+    def _queue_response(self, data: bytes):
+        """ Put a response to be read.  Data bigger than a packet is only ready after the time
+        it takes to send all the packets """
+        ready_time = time.time() + self.time_scale * COMMAND_LATENCY
+        if len(data) <= self.packet_size:
+            self._responses.append([data, ready_time])
+            return
+        seconds_per_packet = self.time_scale * self.packet_size / USB_BYTES_PER_SECOND
+        packets = [data[i:i + self.packet_size] for i in range(0, len(data), self.packet_size)]
+        if self.packet_size < DEFAULT_PACKET_SIZE:
+            # short packets end a transfer each, so every packet has to be read on its own
+            for i, packet in enumerate(packets):
+                self._responses.append([packet, ready_time + (i + 1) * seconds_per_packet])
+        else:
+            # full size packets run together into one transfer
+            self._responses.append([data, ready_time + len(packets) * seconds_per_packet])
+
+    def _handle_command(self, command: str):
+        fields = command.split("|")
+        if command == "ID":
+            self._queue_response(b"PSoC-Spectrometer")
+        elif command == "ID-Spectrometer":
+            self._queue_response(b"C12880")
+        elif fields[0] == "C12880":
+            self._handle_c12880_command(fields[1:])
+        elif fields[0] in self.lights:
+            self._handle_light_command(self.lights[fields[0]], fields[1:])
+        else:
+            logging.info("Simulator got unknown command: {0}".format(command))
+
+    def _handle_c12880_command(self, fields):
+        command = fields[0]
+        if command == "ST_DIVIDER":
+            self.st_divider = int(fields[1])
+        elif command == "ST_PERIOD":
+            self.st_period = int(fields[1])
+        elif command == "READ_SINGLE":
+            self._start_reads(1)
+        elif command == "READ_MULTI":
+            self._start_reads(int(fields[1]))
+        elif command == "BACKGROUND":
+            self._start_reads(10, dark=True)
+        elif command == "QUERY_RUN":
+            if self.read_done_time is None:
+                self._queue_response(QUERY_NO_DATA)
+            elif time.time() < self.read_done_time:
+                self._queue_response(QUERY_NOT_DONE)
+            else:
+                self._finish_reads()
+                self._queue_response(QUERY_DONE)
+        elif command == "EXPORT_DATA":
+            self._finish_reads()
+            if fields[1] == "SINGLE":
+                data = self.single_data.tobytes()
+            else:
+                data = self.multi_data.tobytes()
+            self._queue_response(data)
+        elif command == "DEBUG":
+            self._queue_response(struct.pack('<HHHHHB', 0, 1, 1, self.st_period, NUM_PIXELS, 1))
+        else:
+            logging.info("Simulator got unknown C12880 command: {0}".format(command))
+
+    def _handle_light_command(self, light: SimulatedLight, fields):
+        command = fields[0]
+        if command == "ON":
+            light.on = True
+            if len(fields) > 1:
+                self._set_light_power(light, fields[1])
+        elif command == "OFF":
+            light.on = False
+        elif command == "POWER":
+            self._set_light_power(light, fields[1])
+        elif command == "Flash":
+            light.flash = fields[1] == "1"
+
+    @staticmethod
+    def _set_light_power(light: SimulatedLight, level: str):
+        # CAT4004 levels halve the power for each step, the PWM dimmer sends a 3 digit duty cycle
+        if len(level) == 3:
+            light.power_fraction = min(1., int(level) / 32.)
+        else:
+            light.power_fraction = 1. / 2 ** min(int(level), MAX_POWER_LEVEL)
+
+    def _start_reads(self, num_reads: int, dark: bool = False):
+        self._finish_reads()  # data of a finished read stays until a new read is made
+        self.reads_pending = num_reads
+        self.reads_dark = dark
+        self.read_done_time = time.time() + self.time_scale * (COMMAND_LATENCY +
+                                                               num_reads * self.read_time())
+
+    def _finish_reads(self):
+        """ Make the data of the reads once they are done """
+        if not self.reads_pending or time.time() < self.read_done_time:
+            return
+        spectra = self._make_spectra(self.reads_pending, self.reads_dark)
+        self.multi_data[:] = spectra.sum(axis=0)
+        self.single_data[:] = spectra[-1]
+        self.reads_pending = 0
+
+    def _make_spectra(self, num_reads: int, dark: bool = False) -> np.ndarray:
+        integration_seconds = self.integration_time / 1000000.
+        rate = self.ambient + DARK_RATE
+        if not dark:
+            for light in self.lights.values():
+                if light.on:
+                    rate = rate + light.power_fraction * light.profile
+        signal = rate * integration_seconds
+        noise = self.random.normal(0., 1., (num_reads, NUM_PIXELS)) * np.sqrt(signal + READ_NOISE ** 2)
+        counts = DARK_OFFSET + signal + noise
+        return np.clip(np.rint(counts), 0, SATURATION_COUNT)
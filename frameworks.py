@@ -6,7 +6,6 @@ import tkinter as tk
 # installed libraries
 # local files
 import psoc_spectrometer
-import pyplot_embed
 
 
 class LightButtons(tk.Frame):
@@ -16,9 +15,8 @@ class LightButtons(tk.Frame):
         self.light = light
         tk.Label(self, text="{0} power (mA):".format(light.name)).pack(side='top', pady=button_pady)
 
-        lighting_options = light.power_options
-
-        tk.OptionMenu(self, light.power_var, *light.power_options,
+        self.power_var = tk.StringVar(value=light.power_option)
+        tk.OptionMenu(self, self.power_var, *light.power_options,
                       command=light.change_power_level).pack(side='top', pady=button_pady)
 
         self.button = tk.Button(self, text="Turn {0} On".format(light.name),
@@ -0,0 +1,29 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Y axis scales of the spectrum graph, kept apart from the tkinter plot so the scale can be
+picked without a display, i.e. by the benchmark """
+
+# standard libraries
+import bisect
+
+__author__ = 'Kyle Vitautas Lopin'
+
+COUNT_SCALE = [10, 20, 50, 100, 200, 500, 1000, 5000, 10000, 50000, 100000,
+               500000, 1000000, 5000000, 10000000, 50000000, 100000000]  # last ones for counts / s
+SCALE_HYSTERESIS = 0.8  # only go to a smaller scale when the peak is below this fraction of it
+
+
+def select_scale_index(peak: float, current_index: int, hysteresis: float = SCALE_HYSTERESIS) -> int:
+    """ Pick the index of COUNT_SCALE to use as the y limit.  The scale goes up as soon as the
+    peak is above it, but only goes down when the peak is well below the smaller scale so the
+    axis does not flicker between 2 scales when the peak is near a boundary.
+
+    :param peak: largest value to be displayed
+    :param current_index: index of COUNT_SCALE being used now
+    :param hysteresis: fraction of a smaller scale the peak has to be under to use it
+    :return: index of COUNT_SCALE to use
+    """
+    needed_index = min(bisect.bisect_left(COUNT_SCALE, peak), len(COUNT_SCALE) - 1)
+    if needed_index >= current_index:
+        return needed_index
+    return min(bisect.bisect_left(COUNT_SCALE, peak / hysteresis), current_index)
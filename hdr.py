@@ -0,0 +1,143 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" High dynamic range spectra.  A bracket of reads at different integration times is taken
+back to back, the next integration time and read trigger are sent with the export request of
+the last read so the sensor is exposing while the data is transferred.  The reads are merged
+pixel by pixel into counts per second: each read's estimate is weighted by the inverse of its
+shot and read noise variance, and saturated pixels are left out, so bright peaks come from the
+short reads and weak bands from the long ones. """
+
+# standard libraries
+import collections
+import logging
+import time
+# installed libraries
+import numpy as np
+# local files
+import psoc_spectrometer
+import usb_comm
+
+__author__ = 'Kyle Vitautas Lopin'
+
+SATURATION_COUNT = 4095  # 12 bit ADC
+SATURATION_LEVEL = 0.98  # fraction of the full count a pixel is taken as saturated at
+READ_NOISE = 3.  # standard deviation of a read in counts
+BRACKET_RATIO = 8  # each integration time of the default bracket is this much shorter than the last
+BRACKET_SIZE = 3
+
+Bracket = collections.namedtuple('Bracket', ['counts', 'integration_times', 'num_reads', 'timestamps'])
+
+
+def default_bracket(longest_time: int, ratio: float = BRACKET_RATIO, size: int = BRACKET_SIZE) -> list:
+    """ Integration times of a bracket, longest first, none shorter than the C12880 can do
+
+    :param longest_time: integration time of the longest read in microseconds
+    :return: list of integration times in microseconds with no repeats
+    """
+    times = []
+    for i in range(size):
+        integration_time = max(int(longest_time / ratio ** i), psoc_spectrometer.MIN_INTEGRATION_TIME)
+        if integration_time not in times:
+            times.append(integration_time)
+    return times
+
+
+def acquire_bracket(spectrometer: psoc_spectrometer.C12880, integration_times, num_reads: int = 1,
+                    pipeline: bool = True) -> Bracket:
+    """ Read the spectrometer once at each integration time
+
+    :param spectrometer: C12880 to read, it can not be streaming
+    :param integration_times: integration times in microseconds
+    :param num_reads: number of reads the PSoC sums at each integration time
+    :param pipeline: send the next integration time and trigger with each export request
+    :return: Bracket with an N x pixels array of counts and the settings of each read
+    :raise IOError: if a read fails
+    :raise RuntimeError: if the spectrometer is streaming
+    """
+    if spectrometer.stream is not None and spectrometer.stream.is_alive():
+        raise RuntimeError("Can not read a bracket while the spectrometer is streaming")
+    usb = spectrometer.usb
+    read_command = spectrometer.get_read_command(num_reads)
+    if not read_command:
+        raise ValueError("Can not read {0} times".format(num_reads))
+    if num_reads == 1:
+        read_data = usb.read_single_data
+    else:
+        read_data = usb.read_multi_data
+    counts = np.empty((len(integration_times), usb_comm.NUM_PIXELS), dtype=np.float64)
+    timestamps = np.empty(len(integration_times))
+
+    def trigger(integration_time):
+        if not spectrometer.set_integration_time(integration_time):
+            raise ValueError("Bad integration time: {0}".format(integration_time))
+        usb.usb_write(read_command)
+
+    with usb.lock:
+        trigger(integration_times[0])
+        trigger_time = time.time()
+        for i, integration_time in enumerate(integration_times):
+            # the integration time of the read being waited on is needed for its prediction
+            spectrometer.integration_time = integration_time
+            spectrometer.st_clock_divider = psoc_spectrometer.st_clock_divider(integration_time)
+            query_message = spectrometer.wait_for_data(num_reads, trigger_time)
+            if query_message in (psoc_spectrometer.QUERY_NOT_DONE, psoc_spectrometer.QUERY_NO_DATA) \
+                    or not query_message:
+                raise IOError("Bad data query message: {0}".format(query_message))
+            next_command = None
+            last_read = i + 1 == len(integration_times)
+            if pipeline and not last_read:
+                next_command = lambda: trigger(integration_times[i + 1])
+            data = read_data(next_command)
+            # the next exposure started when the trigger was sent, before the transfer
+            next_trigger_time = usb.export_time
+            if data is None:
+                raise IOError("Failed reading data at {0} usec".format(integration_time))
+            counts[i] = data
+            timestamps[i] = trigger_time
+            if not pipeline and not last_read:
+                trigger(integration_times[i + 1])
+                next_trigger_time = time.time()
+            trigger_time = next_trigger_time
+        # leave the spectrometer set to the last read's integration time
+        spectrometer.integration_time = integration_times[-1]
+        spectrometer.st_clock_divider = psoc_spectrometer.st_clock_divider(integration_times[-1])
+    return Bracket(counts, np.asarray(integration_times, dtype=np.float64),
+                   np.full(len(integration_times), num_reads), timestamps)
+
+
+def merge_bracket(counts, integration_times, num_reads=1, dark=None,
+                  saturation_count: float = SATURATION_COUNT, read_noise: float = READ_NOISE):
+    """ Merge reads at different integration times into one spectrum of counts per second
+
+    :param counts: N x pixels array of the counts of each read, summed over its num_reads
+    :param integration_times: N integration times in microseconds
+    :param num_reads: number of reads each frame is the sum of, a number or N values
+    :param dark: offset of each pixel in counts per read to subtract, i.e. a dark spectrum, a
+    number or an array of pixels.  The offset does not grow with the integration time so it
+    has to be removed for the reads to agree
+    :param saturation_count: full scale count of the ADC
+    :param read_noise: standard deviation of a read in counts
+    :return: (counts per second of each pixel, boolean array of the pixels saturated in every
+    read, their value is only a lower bound from the shortest read)
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    seconds = np.asarray(integration_times, dtype=np.float64)[:, np.newaxis] / 1000000.
+    reads = np.broadcast_to(np.asarray(num_reads, dtype=np.float64),
+                            (counts.shape[0],))[:, np.newaxis]
+    per_read = counts / reads
+    saturated = per_read >= SATURATION_LEVEL * saturation_count
+    signal = per_read if dark is None else per_read - dark
+    rates = signal / seconds
+
+    # variance of each rate estimate is (shot noise + read noise) / (reads * seconds ** 2)
+    weights = reads * seconds ** 2 / (np.maximum(signal, 0.) + read_noise ** 2)
+    weights[saturated] = 0.
+    total_weight = weights.sum(axis=0)
+    all_saturated = total_weight == 0.
+    merged = np.einsum('ij,ij->j', weights, rates)
+    np.divide(merged, total_weight, out=merged, where=~all_saturated)
+    if np.any(all_saturated):
+        shortest = int(np.argmin(seconds[:, 0]))
+        merged[all_saturated] = rates[shortest, all_saturated]
+        logging.debug("{0} pixels saturated at every integration time".format(all_saturated.sum()))
+    return merged, all_saturated
@@ -0,0 +1,118 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Watch for the PSoC being unplugged and plugged back in.  When the device goes away, or a
+write to it fails, it is looked for again every poll period.  Once it answers again the
+integration time and light settings it had are written back, as the firmware restarts with its
+defaults, and a stream that was stopped by the disconnect is started again.  A stream stopped
+by an error while the device stayed connected is restarted too, a few times. """
+
+# standard libraries
+import logging
+import threading
+# local files
+import psoc_spectrometer
+
+__author__ = 'Kyle Vitautas Lopin'
+
+POLL_PERIOD = 1.0  # seconds between checks of the device
+MAX_RETRY_PERIOD = 10.0  # longest seconds between reconnection attempts, they back off to this
+STREAM_STOP_TIMEOUT = 5.0  # seconds to wait for a stream to notice the device is gone
+MAX_STREAM_RESUMES = 3  # times in a row a stream that stops without reading a frame is restarted
+
+CONNECTED = "connected"
+DISCONNECTED = "disconnected"
+RECONNECTED = "reconnected"
+
+
+class DeviceMonitor(threading.Thread):
+    """ Polls a PSoC on a separate thread and reconnects it when it comes back """
+
+    def __init__(self, device: psoc_spectrometer.PSoC, poll_period: float = POLL_PERIOD,
+                 max_retry_period: float = MAX_RETRY_PERIOD, status_callback=None):
+        """
+        :param device: PSoC to watch
+        :param poll_period: seconds between checks that the device is still there
+        :param max_retry_period: longest seconds between reconnection attempts, the time between
+        attempts doubles from the poll period up to this while the device is missing
+        :param status_callback: function called with CONNECTED, DISCONNECTED or RECONNECTED
+        when the device's state changes, from the monitor's thread
+        """
+        threading.Thread.__init__(self, name="device monitor", daemon=True)
+        self.device = device
+        self.usb = device.usb
+        self.poll_period = poll_period
+        self.max_retry_period = max_retry_period
+        self.status_callback = status_callback or (lambda status: None)
+        self.reconnects = 0
+        self.failed_stream = None  # type: psoc_spectrometer.StreamingAcquisition, not resumed again
+        self._stream_resumes = 0
+        self._retry_period = poll_period
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        wait_time = self.poll_period
+        while not self._stop_event.wait(wait_time):
+            wait_time = self.check()
+
+    def check(self) -> float:
+        """ Check the device once and try to reconnect it if it is gone
+
+        :return: seconds to wait before the next check
+        """
+        usb = self.usb
+        if usb.connected and usb.device_present():
+            self._retry_period = self.poll_period
+            self.resume_stream()  # a stream can also stop on an error of a device that is still there
+            return self.poll_period
+        if usb.connected or self._retry_period == self.poll_period:
+            logging.warning("Spectrometer disconnected")
+            usb.connected = False
+            self.status_callback(DISCONNECTED)
+        try:
+            reconnected = usb.reconnect()
+        except Exception as error:  # i.e. the device is still being set up by the computer
+            logging.info("Reconnect failed: {0}".format(error))
+            reconnected = False
+        if not reconnected:
+            wait_time = self._retry_period
+            self._retry_period = min(2 * self._retry_period, self.max_retry_period)
+            return wait_time
+        self._retry_period = self.poll_period
+        self.reconnects += 1
+        self.restore()
+        self.status_callback(RECONNECTED)
+        return self.poll_period
+
+    def restore(self):
+        """ Put the reconnected device back the way it was and resume its stream """
+        stream = self.device.spectrometer.stream
+        if stream is not None:
+            # the stream only stops after its query of the gone device times out
+            stream.join(STREAM_STOP_TIMEOUT)
+            if stream.is_alive():
+                logging.warning("Stream still running {0} s after the disconnect, it will be "
+                                "resumed on a later check".format(STREAM_STOP_TIMEOUT))
+        self.device.restore_settings()
+        self.resume_stream()
+
+    def resume_stream(self):
+        """ Start the spectrometer's stream again if it stopped on an error.  A stream that keeps
+        stopping before it reads a frame is given up on after MAX_STREAM_RESUMES tries and put
+        in failed_stream. """
+        spectrometer = self.device.spectrometer
+        stream = spectrometer.stream
+        if (stream is None or stream.is_alive() or stream.stopped or not stream.error
+                or stream is self.failed_stream):
+            return
+        if stream.frames_read:
+            self._stream_resumes = 0
+        if self._stream_resumes >= MAX_STREAM_RESUMES:
+            logging.error("Stream failed {0} times in a row, not resuming it: {1}".format(
+                self._stream_resumes, stream.error))
+            self.failed_stream = stream
+            return
+        if spectrometer.resume_streaming():
+            self._stream_resumes += 1
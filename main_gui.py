@@ -7,81 +7,175 @@ matplotlib graph embedded into a tk.Frame to display the data and psoc_spectrome
 # standard libraries
 from collections import OrderedDict
 import logging
+import queue
+import threading
+import time
 import tkinter as tk
+from tkinter import filedialog
+from tkinter import messagebox
 # installed libraries
 # local files
+import auto_exposure
+import dark_library
 import frameworks
+import hdr
+import hotplug
 import psoc_spectrometer
-import pyplot_embed
+import recording
+import spectrum_buffer  # for type hinting
 
 __author__ = 'Kyle Vitautas Lopin'
 
 
+STARTUP_BUDGET = 0.5  # seconds from start up to the window being shown, a warning is logged if over
+STATUS_POLL_PERIOD = 100  # milliseconds between checks for status messages from the connection thread
+
+
 class SpectrometerGUI(tk.Tk):
     """ Class to display the controls and data of a C12880 spectrometer.  Currently displays the
      last acquired data spectrum.
 
      TODO: add a time course notebook and move the current spectrum to a separate notebook. """
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, device=None):
         """
         Initialize the graphical user interface by:
         1) Start the logging module
-        2) Attach the device using the psoc_spectrometer call.
-        3) Make the graph area using pyplot_embed that will display the intensity versus wavelength data.
-        4) Make a frame that contains all the buttons used to control the device.
-        5) Make a frame to display the status
+        2) Make a frame to display the status, and show the window
+        3) Attach the device using the psoc_spectrometer call on a separate thread, as looking
+        for it can take seconds.
+        4) Make the graph area using pyplot_embed that will display the intensity versus wavelength
+        data, matplotlib is only imported once the window is up.
+        5) Make a frame that contains all the buttons used to control the device, once the device
+        and graph are ready.
+
+        The seconds each step finished at are put in startup_times.
 
         :param parent:  any parent program that could call this GUI
+        :param device:  pyUSB like device to use instead of looking for one, i.e. a
+        device_simulator.SimulatedPSoC
         """
+        self.start_time = time.perf_counter()
+        self.startup_times = OrderedDict()
         tk.Tk.__init__(self, parent)
         logging.basicConfig(format='%(asctime)s %(module)s %(lineno)d: %(levelname)s %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
 
         # make the main frame with the graph and button area
-        main_frame = tk.Frame(self)
-        main_frame.pack(side='top', fill=tk.BOTH, expand=1)
+        self.main_frame = tk.Frame(self)
+        self.main_frame.pack(side='top', fill=tk.BOTH, expand=1)
 
-        # attach the actual device and make an easier to use alias for the
-        # self.device = psoc_spectrometer.C12880(self)
-        self.device = psoc_spectrometer.PSoC(self)
+        self.recording = None  # type: recording.TimeCourseRecording
+        self.device = None  # type: psoc_spectrometer.PSoC, set when the connection thread is done
+        self.graph = None  # type: pyplot_embed.SpectroPlotter
+        self.buttons_frame = None  # type: ButtonFrame
+        self.monitor = None  # type: hotplug.DeviceMonitor
 
+        # make the status frame with the connection status information
+        self.status_frame = StatusFrame(self)
+        self.status_frame.pack(side='top', fill=tk.X)
+
+        # attach the actual device
+        self.given_device = device
+        self.connector = None  # type: DeviceConnector
+        self.connect()
+        self.after_idle(self.make_graph)
+
+    def connect(self):
+        """ Start looking for the device on a separate thread """
+        self.connector = DeviceConnector(self, self.given_device, self.status_frame.post_status,
+                                         self.status_frame.post_device, self.status_frame.post_failure)
+        self.connector.start()
+
+    def mark_startup(self, step: str):
+        """ Save the time a startup step finished, in seconds since the GUI was started """
+        self.startup_times[step] = time.perf_counter() - self.start_time
+        logging.info("startup: {0} after {1:.3f} s".format(step, self.startup_times[step]))
+
+    def make_graph(self):
+        """ Make the graph once the window is shown, importing matplotlib takes a while """
+        self.mark_startup("window shown")
+        if self.startup_times["window shown"] > STARTUP_BUDGET:
+            logging.warning("Window took {0:.2f} s to show, the budget is {1} s".format(
+                self.startup_times["window shown"], STARTUP_BUDGET))
+        import pyplot_embed
         # make the graph frame, the parent class is a tk.Frame
-        self.graph = pyplot_embed.SpectroPlotter(main_frame, None)
+        self.graph = pyplot_embed.SpectroPlotter(self.main_frame, None)
         self.graph.pack(side='left', fill=tk.BOTH, expand=True)
-
-        # make command buttons
-        self.buttons_frame = ButtonFrame(main_frame, self.graph, self.device)
+        self.mark_startup("graph made")
+        self.make_controls()
+
+    def connected(self, device: psoc_spectrometer.PSoC):
+        """ Called on the tk thread when the connection thread has made the PSoC """
+        self.device = device
+        self.mark_startup("device connected")
+        # reconnect the device if it is unplugged, and tell the user about it
+        self.monitor = hotplug.DeviceMonitor(device, status_callback=lambda status:
+                                             self.status_frame.post_status("Spectrometer " + status))
+        self.monitor.start()
+        self.make_controls()
+
+    def make_controls(self):
+        """ Make the command buttons, they need both the graph and the device """
+        if self.buttons_frame or not self.graph or not self.device:
+            return
+        self.graph.data.dark_library = dark_library.DarkLibrary(self.device.serial or 'default')
+        self.buttons_frame = ButtonFrame(self.main_frame, self.graph, self.device)
         self.buttons_frame.pack(side='left', padx=2, expand=True, fill=tk.Y)
+        self.mark_startup("ready")
 
-        # make the status frame with the connect button and status information
-        self.status_frame = StatusFrame(self, self.device)
-        self.status_frame.pack(side='top', fill=tk.X)
-
-    def update_graph(self, data: list, num_data_reads: int):
+    def update_graph(self, data, num_data_reads: int, integration_time=None):
         """
         Allow user to call the master class to update the graph for any widget that does not
         have direct access to the graph
 
         :param data:  data to display on y-axis of graph
+        :param num_data_reads:  number of reads the data is the sum of
+        :param integration_time:  integration time of the data in microseconds
         """
         logging.debug("updating graph")
-        self.graph.update_data(data, num_data_reads)
+        self.graph.update_data(data, num_data_reads, integration_time)
+        if self.recording:
+            self.recording.append(data, time.time(), integration_time or 0, num_data_reads,
+                                  self.device.light_state())
+
+    def show_error(self, message: str):
+        messagebox.showerror("Error", message)
 
-    def set_background_values(self, data: list):
+    def toggle_recording(self) -> bool:
+        """ Start saving every spectrum to a time course recording, or stop if one is running
+
+        :return: True if a recording was started
+        """
+        if self.recording:
+            self.recording.close()
+            self.recording = None
+            return False
+        directory = filedialog.askdirectory(title="Folder to save the recording in")
+        if not directory:
+            return False
+        self.recording = recording.TimeCourseRecording(directory)
+        return True
+
+    def set_background_values(self, data):
         logging.debug('setting background data values')
-        # self.graph.data.background_data = [x/10. for x in data]
-        self.graph.data.background_count = int(sum(data) / len(data) / 10.0)  # PSoC uses to 10 runs to calculate background
-        logging.debug('set background data value: {0}'.format(self.graph.data.background_count))
+        spectrometer = self.device.spectrometer
+        num_reads = psoc_spectrometer.BACKGROUND_NUM_READS
+        self.graph.data.set_dark_spectrum(data, num_reads, spectrometer.integration_time)
+        self.graph.data.dark_library.add(spectrometer.integration_time, data, num_reads,
+                                         spectrometer.st_clock_divider)
+        self.graph.data.dark_library.save()
+        logging.debug('set background data mean: {0}'.format(self.graph.data.dark_spectrum.mean()))
 
 
 BUTTON_PADY = 7
+STREAM_DISPLAY_PERIOD = 50  # milliseconds between graph updates while streaming
 
 
 class ButtonFrame(tk.Frame):
     """ Frame to contain all the buttons the user can use to control the settings and use of the device """
 
-    def __init__(self, parent: tk.Frame, graph: pyplot_embed.SpectroPlotter, device):
+    def __init__(self, parent: tk.Frame, graph: 'pyplot_embed.SpectroPlotter', device):
         """
         Class to make all the buttons needed to control a C12880 spectrometer that is controlled by a PSoC.
 
@@ -113,6 +207,9 @@ class ButtonFrame(tk.Frame):
             tk.Radiobutton(unit_frame, text=key, variable=self.integration_time_unit, value=value).pack(side=tk.LEFT)
         unit_frame.pack(side=tk.TOP)
         self.integration_time_unit.set(1000)
+        self.auto_exposure_button = tk.Button(integration_frame, text="Auto Exposure",
+                                              command=self.auto_expose)
+        self.auto_exposure_button.pack(side=tk.TOP, pady=BUTTON_PADY)
 
         tk.Label(integration_frame, text="Number of samples to average").pack(side=tk.TOP, pady=BUTTON_PADY)
         self.num_reads_to_average = tk.IntVar()
@@ -125,10 +222,10 @@ class ButtonFrame(tk.Frame):
         #                text="Normalize to integration time",
         #                variable=normalized_flag).pack(side=tk.TOP)
         #
-        # self.subtraction_flag = tk.IntVar()
-        # tk.Checkbutton(integration_frame, text="Subtract background",
-        #                variable=self.subtraction_flag,
-        #                command=self.set_background).pack(side=tk.TOP, fill=tk.X)
+        self.subtraction_flag = tk.IntVar()
+        tk.Checkbutton(integration_frame, text="Subtract background",
+                       variable=self.subtraction_flag,
+                       command=self.set_background).pack(side=tk.TOP, fill=tk.X)
 
         integration_frame.pack(side='top', expand=True, fill=tk.X)
 
@@ -177,11 +274,25 @@ class ButtonFrame(tk.Frame):
         self.read_button = tk.Button(self, text="Read", command=self.read_once)
         self.read_button.pack(side="top", expand=True)
 
+        # make the button to read continuously
+        self.stream_buffer = None  # type: spectrum_buffer.SpectrumRingBuffer
+        self.last_displayed_sequence = -1
+        self.hdr_button = tk.Button(self, text="HDR Read", command=self.read_hdr)
+        self.hdr_button.pack(side="top", expand=True)
+
+        self.stream_button = tk.Button(self, text="Stream", command=self.toggle_stream)
+        self.stream_button.pack(side="top", expand=True)
+
+        self.last_recorded_sequence = -1
+        self.record_button = tk.Button(self, text="Record", command=self.toggle_recording)
+        self.record_button.pack(side="top", expand=True)
+
         # self.flush_button = tk.Button(self, text="flush", command=self.device.usb.flush)
         # self.flush_button.pack(side="top", pady=BUTTON_PADY)
 
         # button to save the data, this will open a toplevel with the data printed out, and an option to save to file
         tk.Button(self, text="Save Data", command=self.save_data).pack(side="top", expand=True)
+        tk.Button(self, text="Export Recording", command=self.export_recording).pack(side="top", expand=True)
 
         tk.Button(self, text="Log Error", command=self.debug_comment).pack(side="top", pady=BUTTON_PADY)
 
@@ -196,15 +307,137 @@ class ButtonFrame(tk.Frame):
         logging.info("Read message: {0}".format(read_message))
         self.read_button.config(state=tk.ACTIVE)
 
+    def read_hdr(self):
+        """ Read a bracket of integration times, from the one set down, and show them merged
+        into one high dynamic range spectrum in counts per second """
+        if self.stream_buffer is not None:
+            self.winfo_toplevel().show_error("Stop the stream to make an HDR read")
+            return
+        spectrometer = self.device.spectrometer
+        longest_time = self.integration_time_var.get() * self.integration_time_unit.get()
+        self.hdr_button.config(state=tk.DISABLED)
+        try:
+            if self.graph.data.has_dark_spectrum:
+                dark = self.graph.data.dark_spectrum
+            else:  # the offset of each pixel is close to a read at the shortest integration time
+                dark = spectrometer.read_counts(psoc_spectrometer.MIN_INTEGRATION_TIME)
+            bracket = hdr.acquire_bracket(spectrometer, hdr.default_bracket(longest_time),
+                                          self.num_reads_to_average.get())
+        except (IOError, ValueError) as error:
+            logging.error("HDR read failed: {0}".format(error))
+            self.winfo_toplevel().show_error("HDR read failed")
+            return
+        finally:
+            self.hdr_button.config(state=tk.ACTIVE)
+        counts_per_second, saturated = hdr.merge_bracket(bracket.counts, bracket.integration_times,
+                                                         bracket.num_reads, dark)
+        if saturated.any():
+            logging.warning("{0} pixels are saturated at the shortest integration time".format(
+                saturated.sum()))
+        self.graph.update_data(counts_per_second, counts_per_second=True)
+
+    def auto_expose(self):
+        """ Find the integration time that puts the peak near the top of the range and put it
+        in the integration time controls """
+        if self.stream_buffer is not None:
+            self.winfo_toplevel().show_error("Stop the stream to use auto exposure")
+            return
+        self.auto_exposure_button.config(state=tk.DISABLED)
+        start_time = self.integration_time_var.get() * self.integration_time_unit.get()
+        try:
+            result = auto_exposure.find_integration_time(self.device.spectrometer.read_counts,
+                                                         start_time=start_time)
+        except IOError as error:
+            logging.error("Auto exposure failed: {0}".format(error))
+            self.winfo_toplevel().show_error("Auto exposure failed")
+            return
+        finally:
+            self.auto_exposure_button.config(state=tk.ACTIVE)
+        logging.info("Auto exposure: {0} usec, peak {1:.0f} after {2} reads".format(
+            result.integration_time, result.peak, result.steps))
+        # use the smallest unit that fits in the spinbox's range of 1 to 1000
+        for unit in (1, 1000, 1000000):
+            if result.integration_time <= 1000 * unit:
+                break
+        self.integration_time_unit.set(unit)
+        # round down, rounding up could push the peak into saturation
+        self.integration_time_var.set(max(1, int(result.integration_time // unit)))
+        if not result.converged:
+            self.winfo_toplevel().show_error("Auto exposure could not reach the target, peak is "
+                                             "{0:.0f} counts".format(result.peak))
+
+    def toggle_stream(self):
+        if self.stream_buffer is not None:
+            self.device.stop_streaming()
+            self.stream_buffer = None
+            self.stream_button.config(text="Stream", relief=tk.RAISED)
+            self.read_button.config(state=tk.ACTIVE)
+            self.hdr_button.config(state=tk.ACTIVE)
+            self.auto_exposure_button.config(state=tk.ACTIVE)
+            return
+        self.stream_buffer = self.device.start_streaming(self.integration_time_var.get(),
+                                                         self.integration_time_unit.get(),
+                                                         self.num_reads_to_average.get())
+        if self.stream_buffer is not None:
+            self.read_button.config(state=tk.DISABLED)
+            self.hdr_button.config(state=tk.DISABLED)
+            self.auto_exposure_button.config(state=tk.DISABLED)
+            self.stream_button.config(text="Stop stream", relief=tk.SUNKEN)
+            self.last_displayed_sequence = -1
+            self.last_recorded_sequence = -1
+            self.after(STREAM_DISPLAY_PERIOD, self.display_stream)
+
+    def toggle_recording(self):
+        if self.winfo_toplevel().toggle_recording():
+            self.record_button.config(text="Stop recording", relief=tk.SUNKEN)
+        else:
+            self.record_button.config(text="Record", relief=tk.RAISED)
+
+    def display_stream(self):
+        """ Show the newest streamed spectrum, frames that came in between display updates are
+        not shown """
+        if self.stream_buffer is None:
+            return
+        time_course = self.winfo_toplevel().recording
+        if time_course:
+            # save every frame, not just the ones that are displayed
+            batch = self.stream_buffer.get_batch(self.last_recorded_sequence)
+            if len(batch.sequences):
+                time_course.append_batch(batch.counts, batch.timestamps,
+                                       self.device.spectrometer.integration_time,
+                                       batch.num_reads, self.device.light_state())
+                self.last_recorded_sequence = int(batch.sequences[-1])
+        frame = self.stream_buffer.latest()
+        if frame and frame.sequence != self.last_displayed_sequence:
+            self.last_displayed_sequence = frame.sequence
+            # one frame per display period is processed, on this thread, there is not enough
+            # work for a ProcessingPool to pay back copying the frames to it
+            self.graph.update_data(frame.counts, frame.num_reads,
+                                   self.device.spectrometer.integration_time)
+        self.after(STREAM_DISPLAY_PERIOD, self.display_stream)
+
     def read_usb(self):
         print(self.device.usb.usb_read_data(encoding='string'))
 
     def set_background(self):
-        self.read_button.config(state=tk.DISABLED)
-        if not self.graph.data.background_count:
-            self.device.spectrometer.get_background_values()
-        self.read_button.config(state=tk.ACTIVE)
-        self.graph.data.use_background = self.subtraction_flag.get()
+        """ Turn dark spectrum subtraction on or off, a dark spectrum for the integration time
+        is taken from the library or read if there is none """
+        if not self.subtraction_flag.get():
+            self.graph.data.use_background = False
+            return
+        integration_time = self.integration_time_var.get() * self.integration_time_unit.get()
+        dark_spectrum = self.graph.data.dark_library.get(integration_time)
+        if dark_spectrum is not None:
+            self.graph.data.set_dark_spectrum(dark_spectrum, 1, integration_time)
+        elif self.stream_buffer is not None:
+            self.subtraction_flag.set(0)
+            self.winfo_toplevel().show_error("Stop the stream to read a dark spectrum")
+            return
+        else:
+            self.read_button.config(state=tk.DISABLED)
+            self.device.spectrometer.get_background_values(integration_time)
+            self.read_button.config(state=tk.ACTIVE)
+        self.graph.data.use_background = True
 
     def LED_toggle(self):
         # led_power_index = self.LED_power_options.index(self)
@@ -237,6 +470,20 @@ class ButtonFrame(tk.Frame):
         logging.debug("save the data: ")
         self.graph.data.save_data()
 
+    def export_recording(self):
+        """
+        Save all the spectra of the running recording, or of a recording the user picks
+        """
+        time_course = self.winfo_toplevel().recording
+        if time_course:
+            time_course.flush()
+        else:
+            directory = filedialog.askdirectory(title="Recording folder to export")
+            if not directory:
+                return
+            time_course = recording.TimeCourseRecording(directory, mode='r')
+        self.graph.data.save_data(time_course)
+
     def debug_comment(self):
         error_message = GetMessage()
         # print(error_message.get("1.0", 'end-1c'))
@@ -263,18 +510,92 @@ def save_message(message, toplevel):
     toplevel.destroy()
 
 
+class DeviceConnector(threading.Thread):
+    """ Look for and set up the PSoC away from the tk thread, USB discovery, serial port probing
+    and the connection test can take several seconds when no device is attached """
+
+    def __init__(self, master: SpectrometerGUI, device=None, status_callback=None,
+                 done_callback=None, fail_callback=None):
+        """
+        :param master: GUI the PSoC is made for
+        :param device: pyUSB like device to use instead of looking for one
+        :param status_callback: function called with a message of how the connection is going
+        :param done_callback: function called with the PSoC when it is made
+        :param fail_callback: function called with the exception if making the PSoC failed
+        """
+        threading.Thread.__init__(self, name="connect device", daemon=True)
+        self.master = master
+        self.device = device
+        self.status_callback = status_callback or (lambda message: None)
+        self.done_callback = done_callback or (lambda device: None)
+        self.fail_callback = fail_callback or (lambda error: None)
+
+    def run(self):
+        self.status_callback("Looking for the spectrometer")
+        try:
+            device = psoc_spectrometer.PSoC(self.master, device=self.device)
+        except Exception as error:  # i.e. no USB backend or no permission to open the device
+            logging.exception("Could not set up the spectrometer")
+            self.status_callback("Could not connect to the spectrometer: {0}".format(error))
+            self.fail_callback(error)
+            return
+        if device.usb.connected:
+            self.status_callback("Connected to {0} {1}".format(device.usb.spectrometer or "PSoC",
+                                                              device.serial or ""))
+        else:
+            self.status_callback("No spectrometer found")
+        self.done_callback(device)
+
+
 class StatusFrame(tk.Frame):
     """ Frame to display information about the sensors and device attached """
 
-    def __init__(self, parent: tk.Tk, device):  # psoc_spectrometerd.AS7262()):
+    def __init__(self, parent: SpectrometerGUI):
         """
-        Make all the information the user should know about device available to them.
+        Make all the information the user should know about device available to them.  Other
+        threads give the frame messages with post_status, they are shown from the tk thread.
 
-        :param parent:
-        :param device:
+        :param parent: the GUI, it is told when the device is connected
         """
         tk.Frame.__init__(self, parent)
-
+        self.master = parent
+        self.messages = queue.Queue()
+        self.status_var = tk.StringVar(value="Starting")
+        tk.Label(self, textvariable=self.status_var, anchor=tk.W).pack(side='left', fill=tk.X)
+        # shown when the connection failed, to try again
+        self.connect_button = tk.Button(self, text="Connect", command=self.connect)
+        self.after(STATUS_POLL_PERIOD, self.check_messages)
+
+    def connect(self):
+        self.connect_button.pack_forget()
+        self.master.connect()
+
+    def post_status(self, message: str):
+        """ Show a status message, can be called from any thread """
+        self.messages.put(('status', message))
+
+    def post_device(self, device: psoc_spectrometer.PSoC):
+        """ Pass the connected device to the GUI, can be called from any thread """
+        self.messages.put(('device', device))
+
+    def post_failure(self, error: Exception):
+        """ Tell the GUI the device could not be set up, can be called from any thread """
+        self.messages.put(('failed', error))
+
+    def check_messages(self):
+        while True:
+            try:
+                kind, value = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'device':
+                self.master.connected(value)
+            elif kind == 'failed':
+                self.connect_button.pack(side='right')
+            else:
+                logging.info("status: {0}".format(value))
+                self.status_var.set(value)
+        self.after(STATUS_POLL_PERIOD, self.check_messages)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,189 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Run several PSoC spectrometers at once from one program.  Each device streams on its own
+acquisition thread into its own ring buffer, the streams can be started together, and a merge
+thread puts the frames of all the devices into one stream in the order they were taken, with
+each frame tagged by the serial number of the device it came from. """
+
+# standard libraries
+import collections
+import heapq
+import logging
+import queue
+import threading
+# local files
+import psoc_spectrometer
+import usb_comm
+
+__author__ = 'Kyle Vitautas Lopin'
+
+START_TIMEOUT = 5.0  # seconds for all the devices to be ready to start together
+MERGE_WAIT = 0.1  # seconds the merge thread waits for new frames before checking the streams
+
+TaggedFrame = collections.namedtuple('TaggedFrame', ['timestamp', 'serial', 'sequence', 'counts',
+                                                     'num_reads'])
+
+
+def open_all_devices(vendor_id=0x04B4, product_id=0x8051) -> list:
+    """ Connect to every PSoC spectrometer plugged in
+
+    :return: list of the psoc_spectrometer.PSoC that answered correctly
+    """
+    devices = []
+    for usb_device in usb_comm.find_usb_devices(vendor_id, product_id):
+        device = psoc_spectrometer.PSoC(device=usb_device)
+        if device.usb.connected:
+            devices.append(device)
+        else:
+            logging.error("Device {0} did not identify itself".format(device.serial))
+    return devices
+
+
+class MultiSpectrometer(object):
+    """ Stream from several spectrometers into one time ordered stream of TaggedFrames """
+
+    def __init__(self, devices: list):
+        """
+        :param devices: psoc_spectrometer.PSoC of each device
+        """
+        serials = [device.serial for device in devices]
+        if len(set(serials)) != len(serials):
+            raise ValueError("Devices have to have different serial numbers: {0}".format(serials))
+        self.devices = collections.OrderedDict(zip(serials, devices))
+        self.frames = queue.Queue()  # TaggedFrames in time order
+        self.merger = None  # type: FrameMerger
+
+    @property
+    def serials(self) -> list:
+        return list(self.devices.keys())
+
+    @property
+    def running(self) -> bool:
+        return self.merger is not None and self.merger.is_alive()
+
+    def start(self, integration_time: int, num_reads: int = 1, max_frames: int = None,
+              synchronized: bool = True,
+              buffer_size: int = psoc_spectrometer.STREAM_BUFFER_SIZE) -> bool:
+        """ Start all the devices streaming
+
+        :param integration_time: integration time in microseconds
+        :param num_reads: number of reads each PSoC sums for each frame
+        :param max_frames: frames to take from each device, run until stop if None
+        :param synchronized: have every device send its first read trigger at the same time
+        :param buffer_size: frames each device's ring buffer holds
+        :return: True if all the devices started
+        """
+        self.stop()
+        barrier = None
+        if synchronized:
+            barrier = threading.Barrier(len(self.devices), timeout=START_TIMEOUT)
+        new_frame_event = threading.Event()
+        ring_buffers = collections.OrderedDict()
+        for serial, device in self.devices.items():
+            ring_buffer = device.spectrometer.start_streaming(
+                integration_time, num_reads, buffer_size, frame_callback=lambda _: new_frame_event.set(),
+                max_frames=max_frames, start_barrier=barrier)
+            if ring_buffer is None:
+                logging.error("Device {0} could not start streaming".format(serial))
+                if barrier:
+                    barrier.abort()
+                self.stop()
+                return False
+            ring_buffers[serial] = ring_buffer
+        streams = {serial: device.spectrometer.stream for serial, device in self.devices.items()}
+        self.merger = FrameMerger(ring_buffers, streams, self.frames, new_frame_event)
+        self.merger.start()
+        return True
+
+    def stop(self):
+        for device in self.devices.values():
+            device.spectrometer.stop_streaming()
+        if self.merger:
+            self.merger.join()
+            self.merger = None
+
+    def get(self, timeout: float = None) -> TaggedFrame:
+        """ Get the next frame of the merged stream
+
+        :return: TaggedFrame, or None if none came in time or the streams are all done
+        """
+        try:
+            return self.frames.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def __iter__(self):
+        """ Go through the merged frames until every stream is done """
+        while True:
+            frame = self.get(MERGE_WAIT)
+            if frame is not None:
+                yield frame
+            elif not self.running and self.frames.empty():
+                return
+
+    def close(self):
+        self.stop()
+        for device in self.devices.values():
+            for light_source in device.light_sources:
+                light_source.turn_on(False)
+
+
+class FrameMerger(threading.Thread):
+    """ Merge the frames of several ring buffers in timestamp order.  A frame is only passed on
+    once every stream that is still running has a frame at least as new, so a frame of a slower
+    device can not come after a newer one of a faster device. """
+
+    def __init__(self, ring_buffers: dict, streams: dict, output: queue.Queue,
+                 new_frame_event: threading.Event):
+        """
+        :param ring_buffers: serial: SpectrumRingBuffer of each device
+        :param streams: serial: StreamingAcquisition filling each ring buffer
+        :param output: queue the TaggedFrames are put in
+        :param new_frame_event: event the streams set when they add a frame
+        """
+        threading.Thread.__init__(self, name="Frame merger", daemon=True)
+        self.ring_buffers = ring_buffers
+        self.streams = streams
+        self.output = output
+        self.new_frame_event = new_frame_event
+        self.last_sequences = {serial: -1 for serial in ring_buffers}
+        self.newest_times = {serial: None for serial in ring_buffers}
+        self.frames_lost = 0
+        self._heap = []
+
+    def run(self):
+        while True:
+            self.new_frame_event.wait(MERGE_WAIT)
+            self.new_frame_event.clear()
+            # check if the streams are done before collecting, so no frame added after is missed
+            finished = {serial for serial, stream in self.streams.items() if not stream.is_alive()}
+            for serial, ring_buffer in self.ring_buffers.items():
+                self._collect(serial, ring_buffer)
+            self._emit(finished)
+            if len(finished) == len(self.streams):
+                break
+        logging.debug("Frame merger finished")
+
+    def _collect(self, serial: str, ring_buffer):
+        last_sequence = self.last_sequences[serial]
+        if ring_buffer.next_sequence <= last_sequence + 1:
+            return
+        batch = ring_buffer.get_batch(last_sequence)
+        if batch.sequences[0] != last_sequence + 1:
+            lost = int(batch.sequences[0]) - last_sequence - 1
+            logging.warning("Merge fell behind, lost {0} spectra of {1}".format(lost, serial))
+            self.frames_lost += lost
+        for i, sequence in enumerate(batch.sequences):
+            heapq.heappush(self._heap, (float(batch.timestamps[i]), serial, int(sequence),
+                                        batch.counts[i], int(batch.num_reads[i])))
+        self.last_sequences[serial] = int(batch.sequences[-1])
+        self.newest_times[serial] = float(batch.timestamps[-1])
+
+    def _emit(self, finished: set):
+        running_times = [timestamp for serial, timestamp in self.newest_times.items()
+                         if serial not in finished]
+        if None in running_times:
+            return  # a running stream has not given a frame yet
+        watermark = min(running_times) if running_times else float('inf')
+        while self._heap and self._heap[0][0] <= watermark:
+            self.output.put(TaggedFrame(*heapq.heappop(self._heap)))
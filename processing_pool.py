@@ -0,0 +1,198 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Process spectra on a pool of worker processes so expensive per frame work does not hold the
+GIL the acquisition and display threads need.  The frames are copied into slots of a shared
+memory block instead of being pickled, each worker writes its result into the matching slot of
+an output block, and the results are handed back in the order the frames were submitted.
+
+    with ProcessingPool(correct_and_smooth, {'dark': dark_spectrum, 'window': 5}) as pool:
+        for result in pool.map(frames):
+            plot(result.data)
+
+The processing function has to be defined at the top level of a module so the workers can
+import it, and is called as function(counts, out, num_reads, integration_time, **options).
+
+The pool is for saving every frame of a stream, as the command line acquisition does.  The GUI
+only processes the newest frame each display period, and its dark spectrum changes while it
+runs, so it keeps processing on the Tk thread.
+"""
+
+# standard libraries
+import collections
+import functools
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import queue
+import threading
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+NUM_PIXELS = 288
+SLOTS_PER_WORKER = 4  # frames that can be in the pool for each worker
+
+ProcessedFrame = collections.namedtuple('ProcessedFrame', ['sequence', 'data', 'num_reads',
+                                                           'integration_time'])
+
+
+def correct_and_smooth(counts, out, num_reads=1, integration_time=None, dark=None, window=1,
+                       counts_per_second=False):
+    """ Average the reads, subtract a dark spectrum, normalize to counts per second and smooth
+    with a moving average, the same steps as SpectrometerData.process plus the smoothing
+
+    :param counts: summed counts of a frame
+    :param out: array to put the result in
+    :param num_reads: number of reads the counts are the sum of
+    :param integration_time: microseconds, used if counts_per_second is set
+    :param dark: dark spectrum to subtract, in counts per read
+    :param window: number of pixels in the moving average, 1 to not smooth
+    :param counts_per_second: divide by the integration time
+    """
+    np.divide(counts, num_reads, out=out)
+    if dark is not None:
+        np.subtract(out, dark, out=out)
+    if counts_per_second and integration_time:
+        np.multiply(out, 1000000. / integration_time, out=out)
+    if window > 1:
+        # reflect the spectrum past its ends so the edge pixels are not averaged with zeros
+        half = window // 2
+        padded = np.pad(out, (half, window - 1 - half), mode='reflect')
+        out[:] = np.convolve(padded, np.full(window, 1. / window), mode='valid')
+
+
+# state of each worker process, set by _init_worker
+_worker = {}
+
+
+def _init_worker(input_name: str, output_name: str, shape: tuple, function, options: dict):
+    _worker['input_memory'] = shared_memory.SharedMemory(name=input_name)
+    _worker['output_memory'] = shared_memory.SharedMemory(name=output_name)
+    _worker['inputs'] = np.ndarray(shape, dtype=np.float64, buffer=_worker['input_memory'].buf)
+    _worker['outputs'] = np.ndarray(shape, dtype=np.float64, buffer=_worker['output_memory'].buf)
+    _worker['function'] = function
+    _worker['options'] = options
+
+
+def _process_slot(slot: int, num_reads, integration_time):
+    _worker['function'](_worker['inputs'][slot], _worker['outputs'][slot], num_reads,
+                        integration_time, **_worker['options'])
+
+
+class ProcessingPool(object):
+    """ Pool of worker processes that run a function on each frame and give the results back in
+    order """
+
+    def __init__(self, function=correct_and_smooth, options: dict = None, num_workers: int = None,
+                 num_slots: int = None, num_pixels: int = NUM_PIXELS):
+        """
+        :param function: processing function, see the module docstring
+        :param options: keyword arguments passed to the function for every frame, i.e. the dark
+        spectrum, they are sent to each worker once
+        :param num_workers: number of worker processes, the number of cores if None
+        :param num_slots: frames that can be submitted but not taken back yet, submit waits
+        for a slot when they are all used
+        :param num_pixels: number of pixels in a frame
+        """
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.num_slots = num_slots or SLOTS_PER_WORKER * self.num_workers
+        shape = (self.num_slots, num_pixels)
+        frame_bytes = num_pixels * np.dtype(np.float64).itemsize
+        self._input_memory = shared_memory.SharedMemory(create=True, size=self.num_slots * frame_bytes)
+        self._output_memory = shared_memory.SharedMemory(create=True, size=self.num_slots * frame_bytes)
+        self.inputs = np.ndarray(shape, dtype=np.float64, buffer=self._input_memory.buf)
+        self.outputs = np.ndarray(shape, dtype=np.float64, buffer=self._output_memory.buf)
+        self._free_slots = queue.Queue()
+        for slot in range(self.num_slots):
+            self._free_slots.put(slot)
+
+        self._next_sequence = 0  # given to the next frame submitted
+        self._next_result = 0  # sequence of the next result to give back
+        self._finished = {}  # sequence: (slot, num_reads, integration_time, error)
+        self._condition = threading.Condition()
+        self._pool = multiprocessing.Pool(self.num_workers, initializer=_init_worker,
+                                          initargs=(self._input_memory.name, self._output_memory.name,
+                                                    shape, function, options or {}))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def pending(self) -> int:
+        """ Number of frames submitted that have not been taken back """
+        return self._next_sequence - self._next_result
+
+    def submit(self, counts, num_reads=1, integration_time=None, timeout: float = None) -> int:
+        """ Copy a frame into shared memory and start processing it
+
+        :param counts: counts of the frame
+        :param timeout: seconds to wait for a free slot, forever if None
+        :return: sequence number of the frame, results are given back in this order
+        :raise queue.Full: if no slot was free in time
+        """
+        try:
+            slot = self._free_slots.get(timeout=timeout)
+        except queue.Empty:
+            raise queue.Full("All {0} processing slots are in use".format(self.num_slots))
+        self.inputs[slot] = counts
+        with self._condition:
+            sequence = self._next_sequence
+            self._next_sequence += 1
+        done = functools.partial(self._done, sequence, slot, num_reads, integration_time)
+        self._pool.apply_async(_process_slot, (slot, num_reads, integration_time),
+                               callback=done, error_callback=done)
+        return sequence
+
+    def _done(self, sequence, slot, num_reads, integration_time, error=None):
+        """ Called on the pool's result thread when a frame is processed """
+        with self._condition:
+            self._finished[sequence] = (slot, num_reads, integration_time, error)
+            self._condition.notify_all()
+
+    def get(self, timeout: float = None) -> ProcessedFrame:
+        """ Take back the oldest frame submitted once it is processed
+
+        :param timeout: seconds to wait for it, forever if None
+        :return: ProcessedFrame with a copy of the result, or None if nothing is pending or it
+        was not done in time
+        :raise: the error of the processing function if it failed on the frame
+        """
+        with self._condition:
+            if not self.pending:
+                return None
+            sequence = self._next_result
+            if not self._condition.wait_for(lambda: sequence in self._finished, timeout):
+                return None
+            slot, num_reads, integration_time, error = self._finished.pop(sequence)
+            self._next_result += 1
+        try:
+            if error is not None:
+                raise error
+            return ProcessedFrame(sequence, self.outputs[slot].copy(), num_reads, integration_time)
+        finally:
+            self._free_slots.put(slot)
+
+    def map(self, frames, num_reads=1, integration_time=None):
+        """ Process an iterable of frames, keeping the pool busy, and yield the results in order
+
+        :param frames: iterable of counts arrays
+        """
+        for counts in frames:
+            if self._free_slots.empty():
+                yield self.get()
+            self.submit(counts, num_reads, integration_time)
+        while self.pending:
+            yield self.get()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        # the numpy views have to go before the shared memory can be closed
+        self.inputs = self.outputs = None
+        for memory in (self._input_memory, self._output_memory):
+            memory.close()
+            memory.unlink()
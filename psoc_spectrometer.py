@@ -3,18 +3,17 @@
 """ Classes to represent different color spectrometers, implimented so here: C12880"""
 
 # standard libraries
-import json
 import logging
-import os
 import queue
 import struct
 import threading
 import time
-import tkinter as tk
-from tkinter import messagebox
-
+# installed libraries
+import numpy as np
 # local files
-import main_gui  # for type hinting
+import readiness
+import spectrum_buffer
+import state_log
 import usb_comm
 # import usb_arduino_hack as usb_comm
 
@@ -24,6 +23,15 @@ __author__ = 'Kyle Vitautas Lopin'
 C12880_CLK_SPEED = 500000.
 C12880_CLK_PERIOD = 1. / C12880_CLK_SPEED
 MAX_NUM_READS = 25
+BACKGROUND_NUM_READS = 10  # reads the PSoC sums for C12880|BACKGROUND
+MIN_INTEGRATION_TIME = 108  # microseconds
+MAX_INTEGRATION_TIME = 16250000
+
+# messages the PSoC answers C12880|QUERY_RUN with, all are 9 characters long
+QUERY_NOT_DONE = "NOT DONE "
+QUERY_NO_DATA = "NO DATA  "
+QUERY_TIMEOUT_PADDING = 1.0  # seconds past twice the expected read time to give up waiting for data
+STREAM_BUFFER_SIZE = 256  # number of spectra kept while streaming
 
 # LED_POWER_OPTIONS = ["100 mA", "50 mA", "25 mA", "12.5 mA", "6.25 mA", "3.1 mA"]
 values = [100/2**x for x in range(0, 6)]
@@ -33,9 +41,54 @@ values.reverse()
 LED_POWER_OPTIONS = ["{:.0f} mA".format(x) for x in values]
 
 
+def st_clock_divider(integration_time) -> int:
+    """ Get the divider of the ST clock to use for an integration time, longer integration times
+    need a slower clock so the PWM period fits in its 16 bit counter
+
+    :param integration_time: integration time in microseconds
+    :return: clock divider, or None if the integration time is out of bounds
+    """
+    if integration_time < MIN_INTEGRATION_TIME or integration_time > MAX_INTEGRATION_TIME:
+        return None
+    elif integration_time < 60000:
+        return 48  # use lowest setting
+    elif integration_time < 260000:
+        return 96  # 4 usec period
+    elif integration_time < 3000000:
+        return 1200
+    return 6000
+
+
+def pwm_compare(integration_time, clock_divider, clock_period=24):
+    """ Get the ST pin PWM compare value for an integration time """
+    clock_period = clock_divider / clock_period  # microseconds clock period
+    return int(integration_time / clock_period) - 48  # 48 because the C12880 integration time is
+    # ST pin high plus 48 cycles, no extra 1 because PWM is set for less not less than or equal
+
+
+def integration_settings(integration_time, clock_period=24):
+    """ Get the ST clock divider and PWM compare value the PSoC needs for an integration time
+
+    :param integration_time: integration time in microseconds
+    :param clock_period: clock cycles per microsecond before the divider
+    :return: (clock divider, pwm compare) or None if the integration time is out of bounds
+    """
+    divider = st_clock_divider(integration_time)
+    if divider is None:
+        return None
+    return divider, pwm_compare(integration_time, divider, clock_period)
+
+
 class PSoC(object):
-    def __init__(self, master: main_gui.SpectrometerGUI):
-        self.communication = USB()
+    def __init__(self, master: 'main_gui.SpectrometerGUI' = None, device=None):
+        """
+        :param master: object that gets the data of single reads through update_graph and
+        set_background_values and is shown errors with show_error, i.e. the GUI.  None to use
+        the device without a GUI.
+        :param device: pyUSB like device to use instead of finding one, i.e. a
+        device_simulator.SimulatedPSoC
+        """
+        self.communication = USB(device)
         self.usb = self.communication.usb  # alias to make it easier to write to
 
         self.spectrometer = C12880(master, self.usb)
@@ -43,8 +96,49 @@ class PSoC(object):
                               CAT4004(self.usb, "Laser", max_power=100),
                               PWMDimmer(self.usb, "Light 1", max_power=100, pwm_period=32, pwm_compare=32)]
 
+    @property
+    def serial(self) -> str:
+        """ USB serial number of the PSoC """
+        return self.usb.serial
+
     def read_once(self, integration_time, integration_unit, num_reads):
-        self.spectrometer.read_once(integration_time, integration_unit, num_reads)
+        return self.spectrometer.read_once(integration_time, integration_unit, num_reads)
+
+    def start_streaming(self, integration_time, integration_unit, num_reads, frame_callback=None):
+        return self.spectrometer.start_streaming(integration_time * integration_unit, num_reads,
+                                                 frame_callback=frame_callback)
+
+    def stop_streaming(self):
+        self.spectrometer.stop_streaming()
+
+    def start_state_log(self, sample_every: int = state_log.SAMPLE_EVERY,
+                        filename: str = state_log.LOG_FILE) -> state_log.StateLogger:
+        """ Log the C12880 state registers after every sample_every frames, for debugging """
+        self.stop_state_log()
+        self.spectrometer.state_logger = state_log.StateLogger(filename, sample_every)
+        return self.spectrometer.state_logger
+
+    def stop_state_log(self):
+        if self.spectrometer.state_logger:
+            self.spectrometer.state_logger.close()
+            self.spectrometer.state_logger = None
+
+    def restore_settings(self):
+        """ Write the integration time and the light sources' power, flash and on states again,
+        i.e. after the device was reconnected and started up with its default settings """
+        self.usb.forget_settings()
+        with self.usb.batch():
+            self.spectrometer.set_integration_time(self.spectrometer.integration_time)
+            for light_source in self.light_sources:
+                light_source.restore_state()
+
+    def light_state(self) -> int:
+        """ Get bit flags of which light sources are on, bit 0 is the first light source """
+        state = 0
+        for i, light_source in enumerate(self.light_sources):
+            if light_source.on:
+                state |= 1 << i
+        return state
 
     def send_read_message(self, integration_time_set):
         logging.info("reading with integration time: {0}".format(integration_time_set))
@@ -55,7 +149,7 @@ class PSoC(object):
 class USB(object):
     """ But the basic info all the Base PSoC Base color sensors / spectrometers should use """
 
-    def __init__(self):
+    def __init__(self, device=None):
         self.OUT_ENDPOINT = 2
         self.DATA_IN_ENDPOINT = 1
         self.USB_INFO_BYTE_SIZE = 48
@@ -68,7 +162,7 @@ class USB(object):
         self.termination_flag = False  # flag to set when streaming data should be stopped
 
         self.usb = usb_comm.PSoC_USB(self, self.data_queue, self.data_acquired_event,
-                                     self.termination_flag)
+                                     self.termination_flag, device=device)
         # self.usb = usb_comm.PSoC_USB(self)
 
 
@@ -93,10 +187,16 @@ class BaseSpectrometer(object):
 
 
 class C12880(object):
-    def __init__(self, master: main_gui.SpectrometerGUI, usb: USB):
+    def __init__(self, master: 'main_gui.SpectrometerGUI', usb: usb_comm.PSoC_USB):
         # BaseSpectrometer.__init__(self)
         self.master = master
         self.reading = None
+        self.stream = None  # type: StreamingAcquisition
+        # held while the stream is checked and replaced, so a hot-plug resume can not start a
+        # stream that is being stopped
+        self._stream_lock = threading.RLock()
+        self.readiness = readiness.ReadinessPredictor()
+        self.state_logger = None  # type: state_log.StateLogger, samples the sensor state if set
 
         self.usb = usb
 
@@ -111,40 +211,39 @@ class C12880(object):
         self.set_integration_time(self.integration_time)
         # self.get_background_values()
 
-    def get_background_values(self):
-        self.read_once(40, 1000, 10, True)
+    def get_background_values(self, integration_time=None):
+        """ Read a dark spectrum and give it to the master's set_background_values
+
+        :param integration_time: integration time in microseconds, the one set if None
+        """
+        self.read_once(integration_time or self.integration_time, 1, BACKGROUND_NUM_READS, True)
+
+    def show_error(self, message):
+        """ Show an error to the user if there is a GUI """
+        if hasattr(self.master, 'show_error'):
+            self.master.show_error(message)
 
     def set_integration_time(self, time):
-        if time < 108:
-            logging.error("Integration time out of bounds: {0}".format(time))
-            messagebox.showerror("Error", "Integration time too low")
-            return False
-        elif time > 16250000:
+        settings = integration_settings(time, self.st_clock_period)
+        if settings is None:
             logging.error("Integration time out of bounds: {0}".format(time))
-            messagebox.showerror("Error", "Integration time is too high")
+            if time < MIN_INTEGRATION_TIME:
+                self.show_error("Integration time too low")
+            else:
+                self.show_error("Integration time is too high")
             return False
-        elif time < 60000:
-            self.st_clock_divider = 48  # use lowest setting
-        elif time < 260000:
-            self.st_clock_divider = 96  # 4 usec period
-        elif time < 3000000:
-            self.st_clock_divider = 1200  # use lowest setting
-        elif time < 16000000:
-            self.st_clock_divider = 6000  # use lowest setting
-
+        self.st_clock_divider, self.st_pwm_compare = settings
         self.integration_time = time
-        self.st_pwm_compare = self.calculate_pwm_compare()
 
-        self.usb.usb_write("C12880|ST_DIVIDER|{0}".format(str(self.st_clock_divider).zfill(5)))
-        self.usb.usb_write("C12880|ST_PERIOD|{0}".format(str(self.st_pwm_compare).zfill(5)))
+        with self.usb.batch():
+            self.usb.write_setting("C12880|ST_DIVIDER|{0}".format(str(self.st_clock_divider).zfill(5)))
+            self.usb.write_setting("C12880|ST_PERIOD|{0}".format(str(self.st_pwm_compare).zfill(5)))
 
         # self.usb.usb_write("C12880|INTEGRATION|{0}".format(str(time).zfill(3)))
         return True
 
     def calculate_pwm_compare(self):
-        clock_period = self.st_clock_divider / self.st_clock_period  # microseconds clock period
-        return int(self.integration_time / clock_period) - 48  # 48 because the C12880 integration time is
-        # ST pin high plus 48 cycles, no extra 1 because PWM is set for less not less than or equal
+        return pwm_compare(self.integration_time, self.st_clock_divider, self.st_clock_period)
 
     def read_once(self, integration_time_set, integration_time_unit, num_reads, background=False):
 
@@ -159,18 +258,15 @@ class C12880(object):
             return
 
         try:
-            logging.debug("sleeping for {0} seconds".format(num_reads * (integration_time/1000000.+0.1)))
-            time.sleep(num_reads * (integration_time/1000000.+0.4))  # TODO: make this an after function somehow
-
-            query_message = self.query_data_readiness()
+            query_message = self.wait_for_data(num_reads)
             logging.info("query message: {0}".format(query_message))
         except Exception as expection:
             logging.error(expection)
             return "Failed getting query message"
 
-        if query_message == "NOT DONE ":
+        if query_message == QUERY_NOT_DONE:
             return "Data still being read"
-        elif query_message == "NO DATA  ":
+        elif query_message == QUERY_NO_DATA:
             return "Error with the C12880 device"
         elif not query_message:
             return "No message received"
@@ -184,21 +280,43 @@ class C12880(object):
                 logging.info("read {0} times".format(num_reads))
                 data = self.usb.read_multi_data()
 
-            if background:
+            if background and self.master:
                 self.master.set_background_values(data)
 
-            if data:
-                self.master.update_graph(data, num_reads)
+            if data and self.master:
+                self.master.update_graph(data, num_reads, self.integration_time)
         except:
             return "Problem getting data"
 
-        try:
-            self.get_C12880_state()
-        except Exception as exception2:
-            logging.error(exception2)
-            return "Error getting C12880 state"
+        if self.state_logger:
+            self.state_logger.frame_done(self)
         return "Successful read"
 
+    def read_counts(self, integration_time, num_reads=1, background=False):
+        """ Make a read without passing it on to the master
+
+        :param integration_time: integration time in microseconds
+        :param num_reads: number of reads the PSoC sums
+        :param background: read a dark spectrum, the PSoC always sums BACKGROUND_NUM_READS
+        reads for it
+        :return: copy of the counts, the sum of num_reads reads
+        :raise IOError: if the read failed
+        """
+        if background:
+            num_reads = BACKGROUND_NUM_READS
+        if not self.send_read_message(integration_time, num_reads, background):
+            raise IOError("Could not start a read of {0} usec".format(integration_time))
+        query_message = self.wait_for_data(num_reads)
+        if query_message in (QUERY_NOT_DONE, QUERY_NO_DATA) or not query_message:
+            raise IOError("Bad data query message: {0}".format(query_message))
+        if num_reads == 1:
+            data = self.usb.read_single_data()
+        else:
+            data = self.usb.read_multi_data()
+        if data is None:
+            raise IOError("Failed reading data")
+        return np.array(data)
+
     def send_read_message(self, integration_time_set, num_reads, is_background_measurement=False):
         logging.info("reading with integration time: {0}".format(integration_time_set))
         integration_set = True  # assume it has been set previously
@@ -210,24 +328,133 @@ class C12880(object):
             return True
 
         if integration_set:
-            if num_reads == 1:
-                self.usb.usb_write("C12880|READ_SINGLE".format())
-            elif 1 < num_reads <= MAX_NUM_READS:
-                self.usb.usb_write("C12880|READ_MULTI|{0}".format(str(num_reads).zfill(3)))
-            else:
+            read_command = self.get_read_command(num_reads)
+            if not read_command:
                 return False
-
+            self.usb.usb_write(read_command)
             return True
         return False
 
+    @staticmethod
+    def get_read_command(num_reads):
+        """ Make the command that starts a read of the C12880
+
+        :param num_reads: number of reads the PSoC should sum together
+        :return: command string, or None if num_reads is out of range
+        """
+        if num_reads == 1:
+            return "C12880|READ_SINGLE"
+        elif 1 < num_reads <= MAX_NUM_READS:
+            return "C12880|READ_MULTI|{0}".format(str(num_reads).zfill(3))
+        return None
+
     def query_data_readiness(self):
-        self.usb.usb_write("C12880|QUERY_RUN")
-        return self.usb.usb_read_data(num_usb_bytes=9, encoding="string")  # Query message is 9 chars long
+        with self.usb.lock:
+            self.usb.usb_write("C12880|QUERY_RUN")
+            message = self.usb.usb_read_data(num_usb_bytes=9, encoding="string")  # Query message is 9 chars long
+        if message:
+            return message.decode('ascii', 'replace')
+        return message
+
+    def wait_for_data(self, num_reads, trigger_time=None):
+        """ Wait for the PSoC to finish a read.  Sleep until just before the read is predicted
+        to be done and then query the PSoC on a backoff schedule until it is done or the
+        deadline is passed.  The time the data was ready is used to improve the prediction.
+
+        :param num_reads: number of reads the PSoC was told to make
+        :param trigger_time: time.time() the read command was sent, now if None
+        :return: the last query message from the PSoC
+        """
+        if trigger_time is None:
+            trigger_time = time.time()
+        predicted_time = self.readiness.predict(self.integration_time, self.st_clock_divider, num_reads)
+        deadline = trigger_time + 2 * predicted_time + QUERY_TIMEOUT_PADDING
+        time.sleep(max(0., trigger_time + self.readiness.first_poll_time(predicted_time) - time.time()))
+
+        last_not_ready = None  # time of the last query that was not done
+        for interval in self.readiness.poll_intervals():
+            query_time = time.time()
+            query_message = self.query_data_readiness()
+            if query_message != QUERY_NOT_DONE:
+                break
+            last_not_ready = query_time
+            if query_time > deadline:
+                logging.error("Timed out waiting for data after {0:.3f} sec".format(query_time - trigger_time))
+                return query_message
+            time.sleep(interval)
+
+        if query_message and query_message != QUERY_NO_DATA:
+            self.readiness.record_polls(self.integration_time, self.st_clock_divider, num_reads,
+                                        trigger_time, last_not_ready, query_time)
+        return query_message
+
+    def start_streaming(self, integration_time, num_reads=1, buffer_size=STREAM_BUFFER_SIZE,
+                        frame_callback=None, max_frames=None, start_barrier=None):
+        """ Start reading the C12880 continuously on a separate thread
+
+        :param integration_time: integration time in microseconds
+        :param num_reads: number of reads the PSoC sums for each frame
+        :param buffer_size: number of frames the ring buffer holds
+        :param frame_callback: function called with the sequence number of each new frame, is
+        called from the streaming thread
+        :param max_frames: number of frames to read, stream until stop_streaming is called if None
+        :param start_barrier: threading.Barrier to wait on before the first read, to start
+        several spectrometers together
+        :return: SpectrumRingBuffer the frames are put in, or None if streaming could not start
+        """
+        with self._stream_lock:
+            self.stop_streaming()
+            if integration_time != self.integration_time:
+                if not self.set_integration_time(integration_time):
+                    return None
+            if not self.get_read_command(num_reads):
+                logging.error("Can not stream with {0} reads".format(num_reads))
+                return None
+            ring_buffer = spectrum_buffer.SpectrumRingBuffer(buffer_size)
+            self.stream = StreamingAcquisition(self, num_reads, ring_buffer,
+                                               frame_callback=frame_callback, max_frames=max_frames,
+                                               start_barrier=start_barrier)
+            self.stream.start()
+            return ring_buffer
+
+    def stop_streaming(self):
+        with self._stream_lock:
+            if self.stream:
+                self.stream.stop()  # marks the stream as stopped so it is not resumed
+                self.stream.join()
+                self.stream = None
+
+    def resume_streaming(self) -> bool:
+        """ Start a stream that stopped on an error again, with the same settings and ring buffer
+        so whoever is reading the buffer gets the new frames, i.e. after a reconnect
+
+        :return: True if a stream was started
+        """
+        with self._stream_lock:
+            stream = self.stream
+            if stream is None or stream.is_alive() or stream.stopped or not stream.error:
+                return False
+            max_frames = None
+            if stream.max_frames:
+                max_frames = stream.max_frames - stream.frames_read
+                if max_frames <= 0:
+                    return False
+            logging.info("Resuming stream stopped by: {0}".format(stream.error))
+            self.usb.drain_input()  # answers to the commands the stream gave up on
+            self.stream = StreamingAcquisition(self, stream.num_reads, stream.ring_buffer,
+                                               pipeline=stream.pipeline,
+                                               frame_callback=stream.frame_callback,
+                                               max_frames=max_frames)
+            self.stream.start()
+            return True
 
-    def get_C12880_state(self):
-        self.usb.usb_write("C12880|DEBUG")
-        time.sleep(0.2)
-        data = self.usb.usb_read_data(11)
+    def get_C12880_state(self) -> dict:
+        """ Read the state registers of the C12880 driver on the PSoC, for debugging """
+        with self.usb.lock:
+            self.usb.usb_write("C12880|DEBUG")
+            data = self.usb.usb_read_data(11)
+        if data is None:
+            raise IOError("No response to the debug request")
         data = self.convert_C12880_debug_values(data)
         data_struct = {}
         data_struct['TRG'] = data[0]
@@ -236,23 +463,7 @@ class C12880(object):
         data_struct['ISR PWM'] = data[3]
         data_struct['dma count'] = data[4]
         data_struct['EoS status'] = data[5]
-
-        if not os.path.exists('log/'):
-            os.makedirs('log/')
-
-        try:
-
-            with open('log/C12880_state.log', 'a') as f:
-                # f.write(data_struct)
-                json.dump(data_struct, f)
-                f.write("\nintegration time:{0}\n".format(self.integration_time))
-        except:
-            with open('log/C12880_state.log', 'w') as f:
-                # f.write(data_struct)
-                json.dump(data_struct, f)
-                f.write("\nintegration time:{0}\n".format(self.integration_time))
-
-        f.close()
+        return data_struct
 
     @staticmethod
     def convert_C12880_debug_values(data):
@@ -298,26 +509,139 @@ class C12880(object):
     #         self.laser_power_set = new_power_level
 
 
+class StreamingAcquisition(threading.Thread):
+    """ Free running acquisition of a C12880.  The trigger for the next exposure is sent right
+    after the export request of the last one, so the sensor integrates while the previous frame
+    is transferred over the USB.  The frames are put into a SpectrumRingBuffer. """
+
+    def __init__(self, spectrometer: 'C12880', num_reads: int,
+                 ring_buffer: spectrum_buffer.SpectrumRingBuffer, pipeline=True,
+                 frame_callback=None, max_frames=None, start_barrier=None):
+        """
+        :param spectrometer: C12880 to read, the integration time should already be set
+        :param num_reads: number of reads the PSoC sums for each frame
+        :param ring_buffer: buffer to put the frames in
+        :param pipeline: send the next read trigger before the last frame is transferred,
+        if False the next read is only triggered after the transfer is done
+        :param frame_callback: function called with the sequence number of each new frame
+        :param max_frames: stop after this many frames, run until stop is called if None
+        :param start_barrier: threading.Barrier to wait on before the first read trigger
+        """
+        threading.Thread.__init__(self, name="C12880 stream", daemon=True)
+        self.spectrometer = spectrometer
+        self.usb = spectrometer.usb
+        self.num_reads = num_reads
+        self.ring_buffer = ring_buffer
+        self.pipeline = pipeline
+        self.frame_callback = frame_callback
+        self.max_frames = max_frames
+        self.start_barrier = start_barrier
+        self.frames_read = 0
+        self.error = None  # message of why the stream stopped if it was not asked to
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        logging.debug("Stopping C12880 stream")
+        self._stop_event.set()
+
+    @property
+    def stopped(self) -> bool:
+        """ True if stop was called, a stopped stream is not resumed """
+        return self._stop_event.is_set()
+
+    def run(self):
+        read_command = self.spectrometer.get_read_command(self.num_reads)
+        if self.num_reads == 1:
+            read_data = self.usb.read_single_data
+        else:
+            read_data = self.usb.read_multi_data
+
+        if self.start_barrier:
+            try:
+                self.start_barrier.wait()
+            except threading.BrokenBarrierError:
+                self.error = "Synchronized start failed"
+                logging.error(self.error)
+                return
+        self.usb.usb_write(read_command)
+        trigger_time = time.time()
+        read_pending = True  # keep track if the PSoC has a read going that has to be cleared
+        while read_pending:
+            query_message = self.spectrometer.wait_for_data(self.num_reads, trigger_time)
+            if query_message in (QUERY_NOT_DONE, QUERY_NO_DATA) or not query_message:
+                self.error = "Bad data query message: {0}".format(query_message)
+                logging.error(self.error)
+                break
+
+            keep_running = not self._stop_event.is_set()
+            if self.max_frames and self.frames_read + 1 >= self.max_frames:
+                keep_running = False
+            next_command = None
+            if keep_running and self.pipeline:
+                next_command = read_command
+            with self.usb.lock:
+                data = read_data(next_command)
+                # the next exposure started when the trigger was sent, before the transfer
+                next_trigger_time = self.usb.export_time
+            if data is None:
+                self.error = "Failed reading data"
+                logging.error(self.error)
+                break
+
+            sequence = self.ring_buffer.append(data, self.num_reads, trigger_time)
+            self.frames_read += 1
+            if self.frame_callback:
+                self.frame_callback(sequence)
+            if self.spectrometer.state_logger:
+                self.spectrometer.state_logger.frame_done(self.spectrometer)
+
+            if keep_running and not self.pipeline:
+                self.usb.usb_write(read_command)
+                next_trigger_time = time.time()
+            trigger_time = next_trigger_time
+            read_pending = keep_running
+        logging.debug("C12880 stream finished after {0} frames".format(self.frames_read))
+
+
 class LightSource(object):
     def __init__(self, usb: usb_comm.PSoC_USB, name: str,
-                 power_var: tk.StringVar = None, power_options: list=None, power_set: int=0):
+                 power_options: list=None, power_set: int=0):
         self.usb = usb
         self.name = name
-        if not power_var:
-            power_var = tk.StringVar()
-        self.power_var = power_var
         self.power_options = power_options
+        self.power_option = None  # type: str, the power option that is selected
+        if power_options:
+            self.power_option = power_options[0]
         self.power_set = power_set  # the current setting of the current to the light
         self.on = False  # type: Boolean to tell if the device has power to it
         self.use_flash = False  # flag to indicate if light source should be flashed
 
-    def change_power_level(self, *args):
-        logging.debug("changing {0} power to: {1}".format(self.name, self.power_var.get()))
-        new_power_level = self.power_options.index(self.power_var.get())
+    def change_power_level(self, power_option: str = None):
+        """ Set the power of the light
+
+        :param power_option: one of the power_options, the selected option is resent if None
+        """
+        if power_option is not None:
+            self.power_option = power_option
+        logging.debug("changing {0} power to: {1}".format(self.name, self.power_option))
+        new_power_level = self.power_options.index(self.power_option)
         if new_power_level != self.power_set:
-            self.usb.usb_write("{0}|POWER|{1}".format(self.name, new_power_level))
+            self.usb.write_setting("{0}|POWER|{1}".format(self.name, new_power_level))
             self.power_set = new_power_level
 
+    def set_power_milliamps(self, milliamps: float):
+        """ Select the power option closest to a current
+
+        :param milliamps: current in mA to run the light at
+        """
+        closest_option = min(self.power_options,
+                             key=lambda option: abs(float(option.split()[0]) - milliamps))
+        self.change_power_level(closest_option)
+
+    def turn_on(self, power_on=True):
+        if self.on != power_on:
+            self.toggle()
+
     def toggle(self):
         logging.debug("{0} power: {1}".format(self.name, self.on))
         if self.on:
@@ -329,11 +653,23 @@ class LightSource(object):
             self.usb.usb_write("{0}|ON|{1}".format(self.name, self.power_set))
             self.on = True
 
+    def restore_state(self):
+        """ Write the power, flash and on state again, i.e. after the device was reset """
+        self.power_set = None  # so the power is written even if it was not changed
+        if self.power_option:
+            self.change_power_level()
+        self.set_flash(self.use_flash)
+        if self.on:
+            self.on = False
+            self.toggle()
+
     def set_flash(self, use_flash=False):
+        self.use_flash = use_flash
         flash_flag = 0
         if use_flash:
             flash_flag = 1
-        self.usb.usb_write("{0}|Flash|{1}".format(self.name, flash_flag))
+        self.usb.write_setting("{0}|Flash|{1}".format(self.name, flash_flag))
+
 
 class CAT4004(LightSource):
     def __init__(self, usb: usb_comm.PSoC_USB, name:str, max_power: int = 100):
@@ -343,7 +679,6 @@ class CAT4004(LightSource):
         power_options_str = ["{:.0f} mA".format(x) for x in power_options]
 
         LightSource.__init__(self, usb, name, power_options=power_options_str)
-        self.power_var.set(self.power_options[0])
 
 class PWMDimmer(LightSource):
     def __init__(self, usb: usb_comm.PSoC_USB, name: str, max_power: int = 100,
@@ -356,17 +691,18 @@ class PWMDimmer(LightSource):
 
         self.max_power = max_power
         self.power_set = self.power_options[0]
-        self.power_var.set(self.power_set)
         self.pwm_period = pwm_period
         self.pwm_compare = pwm_compare
 
-    def change_power_level(self, *args):
-        logging.debug("changing {0} power to: {1}".format(self.name, self.power_var.get()))
-        new_power_level = self.power_options.index(self.power_var.get())
-        new_power_value = float(self.power_var.get().split()[0])
+    def change_power_level(self, power_option: str = None):
+        if power_option is not None:
+            self.power_option = power_option
+        logging.debug("changing {0} power to: {1}".format(self.name, self.power_option))
+        new_power_level = self.power_options.index(self.power_option)
+        new_power_value = float(self.power_option.split()[0])
         new_pwm_setting = int((new_power_value / self.max_power) * self.pwm_period)
         if new_power_level != self.power_set:
-            self.usb.usb_write("{0}|POWER|{1}".format(self.name, str(new_pwm_setting).zfill(3)))
+            self.usb.write_setting("{0}|POWER|{1}".format(self.name, str(new_pwm_setting).zfill(3)))
             self.power_set = new_power_level
 
     def toggle(self):
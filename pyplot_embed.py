@@ -4,6 +4,7 @@
 
 #standard libraries
 import logging
+import time
 import tkinter as tk
 
 # installed libraries
@@ -12,34 +13,26 @@ matplotlib.use("TkAgg")
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
 from matplotlib import pyplot as plt
 # local files
+import calibration
 import data_class
+from graph_scale import COUNT_SCALE, SCALE_HYSTERESIS, select_scale_index
 
 __author__ = 'Kyle Vitautas Lopin'
 
 C12880_SERIAL = "17D00042"
-pixel = range(1, 289)
 
-A_0 = 3.056675765e+2
-B_1 = 2.718285424
-B_2 = -1.550742501e-3
-B_3 = -3.975858137e-6
-B_4 = -5.463349212e-9
-B_5 = -2.634533143e-11
-
-COUNT_SCALE = [10, 20, 50, 100, 200, 500, 1000, 5000, 10000, 50000, 100000]
-LOWEST_WAVELENGTH = 340
-HIGHEST_WAVELENGTH = 850
-NUM_PIXELS = 288
-WAVELENGTH_INCREMENT = (HIGHEST_WAVELENGTH - LOWEST_WAVELENGTH) / NUM_PIXELS
-WAVELENGTHS = [LOWEST_WAVELENGTH + x*WAVELENGTH_INCREMENT for x in range(NUM_PIXELS)]
-
-WAVELENGTHS = [A_0+B_1*x+B_2*x**2+B_3*x**3+B_4*x**4+B_5*x**5 for x in range(1, 289)]
+DEFAULT_MAX_FPS = 20  # most times a second to redraw the graph
 
 
 class SpectroPlotter(tk.Frame):
-    def __init__(self, parent, _size=(6, 3)):
+    """ Graph of the spectrum.  New data is processed when it comes in but the graph is only
+    redrawn at most max_fps times a second, data that comes in between redraws is not shown.
+    Only the line is redrawn, on top of a cached copy of the axes, unless the y scale changes. """
+
+    def __init__(self, parent, _size=(6, 3), serial=C12880_SERIAL, max_fps=DEFAULT_MAX_FPS):
         tk.Frame.__init__(self, master=parent)
-        self.data = data_class.SpectrometerData(WAVELENGTHS)
+        self.calibration = calibration.get_calibration(serial)
+        self.data = data_class.SpectrometerData(self.calibration.wavelengths)
         self.scale_index = 3
 
         # routine to make and embed the matplotlib graph
@@ -54,32 +47,65 @@ class SpectroPlotter(tk.Frame):
         toolbar.update()
 
         self.canvas._tkcanvas.pack(side='top', fill=tk.BOTH, expand=True)
-        self.canvas.draw()
 
         self.axis.set_xlim([300, 850])
         self.axis.set_xlabel("wavelength (nm)")
 
         self.axis.set_ylim([-200, COUNT_SCALE[self.scale_index]])
         # self.axis.set_ylabel(r'$\mu$W/cm$^2$')
-        self.axis.set_ylabel('counts')
-        self.lines = None
-
-    def update_data(self, new_count_data=None, num_data_reads: int = 1):
-        if new_count_data:
-            self.data.update_data(new_count_data, num_data_reads)
-        else:
-            self.data.set_data_type()
-        display_data = self.data.current_data
-        while max(display_data) > COUNT_SCALE[self.scale_index]:
-            self.scale_index += 1
-            self.axis.set_ylim([0, COUNT_SCALE[self.scale_index]])
-        while (self.scale_index >= 1) and (max(display_data) < COUNT_SCALE[self.scale_index-1]):
-            self.scale_index -= 1
-            self.axis.set_ylim([0, COUNT_SCALE[self.scale_index]])
-        if self.lines:
-            self.lines.set_ydata(display_data)
-        else:
-            self.lines, = self.axis.plot(WAVELENGTHS, display_data)
+        self.axis.set_ylabel(self.data.units)
+        # the line is animated so a full draw leaves it out of the cached background
+        self.lines, = self.axis.plot(self.data.wavelengths, self.data.current_data, animated=True)
+        self.lines.set_visible(False)
+
+        self.max_fps = max_fps
+        self.background = None  # copy of the axes without the line to blit the line onto
+        self.render_scheduled = False
+        self.last_render_time = 0
+        self.canvas.mpl_connect('draw_event', self.on_draw)
         self.canvas.draw()
 
-
+    def update_data(self, new_count_data=None, num_data_reads: int = 1, integration_time=None,
+                    counts_per_second=False):
+        """ Process new data and schedule a redraw if one is not already waiting
+
+        :param new_count_data: counts from the device, redraw the current data if None
+        :param num_data_reads: number of reads the data is the sum of
+        :param integration_time: integration time of the data in microseconds
+        :param counts_per_second: the data is already processed to counts per second, i.e. a
+        high dynamic range spectrum
+        """
+        if new_count_data is not None:
+            self.data.update_data(new_count_data, num_data_reads, integration_time,
+                                  counts_per_second=counts_per_second)
+        if self.render_scheduled:
+            return  # the waiting redraw will show this data instead
+        self.render_scheduled = True
+        delay = self.last_render_time + 1. / self.max_fps - time.perf_counter()
+        self.after(max(0, int(1000 * delay)), self.render)
+
+    def render(self):
+        self.render_scheduled = False
+        self.last_render_time = time.perf_counter()
+        display_data = self.data.current_data
+        self.lines.set_ydata(display_data)
+        self.lines.set_visible(True)
+
+        new_scale_index = select_scale_index(display_data.max(), self.scale_index)
+        if self.data.units != self.axis.get_ylabel():
+            self.axis.set_ylabel(self.data.units)
+            self.background = None
+        if new_scale_index != self.scale_index or self.background is None:
+            self.scale_index = new_scale_index
+            self.axis.set_ylim([0, COUNT_SCALE[self.scale_index]])
+            self.canvas.draw()  # on_draw will cache the new background and draw the line
+            return
+        self.canvas.restore_region(self.background)
+        self.axis.draw_artist(self.lines)
+        self.canvas.blit(self.axis.bbox)
+
+    def on_draw(self, event=None):
+        """ Cache the axes after every full draw, i.e. from a resize or the toolbar, and put
+        the line back on top """
+        self.background = self.canvas.copy_from_bbox(self.axis.bbox)
+        self.axis.draw_artist(self.lines)
@@ -0,0 +1,101 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Predict when the PSoC will have finished a C12880 read so the data can be polled for
+right when it should be ready instead of after a fixed, pessimistic sleep """
+
+# standard libraries
+import logging
+
+__author__ = 'Kyle Vitautas Lopin'
+
+ST_CLOCK_CYCLES_PER_US = 24  # PSoC clock cycles per microsecond that the ST clock divider divides
+# after the integration the C12880 takes 88 clock cycles before the video starts and then
+# 1 clock cycle per pixel, add a few cycles for the end of scan signal
+READOUT_CLOCK_CYCLES = 88 + 288 + 12
+DEFAULT_READ_OVERHEAD = 0.002  # seconds for each read the model does not account for, until it is learned
+OVERHEAD_SMOOTHING = 0.25  # weight of a new latency measurement in the running average
+EARLY_POLL_FRACTION = 0.05  # start polling this fraction of the predicted time early
+MIN_POLL_INTERVAL = 0.0005  # seconds between the first queries
+MAX_POLL_INTERVAL = 0.02  # longest time between queries as the backoff grows
+POLL_BACKOFF = 2.  # multiply the poll interval by this after each not ready answer
+
+
+class ReadinessPredictor(object):
+    """ Model of how long a C12880 read takes.  The exposure and readout time is calculated
+    from the integration time and clock divider, and the time the PSoC adds on top of that is
+    learned from the observed latencies for each clock divider. """
+
+    def __init__(self, clock_cycles_per_us: float = ST_CLOCK_CYCLES_PER_US):
+        self.clock_cycles_per_us = clock_cycles_per_us
+        self.read_overheads = {}  # clock divider: learned seconds of overhead per read
+
+    def sensor_time(self, integration_time: float, clock_divider: int, num_reads: int) -> float:
+        """ Time the sensor needs to integrate and clock out all the reads
+
+        :param integration_time: integration time in microseconds
+        :param clock_divider: ST clock divider the PSoC is set to
+        :param num_reads: number of reads the PSoC makes
+        :return: seconds the reads take
+        """
+        clock_period = clock_divider / self.clock_cycles_per_us  # microseconds
+        read_time = integration_time + READOUT_CLOCK_CYCLES * clock_period
+        return num_reads * read_time / 1000000.
+
+    def predict(self, integration_time: float, clock_divider: int, num_reads: int) -> float:
+        """ Predict how long after the read command the data will be ready
+
+        :param integration_time: integration time in microseconds
+        :param clock_divider: ST clock divider the PSoC is set to
+        :param num_reads: number of reads the PSoC makes
+        :return: seconds from the read command until the data should be ready
+        """
+        overhead = self.read_overheads.get(clock_divider, DEFAULT_READ_OVERHEAD)
+        return self.sensor_time(integration_time, clock_divider, num_reads) + num_reads * overhead
+
+    def poll_intervals(self):
+        """ Generate the times to wait between queries after the first query was not ready,
+        starting short and backing off to MAX_POLL_INTERVAL """
+        interval = MIN_POLL_INTERVAL
+        while True:
+            yield interval
+            interval = min(interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+
+    @staticmethod
+    def first_poll_time(predicted_time: float) -> float:
+        """ Seconds after the read command to send the first query """
+        return predicted_time * (1. - EARLY_POLL_FRACTION)
+
+    def record(self, integration_time: float, clock_divider: int, num_reads: int,
+               latency: float):
+        """ Update the learned overhead with an observed time from read command to data ready
+
+        :param integration_time: integration time in microseconds
+        :param clock_divider: ST clock divider the PSoC is set to
+        :param num_reads: number of reads the PSoC made
+        :param latency: seconds from the read command until the data was ready
+        """
+        sensor_time = self.sensor_time(integration_time, clock_divider, num_reads)
+        measured_overhead = max(0., (latency - sensor_time) / num_reads)
+        if clock_divider in self.read_overheads:
+            old_overhead = self.read_overheads[clock_divider]
+            measured_overhead = (OVERHEAD_SMOOTHING * measured_overhead +
+                                 (1. - OVERHEAD_SMOOTHING) * old_overhead)
+        self.read_overheads[clock_divider] = measured_overhead
+        logging.debug("read overhead for divider {0}: {1:.5f} sec".format(clock_divider,
+                                                                         measured_overhead))
+
+    def record_polls(self, integration_time: float, clock_divider: int, num_reads: int,
+                     trigger_time: float, last_not_ready: float, ready_time: float):
+        """ Update the learned overhead from the queries of a read.  The data was ready some
+        time between the last query that was not done and the first one that was, or before the
+        first query if every one was done
+
+        :param trigger_time: time.time() the read command was sent
+        :param last_not_ready: time.time() of the last query that was not done, None if none
+        :param ready_time: time.time() of the query that was done
+        """
+        if last_not_ready is None:
+            sensor_end = trigger_time + self.sensor_time(integration_time, clock_divider, num_reads)
+            last_not_ready = min(sensor_end, ready_time)
+        latency = (last_not_ready + ready_time) / 2. - trigger_time
+        self.record(integration_time, clock_divider, num_reads, latency)
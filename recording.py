@@ -0,0 +1,220 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Append only, memory mapped store of a time course of spectra.  The counts of every frame
+are kept in an N x 288 array on disk, with parallel arrays of the timestamp, integration time,
+number of reads and light source state of each frame.  Only the pages being used are kept in
+RAM so a recording can run for as long as there is disk space. """
+
+# standard libraries
+from collections import namedtuple
+import json
+import logging
+import os
+import time
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+NUM_PIXELS = 288
+INITIAL_CAPACITY = 1024  # frames to make room for when a recording is started
+MAX_GROWTH = 65536  # most frames to add when the files are grown, otherwise the capacity doubles
+HEADER_SAVE_INTERVAL = 256  # save the frame count to the header after this many frames
+HEADER_FILE = 'header.json'
+COUNTS_FILE = 'counts.dat'
+# name and type of the information kept for each frame besides the counts
+FRAME_FIELDS = [('timestamp', np.float64), ('integration_time', np.float64),
+                ('num_reads', np.uint16), ('light_state', np.uint16)]
+
+RecordedFrame = namedtuple('RecordedFrame', ['index', 'timestamp', 'integration_time',
+                                             'num_reads', 'light_state', 'counts'])
+
+
+class TimeCourseRecording(object):
+    """ Spectra saved to a folder of memory mapped files.  Frames can only be added to the end,
+    and have to be added in time order so they can be found by time. """
+
+    def __init__(self, directory: str, mode: str = 'w', num_pixels: int = NUM_PIXELS,
+                 dtype=np.float32, initial_capacity: int = INITIAL_CAPACITY):
+        """
+        :param directory: folder to keep the recording files in
+        :param mode: 'w' to start a new recording, 'a' to add to an old one, or 'r' to only read one
+        :param num_pixels: pixels in each spectrum, only used for a new recording
+        :param dtype: numpy type to save the counts as, only used for a new recording
+        :param initial_capacity: frames to make room for in a new recording
+        """
+        if mode not in ('w', 'a', 'r'):
+            raise ValueError("mode has to be 'w', 'a', or 'r', not {0}".format(mode))
+        self.directory = directory
+        self.read_only = (mode == 'r')
+        if mode == 'w':
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            self.num_pixels = num_pixels
+            self.dtype = np.dtype(dtype)
+            self.count = 0
+            self.capacity = max(1, initial_capacity)
+            for filename, item_size in self._files():
+                with open(filename, 'wb') as _file:
+                    _file.truncate(self.capacity * item_size)
+            self._save_header()
+        else:
+            with open(os.path.join(directory, HEADER_FILE), 'r') as _file:
+                header = json.load(_file)
+            self.num_pixels = header['num_pixels']
+            self.dtype = np.dtype(header['dtype'])
+            self.count = header['count']
+            self.capacity = os.path.getsize(os.path.join(directory, COUNTS_FILE)) // self._frame_bytes()
+        self.unsaved_frames = 0
+        self._map_files()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        """ Counts of a frame or a slice of frames, as a view into the file """
+        return self.counts[:self.count][index]
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self.fields['timestamp'][:self.count]
+
+    def append(self, counts, timestamp: float = None, integration_time: float = 0,
+               num_reads: int = 1, light_state: int = 0) -> int:
+        """ Add a frame to the end of the recording
+
+        :param counts: num_pixels counts
+        :param timestamp: time.time() of the frame, the current time if None
+        :param integration_time: integration time in microseconds
+        :param num_reads: number of reads the counts are the sum of
+        :param light_state: bit flags of the light sources that were on
+        :return: index of the new frame
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if self.count >= self.capacity:
+            self._grow(self.count + 1)
+        index = self.count
+        self.counts[index] = counts
+        self.fields['timestamp'][index] = timestamp
+        self.fields['integration_time'][index] = integration_time
+        self.fields['num_reads'][index] = num_reads
+        self.fields['light_state'][index] = light_state
+        self._added(1)
+        return index
+
+    def append_batch(self, counts, timestamps, integration_times=0, num_reads=1, light_states=0) -> int:
+        """ Add N frames to the end of the recording
+
+        :param counts: N x num_pixels array of counts
+        :param timestamps: N time.time() values
+        :param integration_times: integration time in microseconds, a number or N values
+        :param num_reads: number of reads each frame is the sum of, a number or N values
+        :param light_states: bit flags of the lights that were on, a number or N values
+        :return: index of the first new frame
+        """
+        num_frames = len(counts)
+        if self.count + num_frames > self.capacity:
+            self._grow(self.count + num_frames)
+        first, last = self.count, self.count + num_frames
+        self.counts[first:last] = counts
+        self.fields['timestamp'][first:last] = timestamps
+        self.fields['integration_time'][first:last] = integration_times
+        self.fields['num_reads'][first:last] = num_reads
+        self.fields['light_state'][first:last] = light_states
+        self._added(num_frames)
+        return first
+
+    def frame(self, index: int) -> RecordedFrame:
+        """ Get a frame and its information
+
+        :param index: index of the frame, negative values count from the end
+        :return: RecordedFrame, the counts are a view into the file
+        """
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("frame {0} is not in a recording of {1} frames".format(index, self.count))
+        return RecordedFrame(index, float(self.fields['timestamp'][index]),
+                             float(self.fields['integration_time'][index]),
+                             int(self.fields['num_reads'][index]),
+                             int(self.fields['light_state'][index]), self.counts[index])
+
+    def index_at_time(self, timestamp: float) -> int:
+        """ Find the last frame taken at or before a time
+
+        :param timestamp: time.time() value to look for
+        :return: index of the frame, or -1 if all frames are later
+        """
+        return int(np.searchsorted(self.timestamps, timestamp, side='right')) - 1
+
+    def time_slice(self, start_time: float, end_time: float) -> slice:
+        """ Get the slice of frames taken from start_time up to, but not including, end_time """
+        timestamps = self.timestamps
+        return slice(int(np.searchsorted(timestamps, start_time, side='left')),
+                     int(np.searchsorted(timestamps, end_time, side='left')))
+
+    def flush(self):
+        """ Write the data in memory to the files and save the frame count """
+        if self.read_only:
+            return
+        self.counts.flush()
+        for field in self.fields.values():
+            field.flush()
+        self._save_header()
+        self.unsaved_frames = 0
+
+    def close(self):
+        self.flush()
+        self.counts = None
+        self.fields = None
+
+    def _added(self, num_frames):
+        self.count += num_frames
+        self.unsaved_frames += num_frames
+        if self.unsaved_frames >= HEADER_SAVE_INTERVAL:
+            self.flush()
+
+    def _grow(self, min_capacity):
+        """ Make the files bigger, the capacity is doubled up to MAX_GROWTH frames at a time so
+        appending takes constant time on average """
+        if self.read_only:
+            raise IOError("Recording {0} is opened read only".format(self.directory))
+        new_capacity = self.capacity
+        while new_capacity < min_capacity:
+            new_capacity += min(new_capacity, MAX_GROWTH)
+        logging.debug("growing recording to {0} frames".format(new_capacity))
+        self.flush()
+        # the old maps have to be let go of before the files can change size on windows
+        self.counts = None
+        self.fields = None
+        for filename, item_size in self._files():
+            with open(filename, 'r+b') as _file:
+                _file.truncate(new_capacity * item_size)
+        self.capacity = new_capacity
+        self._map_files()
+
+    def _map_files(self):
+        mode = 'r' if self.read_only else 'r+'
+        self.counts = np.memmap(os.path.join(self.directory, COUNTS_FILE), dtype=self.dtype,
+                                mode=mode, shape=(self.capacity, self.num_pixels))
+        self.fields = {}
+        for name, dtype in FRAME_FIELDS:
+            self.fields[name] = np.memmap(os.path.join(self.directory, name + '.dat'),
+                                          dtype=dtype, mode=mode, shape=(self.capacity,))
+
+    def _files(self):
+        """ List the name and bytes per frame of each file of the recording """
+        files = [(os.path.join(self.directory, COUNTS_FILE), self._frame_bytes())]
+        for name, dtype in FRAME_FIELDS:
+            files.append((os.path.join(self.directory, name + '.dat'), np.dtype(dtype).itemsize))
+        return files
+
+    def _frame_bytes(self):
+        return self.num_pixels * self.dtype.itemsize
+
+    def _save_header(self):
+        header = {'num_pixels': self.num_pixels, 'dtype': self.dtype.str, 'count': self.count,
+                  'fields': [name for name, _ in FRAME_FIELDS]}
+        with open(os.path.join(self.directory, HEADER_FILE), 'w') as _file:
+            json.dump(header, _file)
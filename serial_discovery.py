@@ -0,0 +1,153 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Find the serial port a PSoC spectrometer is on.  Ports with the USB vendor id of a known
+board are tried first, the port that worked last time is tried before any of them, and the
+ports are probed at the same time on a small pool of threads so a computer with many serial
+ports does not have to wait for each one to time out in turn. """
+
+# standard libraries
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import glob
+import logging
+import sys
+# installed libraries
+import serial
+import serial.tools.list_ports
+
+__author__ = 'Kyle Vitautas Lopin'
+
+PSOC_ID_MESSAGE = b"PSoC-Spectrometer"
+ID_COMMAND = b"ID"
+BAUDRATE = 115200
+PROBE_TIMEOUT = 0.5  # seconds to wait for a port to identify itself
+MAX_PROBE_WORKERS = 8
+# USB vendor ids of the boards the spectrometer has been built on, Cypress and Arduino
+USB_VENDOR_IDS = [0x04B4, 0x2341]
+LAST_PORT_FILE = 'last_serial_port.txt'  # the port the device was found on last time
+
+
+def candidate_ports(vendor_ids=USB_VENDOR_IDS, product_ids=None) -> list:
+    """ List the serial ports that could have the device, in the order to try them.  Ports of a
+    USB device with a matching vendor and product id come first, then other USB serial ports.
+    Ports without USB information, i.e. the motherboard's /dev/ttyS ports, are only listed if
+    the port information can not be read.
+
+    :param vendor_ids: USB vendor ids to try first
+    :param product_ids: USB product ids to try first, any product id of the vendors if None
+    :return: list of port names
+    """
+    try:
+        ports = serial.tools.list_ports.comports()
+    except Exception as error:
+        logging.info("Could not list the serial ports: {0}".format(error))
+        return glob_ports()
+    matching = []
+    other_usb = []
+    for port in ports:
+        if port.vid is None:
+            continue
+        if port.vid in vendor_ids and (not product_ids or port.pid in product_ids):
+            matching.append(port.device)
+        else:
+            other_usb.append(port.device)
+    return matching + other_usb
+
+
+def port_present(port: str) -> bool:
+    """ Check if a serial port is still listed, i.e. its USB serial adapter was not unplugged """
+    try:
+        return port in [info.device for info in serial.tools.list_ports.comports()]
+    except Exception as error:
+        logging.info("Could not list the serial ports: {0}".format(error))
+        return port in glob_ports()
+
+
+def glob_ports() -> list:
+    """ List the serial ports by name, for when pyserial can not give the port information """
+    # taken from http://stackoverflow.com/questions/12090503/listing-available-com-ports-with-python
+    if sys.platform.startswith('win'):
+        return ['COM%s' % (i+1) for i in range(32)]
+    elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
+        return glob.glob('/dev/tty[A-Za-z]*')
+    elif sys.platform.startswith('darwin'):
+        return glob.glob('/dev/tty.*')
+    raise EnvironmentError('Unsupported platform')
+
+
+def probe_port(port: str, expected_message: bytes = PSOC_ID_MESSAGE, baudrate: int = BAUDRATE,
+               timeout: float = PROBE_TIMEOUT) -> bool:
+    """ Ask the device on a port to identify itself
+
+    :param port: name of the port, i.e. COM3 or /dev/ttyACM0
+    :param expected_message: what the device answers the ID command with
+    :param baudrate: baud rate to open the port at
+    :param timeout: seconds to wait for the answer
+    :return: True if the device answered with the expected message
+    """
+    try:
+        with serial.Serial(port, baudrate=baudrate, timeout=timeout, write_timeout=timeout) as device:
+            device.reset_input_buffer()
+            device.write(ID_COMMAND)
+            message = device.read(len(expected_message))
+    except (OSError, serial.SerialException) as error:
+        logging.debug("Could not probe {0}: {1}".format(port, error))
+        return False
+    logging.debug("{0} answered: {1}".format(port, message))
+    return message == expected_message
+
+
+def load_last_port(filename: str = LAST_PORT_FILE) -> str:
+    try:
+        with open(filename) as _file:
+            return _file.read().strip() or None
+    except OSError:
+        return None
+
+
+def save_last_port(port: str, filename: str = LAST_PORT_FILE):
+    try:
+        with open(filename, 'w') as _file:
+            _file.write(port)
+    except OSError as error:
+        logging.info("Could not save the serial port: {0}".format(error))
+
+
+def find_device_port(ports: list = None, probe=probe_port, max_workers: int = MAX_PROBE_WORKERS,
+                     last_port_file: str = LAST_PORT_FILE) -> str:
+    """ Find the port the spectrometer is on
+
+    :param ports: port names to try, from candidate_ports if None
+    :param probe: function that takes a port name and returns True if the device is on it
+    :param max_workers: most ports to probe at the same time
+    :param last_port_file: file the last port found is kept in, None to not use one
+    :return: name of the port, or None if the device was not found
+    """
+    if ports is None:
+        ports = candidate_ports()
+    last_port = load_last_port(last_port_file) if last_port_file else None
+    if last_port:
+        if probe(last_port):
+            logging.info("Device found on the last port used: {0}".format(last_port))
+            return last_port
+        ports = [port for port in ports if port != last_port]
+    if not ports:
+        return None
+
+    found_port = None
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(ports))),
+                                  thread_name_prefix="Serial probe")
+    try:
+        probes = {executor.submit(probe, port): port for port in ports}
+        for finished in as_completed(probes):
+            if finished.exception() is None and finished.result():
+                found_port = probes[finished]
+                break
+        for future in probes:
+            future.cancel()  # ports not started yet do not have to be probed
+    finally:
+        executor.shutdown(wait=False)
+    if found_port:
+        logging.info("Device found on {0}".format(found_port))
+        if last_port_file:
+            save_last_port(found_port, last_port_file)
+    return found_port
@@ -0,0 +1,134 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Binary frames for the serial connection to the spectrometer.  Each frame is
+
+    sync (2 bytes, A5 5A) | type (1) | length (2) | counter (2) | payload (length) | crc (2)
+
+with the numbers little endian and the crc a CRC-16-CCITT of the type, length, counter and
+payload.  FrameParser takes the bytes as they arrive, in pieces of any size, and returns the
+whole frames found in them; a bad crc or a torn frame only costs that frame as the parser looks
+for the next sync word. """
+
+# standard libraries
+import binascii
+import collections
+import logging
+import struct
+
+__author__ = 'Kyle Vitautas Lopin'
+
+SYNC = b"\xa5\x5a"
+HEADER = struct.Struct('<2sBHH')  # sync, type, length, counter
+CRC = struct.Struct('<H')
+CRC_START = 0xFFFF
+MAX_PAYLOAD = 4096  # bytes, longer lengths are taken as a corrupted header
+
+# frame types
+SPECTRUM = 0x01  # payload is NUM_PIXELS uint16 counts
+MESSAGE = 0x02  # payload is ascii text, i.e. an answer to a command
+BAUD_ACK = 0x03  # payload is the uint32 baud rate the device will change to
+
+Frame = collections.namedtuple('Frame', ['type', 'counter', 'payload'])
+
+
+def crc16(data, crc: int = CRC_START) -> int:
+    return binascii.crc_hqx(data, crc)
+
+
+def encode_frame(frame_type: int, counter: int, payload: bytes = b"") -> bytes:
+    """ Make the bytes of a frame, the way the firmware sends them """
+    header = HEADER.pack(SYNC, frame_type, len(payload), counter & 0xFFFF)
+    return header + payload + CRC.pack(crc16(payload, crc16(header[len(SYNC):])))
+
+
+class FrameParser(object):
+    """ Find frames in a stream of bytes that arrives in pieces """
+
+    def __init__(self, buffer_size: int = 4 * (HEADER.size + MAX_PAYLOAD + CRC.size)):
+        self._buffer = bytearray(buffer_size)  # reused for all the data, never reallocated
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first byte not parsed yet
+        self._end = 0  # end of the data in the buffer
+        self.last_counter = None
+        self.frames = 0
+        self.crc_errors = 0
+        self.bytes_skipped = 0  # bytes thrown away looking for a sync word
+        self.frames_lost = 0  # from gaps in the frame counter
+
+    def reset(self):
+        self._start = self._end = 0
+        self.last_counter = None
+
+    def feed(self, data) -> list:
+        """ Add bytes read from the port and get the frames they complete
+
+        :param data: bytes read from the serial port
+        :return: list of Frames, the payloads are copies so they can be kept
+        """
+        frames = []
+        data = memoryview(data)
+        while len(data):
+            if self._end == len(self._buffer):
+                self._compact()
+            if self._end == len(self._buffer):  # full of a frame that can not be finished
+                self._skip(1)
+                self._compact()
+            num_bytes = min(len(data), len(self._buffer) - self._end)
+            self._view[self._end:self._end + num_bytes] = data[:num_bytes]
+            self._end += num_bytes
+            data = data[num_bytes:]
+            self._parse(frames)
+        self._compact()
+        return frames
+
+    def _parse(self, frames: list):
+        buffer = self._buffer
+        while self._end - self._start >= HEADER.size:
+            sync_index = buffer.find(SYNC, self._start, self._end)
+            if sync_index < 0:
+                # keep the last byte, it could be the start of a sync word
+                self._skip(self._end - self._start - 1)
+                return
+            if sync_index > self._start:
+                self._skip(sync_index - self._start)
+                continue
+            if self._end - self._start < HEADER.size:
+                return
+            _, frame_type, length, counter = HEADER.unpack_from(buffer, self._start)
+            if length > MAX_PAYLOAD:
+                self._skip(1)
+                continue
+            frame_end = self._start + HEADER.size + length + CRC.size
+            if frame_end > self._end:
+                return  # wait for the rest of the frame
+            payload_start = self._start + HEADER.size
+            crc = crc16(self._view[self._start + len(SYNC):payload_start + length])
+            if crc != CRC.unpack_from(buffer, payload_start + length)[0]:
+                self.crc_errors += 1
+                self._skip(1)
+                continue
+            self._check_counter(counter)
+            frames.append(Frame(frame_type, counter, bytes(self._view[payload_start:payload_start + length])))
+            self.frames += 1
+            self._start = frame_end
+
+    def _check_counter(self, counter: int):
+        if self.last_counter is not None:
+            gap = (counter - self.last_counter - 1) & 0xFFFF
+            if gap:
+                logging.debug("Lost {0} serial frames".format(gap))
+                self.frames_lost += gap
+        self.last_counter = counter
+
+    def _skip(self, num_bytes: int):
+        self.bytes_skipped += num_bytes
+        self._start += num_bytes
+
+    def _compact(self):
+        """ Move the unparsed bytes to the start of the buffer """
+        if self._start == 0:
+            return
+        remaining = self._end - self._start
+        self._view[:remaining] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = remaining
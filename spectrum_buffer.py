@@ -0,0 +1,109 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Fixed capacity ring buffer of spectra that an acquisition thread fills and the GUI, or any
+other consumer, reads from """
+
+# standard libraries
+from collections import namedtuple
+import threading
+import time
+# installed libraries
+import numpy as np
+
+__author__ = 'Kyle Vitautas Lopin'
+
+NUM_PIXELS = 288
+
+SpectrumFrame = namedtuple('SpectrumFrame', ['sequence', 'timestamp', 'num_reads', 'counts'])
+SpectrumBatch = namedtuple('SpectrumBatch', ['sequences', 'timestamps', 'num_reads', 'counts'])
+
+
+class SpectrumRingBuffer(object):
+    """ Hold the last capacity spectra in preallocated arrays.  Every frame gets a sequence number
+    that increases by 1 for each frame put in, so a consumer can tell if it missed frames.  Once
+    the buffer is full the oldest frames are overwritten. """
+
+    def __init__(self, capacity: int = 256, num_pixels: int = NUM_PIXELS, dtype=np.float64):
+        """
+        :param capacity: number of spectra the buffer holds
+        :param num_pixels: number of pixels in each spectrum
+        :param dtype: numpy data type to store the counts as
+        """
+        self.capacity = capacity
+        self.num_pixels = num_pixels
+        self.counts = np.zeros((capacity, num_pixels), dtype=dtype)
+        self.sequences = np.full(capacity, -1, dtype=np.int64)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.num_reads = np.zeros(capacity, dtype=np.uint16)
+        self.next_sequence = 0  # sequence number the next frame put in will get
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return min(self.next_sequence, self.capacity)
+
+    def append(self, counts, num_reads: int = 1, timestamp: float = None) -> int:
+        """ Copy a spectrum into the buffer, overwriting the oldest frame if it is full
+
+        :param counts: sequence of num_pixels counts, anything numpy can copy from
+        :param num_reads: number of reads the PSoC summed to make the counts
+        :param timestamp: time.time() the exposure started, the current time if None
+        :return: sequence number given to the frame
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._condition:
+            sequence = self.next_sequence
+            index = sequence % self.capacity
+            self.counts[index] = counts
+            self.sequences[index] = sequence
+            self.timestamps[index] = timestamp
+            self.num_reads[index] = num_reads
+            self.next_sequence += 1
+            self._condition.notify_all()
+        return sequence
+
+    def latest(self) -> SpectrumFrame:
+        """ Get a copy of the newest frame
+
+        :return: SpectrumFrame of the newest frame, or None if nothing has been put in yet
+        """
+        with self._condition:
+            if not self.next_sequence:
+                return None
+            index = (self.next_sequence - 1) % self.capacity
+            return SpectrumFrame(int(self.sequences[index]), float(self.timestamps[index]),
+                                 int(self.num_reads[index]), self.counts[index].copy())
+
+    def get_batch(self, after_sequence: int = -1, max_frames: int = None) -> SpectrumBatch:
+        """ Get copies of all frames newer than after_sequence that are still in the buffer,
+        oldest first
+
+        :param after_sequence: sequence number of the last frame the consumer already has
+        :param max_frames: most frames to return, the oldest ones are returned if there are more
+        :return: SpectrumBatch with a row in counts for each frame
+        """
+        with self._condition:
+            first = max(after_sequence + 1, self.next_sequence - self.capacity)
+            last = self.next_sequence
+            if max_frames is not None:
+                last = min(last, first + max_frames)
+            indexes = np.arange(first, last) % self.capacity
+            return SpectrumBatch(self.sequences[indexes], self.timestamps[indexes],
+                                 self.num_reads[indexes], self.counts[indexes])
+
+    def wait_for_frame(self, after_sequence: int = -1, timeout: float = None) -> bool:
+        """ Block until a frame newer than after_sequence is put in
+
+        :param after_sequence: sequence number of the last frame the consumer already has
+        :param timeout: seconds to wait, wait forever if None
+        :return: True if there is a newer frame, False if the wait timed out
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self.next_sequence > after_sequence + 1,
+                                            timeout)
+
+    def clear(self):
+        """ Remove all frames, the sequence numbers start over at 0 """
+        with self._condition:
+            self.sequences.fill(-1)
+            self.next_sequence = 0
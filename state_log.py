@@ -0,0 +1,104 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Sampled logging of the C12880 state registers for debugging.  Only every Nth frame is
+sampled, and the DEBUG query and the file writing are done on a background thread so the
+acquisition does not wait on them.  Records are JSON lines, buffered in memory and written to a
+log file that is rotated when it gets too big. """
+
+# standard libraries
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+__author__ = 'Kyle Vitautas Lopin'
+
+LOG_FILE = 'log/C12880_state.log'
+SAMPLE_EVERY = 100  # frames between state captures
+MAX_BYTES = 1000000  # size of the log file before it is rotated
+BACKUP_COUNT = 3  # number of rotated log files kept
+BUFFER_RECORDS = 20  # records held in memory before they are written
+MAX_PENDING = 4  # captures waiting for the writer, more are dropped instead of piling up
+
+
+class StateLogger(object):
+    """ Captures the state of a C12880 every sample_every frames on a writer thread """
+
+    def __init__(self, filename: str = LOG_FILE, sample_every: int = SAMPLE_EVERY,
+                 max_bytes: int = MAX_BYTES, backup_count: int = BACKUP_COUNT,
+                 buffer_records: int = BUFFER_RECORDS):
+        """
+        :param filename: log file to write the records to
+        :param sample_every: capture the state after every this many frames
+        :param max_bytes: size the log file is rotated at
+        :param backup_count: number of old log files to keep
+        :param buffer_records: number of records to hold before writing them to the file,
+        errors are written right away
+        """
+        self.sample_every = max(1, sample_every)
+        self.frames_seen = 0
+        self.records_written = 0
+        self.records_dropped = 0
+
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        self._file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes,
+                                                                  backupCount=backup_count, delay=True)
+        self._handler = logging.handlers.MemoryHandler(buffer_records, flushLevel=logging.ERROR,
+                                                       target=self._file_handler)
+        # a logger of its own so the records do not go to the console too
+        self._logger = logging.getLogger("{0}.{1}".format(__name__, id(self)))
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._logger.addHandler(self._handler)
+
+        self._queue = queue.Queue(MAX_PENDING)
+        self._thread = threading.Thread(target=self._run, name="C12880 state log", daemon=True)
+        self._thread.start()
+
+    def frame_done(self, spectrometer) -> bool:
+        """ Count a frame and queue a state capture if it is a sampled one, does not block
+
+        :param spectrometer: C12880 the frame was read from
+        :return: True if a capture was queued
+        """
+        self.frames_seen += 1
+        if self.frames_seen % self.sample_every:
+            return False
+        context = {'time': time.time(), 'frame': self.frames_seen,
+                   'integration time': spectrometer.integration_time,
+                   'divider': spectrometer.st_clock_divider}
+        try:
+            self._queue.put_nowait((spectrometer, context))
+        except queue.Full:
+            self.records_dropped += 1
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            spectrometer, context = item
+            try:
+                context.update(spectrometer.get_C12880_state())
+                self._logger.info(json.dumps(context))
+            except Exception as error:
+                context['error'] = str(error)
+                self._logger.error(json.dumps(context))
+            self.records_written += 1
+
+    def flush(self):
+        self._handler.flush()
+
+    def close(self):
+        """ Write the records that are still queued and close the log file """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._logger.removeHandler(self._handler)
+        self._handler.close()  # flushes to the file handler
+        self._file_handler.close()
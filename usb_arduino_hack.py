@@ -1,77 +1,148 @@
 # standard libraries
-
-import serial
+import array
+import logging
+import sys
 import time
+# installed libraries
+import serial
 # local files
-import main_gui
+import serial_discovery
+import serial_frames
 
 
 BAUDRATE = 115200
 STOPBITS = serial.STOPBITS_ONE
 PARITY = serial.PARITY_NONE
 BYTESIZE = serial.EIGHTBITS
+DEFAULT_PORT = 'COM6'
+FAST_BAUDRATES = [921600, 460800, 230400]  # tried in order by negotiate_baudrate
+NUM_PIXELS = 288
+READ_TIMEOUT = 1.0  # seconds to wait for a spectrum
 
+# commands of the serial firmware
+READ_ASCII_COMMAND = b'R'  # answered with a line of comma separated counts
+READ_FRAME_COMMAND = b'F'  # answered with a serial_frames.SPECTRUM frame
+PING_COMMAND = b'P'  # answered with a serial_frames.MESSAGE frame by firmware that sends frames
+BAUD_COMMAND = b'B'  # followed by the uint32 baud rate, answered with a BAUD_ACK frame
 
-def find_available_ports():
-
-    # taken from http://stackoverflow.com/questions/12090503/listing-available-com-ports-with-python
 
-    if sys.platform.startswith('win'):
-        ports = ['COM%s' % (i+1) for i in range(32)]
-    elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-        ports = glob.glob('/dev/tty[A-Za-z]*')
-    elif sys.platform.startswith('darwin'):
-        ports = glob.glob('/dev/tty.*')
-    else:
-        raise EnvironmentError('Unsupported platform')
-
-    available_ports = []
-    for port in ports:
-        try:
-            device = serial.Serial(port=port, write_timeout=0.5,
-                                   inter_byte_timeout=1, baudrate=115200,
-                                   parity=serial.PARITY_EVEN, stopbits=1)
-            device.close()
-            available_ports.append(device)
-        except (OSError, serial.SerialException):
-            pass
-    return available_ports
+def find_available_ports():
+    return serial_discovery.candidate_ports()
 
 
 class PSoC_USB(object):
-    def __init__(self, master: main_gui.SpectrometerGUI):
-        self.device = serial.Serial('COM6', baudrate=BAUDRATE, stopbits=STOPBITS,
-                                    parity=PARITY, bytesize=BYTESIZE, timeout=1)
+    def __init__(self, master: 'main_gui.SpectrometerGUI', port: str = None,
+                 baudrate: int = None):
+        """
+        :param port: serial port of the device, looked for if None
+        :param baudrate: baud rate to ask the device to change to, the fastest one it accepts
+        is used if None
+        """
+        self.master = master
+        if port is None:
+            port = serial_discovery.find_device_port() or DEFAULT_PORT
+        self.device = serial.Serial(port, baudrate=BAUDRATE, stopbits=STOPBITS,
+                                    parity=PARITY, bytesize=BYTESIZE, timeout=READ_TIMEOUT)
+        self.parser = serial_frames.FrameParser()
+        self.spectrum = array.array('H', bytes(2 * NUM_PIXELS))  # reused for every spectrum
+        self.use_frames = self.check_frame_support()
+        if self.use_frames:
+            self.negotiate_baudrate([baudrate] if baudrate else FAST_BAUDRATES)
+        logging.info("serial device on {0} at {1} baud, binary frames: {2}".format(
+            port, self.device.baudrate, self.use_frames))
 
     def usb_write(self, message):
         self.device.write(message.encode('utf-8'))
 
+    def read_frame(self, frame_type: int, timeout: float = READ_TIMEOUT):
+        """ Read from the port until a frame of a type arrives
+
+        :return: the serial_frames.Frame, or None if it did not arrive in time
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            # block for at least one byte, then take everything already waiting
+            data = self.device.read(max(1, self.device.in_waiting))
+            for frame in self.parser.feed(data):
+                if frame.type == frame_type:
+                    return frame
+                logging.debug("Skipping serial frame of type {0}".format(frame.type))
+        return None
+
+    def check_frame_support(self) -> bool:
+        """ Ping the device to see if its firmware sends binary frames """
+        self.flush()
+        self.device.write(PING_COMMAND)
+        return self.read_frame(serial_frames.MESSAGE, timeout=self.device.timeout) is not None
+
+    def negotiate_baudrate(self, baudrates) -> int:
+        """ Ask the device to change to the fastest of the baud rates it accepts.  The device
+        acknowledges at the old rate, both sides change, and the link is checked with a ping; if
+        that fails both go back to the old rate after the device's own timeout.
+
+        :param baudrates: baud rates to try, fastest first
+        :return: the baud rate in use
+        """
+        old_baudrate = self.device.baudrate
+        for baudrate in baudrates:
+            self.device.write(BAUD_COMMAND + baudrate.to_bytes(4, 'little'))
+            ack = self.read_frame(serial_frames.BAUD_ACK)
+            if ack is None or int.from_bytes(ack.payload[:4], 'little') != baudrate:
+                continue
+            self.device.flush()
+            self.device.baudrate = baudrate
+            self.parser.reset()
+            if self.check_frame_support():
+                return baudrate
+            logging.info("Link failed at {0} baud".format(baudrate))
+            self.device.baudrate = old_baudrate
+            self.parser.reset()
+            self.check_frame_support()  # waits out the device going back to the old rate
+        return self.device.baudrate
+
     def read_all_data(self):
         try:
-            self.device.write(b'R')
-            time.sleep(0.5)
-            data = self.device.readline().rstrip()
-            print(data)
-            data2 = data.split(b",")[:-1]
-            print(data2)
-            if data:
-                # self.device.flushOutput()
-                # self.device.flushInput()
-                print("check1")
-                sdata = [int(p) for p in data2]
-                print("check2")
-                print(sdata)
-                print(len(sdata))
-                time.sleep(0.5)
-                if len(sdata) == 288:
-                    return sdata
-                # print(from_device)
-            else:
-                print("no data")
-
+            if self.use_frames:
+                return self.read_frame_data()
+            return self.read_ascii_data()
         except Exception as error:
-            print(error)
+            logging.error(error)
+
+    def read_frame_data(self):
+        """ Get a spectrum sent as a binary frame
+
+        :return: array of 288 uint16 counts, reused by the next read, or None if none arrived
+        """
+        self.device.write(READ_FRAME_COMMAND)
+        frame = self.read_frame(serial_frames.SPECTRUM)
+        if frame is None:
+            logging.error("No spectrum frame received")
+            return None
+        if len(frame.payload) != len(self.spectrum) * self.spectrum.itemsize:
+            logging.error("Spectrum frame of {0} bytes".format(len(frame.payload)))
+            return None
+        memoryview(self.spectrum).cast('B')[:] = frame.payload
+        if sys.byteorder != 'little':
+            self.spectrum.byteswap()
+        return self.spectrum
+
+    def read_ascii_data(self):
+        """ Get a spectrum sent as a line of comma separated counts, for the older firmware
+
+        :return: list of 288 counts, or None if the line was not a full spectrum
+        """
+        self.device.write(READ_ASCII_COMMAND)
+        data = self.device.readline().rstrip()
+        if not data:
+            logging.error("no data")
+            return None
+        sdata = [int(p) for p in data.split(b",")[:-1]]
+        if len(sdata) == NUM_PIXELS:
+            return sdata
+        logging.error("Received {0} counts".format(len(sdata)))
+        return None
 
     def flush(self):
         self.device.flushInput()
-        self.device.flushOutput()
\ No newline at end of file
+        self.device.flushOutput()
+        self.parser.reset()
@@ -3,6 +3,8 @@
 """ Classes to communication with a spectrophotometer"""
 
 # standard libraries
+import array
+import contextlib
 from enum import Enum
 import logging
 import queue
@@ -17,16 +19,25 @@ import usb
 import usb.core
 import usb.util
 import usb.backend
-
 # local files
-import psoc_spectrometer  # for type hinting
+import serial_discovery
+import usb_stats
 
 PSOC_ID_MESSAGE = b"PSoC-Spectrometer"
 C12880_ID_MESSAGE = b"C12880"
 
 USB_DATA_BYTE_SIZE = 40
 IN_ENDPOINT = 0x81
+DRAIN_TIMEOUT = 100  # milliseconds to wait for old responses when clearing them out
+DRAIN_READ_SIZE = 4096
 OUT_ENDPOINT = 0x02
+DEFAULT_MAX_PACKET_SIZE = 64  # full speed bulk endpoint size, used if the descriptor can not be read
+NUM_PIXELS = 288  # the C12880 has 288 pixels
+EXPORT_VERB = "C12880|EXPORT_DATA"  # verb the frame reads are counted under in the stats
+RECONNECT_VERB = "RECONNECT"  # verb reconnection attempts are counted as retries under
+COMMAND_SEPARATOR = usb_stats.COMMAND_SEPARATOR
+# the PSoC sends data little endian, so the buffers only have to be swapped on a big endian computer
+NEEDS_BYTESWAP = sys.byteorder != 'little'
 
 # Serial communication settings
 BAUDRATE = 115200
@@ -46,16 +57,45 @@ class DeviceTypes(Enum):
 class PSoC_USB(object):
     def __init__(self, master, queue: queue.Queue, event: threading.Event(),
                  termination_flag: bool,
-                 vendor_id=0x04B4, product_id=0x8051):
+                 vendor_id=0x04B4, product_id=0x8051, device=None):
+        """
+        :param device: object with the pyUSB device read and write calls to use instead of looking
+        for a USB device, i.e. a device_simulator.SimulatedPSoC
+        """
         self.master_device = master
         self.usb_device_found = False
         self.found = False
         self.connected = False
         self.spectrometer = None
-        self.device = self.connect_usb(vendor_id, product_id)
+        # reusable buffers the spectrum data is read into, made when first needed
+        self.single_data_reader = None
+        self.multi_data_reader = None
+        # hold this lock around a command and its response so threads do not mix up replies
+        self.lock = threading.RLock()
+        # count and time of each command and read, see usb_stats.TransportStats.snapshot
+        self.stats = usb_stats.TransportStats()
+        # last command written for each setting, so writing a value that is already set is skipped
+        self.shadow = {}
+        self._batch = None  # commands waiting to be written together, see batch
+        # time.time() the last export request, and any command sent with it, was written
+        self.export_time = None
+        self._batch_thread = None
+        # True if the firmware runs several commands separated by COMMAND_SEPARATOR in one transfer
+        self.batch_transfers = getattr(device, 'supports_batches', False)
+        self.out_packet_size = None  # bytes a batch transfer can hold, read from the device when needed
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.given_device = device  # device given instead of looked for, see reconnect
+        if device is not None:
+            self.device = device
+            self.found = True
+            self.usb_device_found = True
+        else:
+            self.device = self.connect_usb(vendor_id, product_id)
         if not self.usb_device_found:
             logging.info("No USB device find, looking for serial")
             self.device = self.connect_serial()
+        self.serial = device_serial(self.device)
 
         self.connection_test()
         # data_processing_function([1])
@@ -66,7 +106,7 @@ class PSoC_USB(object):
                                                            self.data_ready_event,
                                                            termination_flag)
 
-    def connect_usb(self, vendor_id, product_id):
+    def connect_usb(self, vendor_id, product_id, serial_number=None):
         """
         Use the pyUSB module to find and set the configuration of a USB device
 
@@ -77,9 +117,13 @@ class PSoC_USB(object):
         :param vendor_id: the USB vendor id, used to identify the proper device connected to
         the computer
         :param product_id: the USB product id
+        :param serial_number: only connect to the device with this USB serial number, any if None
         :return: USB device that can use the pyUSB API if found, else returns None if not found
         """
-        device = usb.core.find(idVendor=vendor_id, idProduct=product_id)
+        custom_match = None
+        if serial_number:
+            custom_match = lambda found: device_serial(found) == serial_number
+        device = usb.core.find(idVendor=vendor_id, idProduct=product_id, custom_match=custom_match)
         logging.info("device: {0}".format(device))
         if device is None:
             logging.info("Device not found")
@@ -93,6 +137,69 @@ class PSoC_USB(object):
         device.set_configuration()
         return device
 
+    def device_present(self) -> bool:
+        """ Check if the device is still plugged in, without sending it anything """
+        device = self.device
+        if device is None:
+            return False
+        if hasattr(device, 'attached'):  # device_simulator.SimulatedPSoC
+            return device.attached
+        if isinstance(device, usb.core.Device):
+            return usb.core.find(idVendor=self.vendor_id, idProduct=self.product_id,
+                                 custom_match=lambda found: (found.bus == device.bus and
+                                                             found.address == device.address)) is not None
+        if hasattr(device, 'port'):  # serial port
+            return serial_discovery.port_present(device.port)
+        return True
+
+    def reconnect(self) -> bool:
+        """ Release the device and look for it again, i.e. after it was unplugged.  The settings
+        the device had are forgotten, they have to be written again.
+
+        :return: True if the device is connected and answers the connection test
+        """
+        with self.lock:
+            self.stats.record_retry(RECONNECT_VERB)
+            self.connected = False
+            self.shadow.clear()
+            self._release_device()
+            self.single_data_reader = None  # the readers hold on to the old device
+            self.multi_data_reader = None
+            self.out_packet_size = None
+            if hasattr(self.given_device, 'attached'):  # device_simulator.SimulatedPSoC
+                self.device = self.given_device if self.given_device.attached else None
+            else:
+                # a replugged device gets a new handle, find the same one again by its serial
+                # number, names made from where it was plugged in change so any device will do
+                serial_number = self.serial
+                if serial_number and serial_number.startswith("bus"):
+                    serial_number = None
+                self.usb_device_found = False
+                self.device = self.connect_usb(self.vendor_id, self.product_id, serial_number)
+                if not self.usb_device_found and self.given_device is None:
+                    self.device = self.connect_serial()
+            if self.device is None:
+                return False
+            serial_number = device_serial(self.device)
+            if self.serial and serial_number != self.serial:
+                logging.warning("Reconnected to {0}, was connected to {1}".format(serial_number,
+                                                                                self.serial))
+            self.serial = serial_number
+            self.connection_test()
+            logging.info("Reconnect {0}".format("worked" if self.connected else "failed"))
+            return self.connected
+
+    def _release_device(self):
+        if self.device is None or hasattr(self.device, 'attached'):  # simulators are reused
+            return
+        try:
+            if isinstance(self.device, usb.core.Device):
+                usb.util.dispose_resources(self.device)
+            elif hasattr(self.device, 'close'):
+                self.device.close()
+        except Exception as error:  # the device is probably gone already
+            logging.debug("Could not release the device: {0}".format(error))
+
     def connection_test(self):
         """ Test if the device response correctly.  The device should return a message when
         given and identification call of 'I', and return the Spectrometer the device is connect to
@@ -121,45 +228,144 @@ class PSoC_USB(object):
             logging.info("C12880 attached")
 
     def connect_serial(self):
-        available_ports = find_available_ports()
-        logging.info("serial ports found: {0}".format(available_ports))
-        for port in available_ports:
-            try:
-                logging.info("writing to port: {0}".format(port.port))
-                device = serial.Serial(port.port, baudrate=BAUDRATE, stopbits=STOPBITS,
-                                       parity=PARITY, bytesize=BYTESIZE, timeout=1)
-                device.flushInput()
-                device.flushOutput()
-
-                # device.write(b"ID-")
-                # time.sleep(0.5)
-                # from_device = device.read_all()
-                # time.sleep(0.5)
-                from_device = device.read_all()
-                logging.info("From the device: {0}".format(from_device))
-                if from_device == PSOC_ID_MESSAGE:
-                    logging.info("Found serial device")
-                    self.found = True
-                    self.device_type = DeviceTypes.serial
-                    self.connected = True
-                    return device
-
-            except Exception as exception:
-                # not the correct device
-                logging.info("No device at port: {0}".format(port))
-                logging.info("Exception: {0}".format(exception))
+        port = serial_discovery.find_device_port()
+        if not port:
+            logging.info("No serial device found")
+            return None
+        try:
+            device = serial.Serial(port, baudrate=BAUDRATE, stopbits=STOPBITS,
+                                   parity=PARITY, bytesize=BYTESIZE, timeout=1)
+        except (OSError, serial.SerialException) as exception:
+            logging.info("Could not open port {0}: {1}".format(port, exception))
+            return None
+        logging.info("Found serial device on {0}".format(port))
+        self.found = True
+        self.device_type = DeviceTypes.serial
+        self.connected = True
+        return device
 
     def usb_write(self, message, endpoint=OUT_ENDPOINT):
         if not endpoint:
             endpoint = self.master_device.OUT_ENDPOINT
+        if self._batch is not None and self._batch_thread == threading.get_ident():
+            self._batch.append(message)
+            return
 
+        start = time.perf_counter()
         try:
-            print("write to usb: ", message)
+            logging.debug("write to usb: {0}".format(message))
             self.device.write(endpoint, message)
 
         except Exception as error:
+            self.stats.record_write(message, len(message), time.perf_counter() - start, error=True)
             logging.error("USB writing error: {0}".format(error))
             self.connected = False
+            self.shadow.clear()  # the device state is unknown after a failed write
+            return
+        self.stats.record_write(message, len(message), time.perf_counter() - start)
+
+    def write_setting(self, message: str, setting: str = None) -> bool:
+        """ Write a command that sets a value on the device, unless the same command was the
+        last one written for that setting
+
+        :param message: command to write, i.e. C12880|ST_DIVIDER|00048
+        :param setting: name of the setting the command changes, the command verb if None
+        :return: True if the command was written, False if it was skipped
+        """
+        if setting is None:
+            setting = self.stats.verb(message)
+        with self.lock:
+            if self.shadow.get(setting) == message:
+                return False
+            self.usb_write(message)
+            if self.connected:
+                self.shadow[setting] = message
+            return True
+
+    def note_write(self, message, error: bool = False):
+        """ Keep the shadow right for a command written to the device some other way than
+        write_setting, i.e. through an AsyncPSoCTransport
+
+        :param message: command, or commands joined by COMMAND_SEPARATOR, that was written
+        :param error: True if the write failed, the device state is unknown then
+        """
+        if isinstance(message, (bytes, bytearray)):
+            message = message.decode('ascii', 'replace')
+        with self.lock:
+            if error:
+                self.shadow.clear()
+                return
+            for command in message.split(COMMAND_SEPARATOR):
+                setting = self.stats.verb(command)
+                if setting in self.shadow:
+                    self.shadow[setting] = command
+
+    def forget_settings(self):
+        """ Write every setting again the next time it is set, i.e. after the device is reset """
+        with self.lock:
+            self.shadow.clear()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Collect the commands written in the with block and write them together at the end.
+        If the firmware supports it they are joined into as few transfers as possible, else
+        they are written one after another without other threads getting in between. """
+        with self.lock:
+            if self._batch is not None:  # already in a batch, it is written by the outer block
+                yield
+                return
+            self._batch = []
+            self._batch_thread = threading.get_ident()
+            try:
+                yield
+            finally:
+                self.flush_batch()
+                self._batch = None
+                self._batch_thread = None
+
+    def flush_batch(self):
+        """ Write the commands collected by batch so far """
+        with self.lock:
+            messages = self._batch
+            if not messages:
+                return
+            self._batch = None  # so usb_write sends them instead of collecting them
+            try:
+                if not self.batch_transfers:
+                    for message in messages:
+                        self.usb_write(message)
+                    return
+                if not self.out_packet_size:
+                    self.out_packet_size = get_max_packet_size(self.device, OUT_ENDPOINT)
+                max_size = self.out_packet_size
+                transfer = messages[0]
+                for message in messages[1:]:
+                    if len(transfer) + len(COMMAND_SEPARATOR) + len(message) > max_size:
+                        self.usb_write(transfer)
+                        transfer = message
+                    else:
+                        transfer += COMMAND_SEPARATOR + message
+                self.usb_write(transfer)
+            finally:
+                self._batch = []
+
+    def drain_input(self, timeout: int = DRAIN_TIMEOUT) -> int:
+        """ Read and throw away any responses still waiting, i.e. the late answer to a read that
+        timed out, so they are not taken as the answer to the next command
+
+        :param timeout: milliseconds to wait for more data before it is taken as drained
+        :return: number of bytes thrown away
+        """
+        num_bytes = 0
+        with self.lock:
+            while True:
+                try:
+                    num_bytes += len(self.device.read(IN_ENDPOINT, DRAIN_READ_SIZE, timeout))
+                except Exception:  # timed out, nothing is left
+                    break
+        if num_bytes:
+            logging.info("Threw away {0} bytes of old responses".format(num_bytes))
+        return num_bytes
 
     def usb_read_info(self, info_endpoint=None, num_usb_bytes=None):
         if not info_endpoint:
@@ -181,13 +387,19 @@ class PSoC_USB(object):
         if not self.connected:
             logging.info("not working")
             return None
+        if self._batch and self._batch_thread == threading.get_ident():
+            self.flush_batch()  # the commands have to be sent before their response can be read
+        start = time.perf_counter()
         try:
             usb_input = self.device.read(endpoint, num_usb_bytes, timeout)  # TODO fix this
             # print(usb_input)
         except Exception as error:
+            self.stats.record_read(0, time.perf_counter() - start,
+                                   timed_out=isinstance(error, usb.core.USBTimeoutError), error=True)
             logging.error("Failed data read")
             logging.error("No IN ENDPOINT: %s", error)
             return None
+        self.stats.record_read(len(usb_input), time.perf_counter() - start)
         if encoding == 'uint16':
             # print("Not a confirmed encoding data type")
             num_elements = int(len(usb_input) / 2)
@@ -205,38 +417,193 @@ class PSoC_USB(object):
             else:
                 print("Error in reading")
         elif encoding == 'string':
-            return usb_input.tostring()  # remove the 0x00 end of string
+            return usb_input.tobytes()  # remove the 0x00 end of string
         else:  # no encoding so just return raw data
             return usb_input
 
-    def read_single_data(self):
-        try:
-            self.usb_write("C12880|EXPORT_DATA|SINGLE")
-            logging.debug("reading single data")
-            data_packet = []
-            for i in range(12):
-                data_packet.extend(self.usb_read_data(num_usb_bytes=48, encoding="uint16"))
+    def read_single_data(self, next_command: str = None):
+        """ Export a single read spectrum from the PSoC.  The returned array is reused by the next
+        single read, so copy it if it has to be kept.
 
-            return data_packet
+        :param next_command: command to send right after the export request, i.e. the next read
+        trigger, so the device can start on it while this data is transferred.  Can also be a
+        function that writes the commands, they are batched with the export request.  The time
+        it was sent, before the data transfer, is saved in export_time
+        :return: array of 288 uint16 counts, or None if the read failed
+        """
+        try:
+            with self.lock:
+                with self.batch():
+                    self.usb_write("C12880|EXPORT_DATA|SINGLE")
+                    if callable(next_command):
+                        next_command()
+                    elif next_command:
+                        self.usb_write(next_command)
+                self.export_time = time.time()
+                logging.debug("reading single data")
+                if not self.single_data_reader:
+                    self.single_data_reader = BulkFrameReader(self.device, 'H', NUM_PIXELS)
+                return self._timed_frame_read(self.single_data_reader)
         except Exception as error:
             logging.error(error)
 
-    def read_multi_data(self):
-        try:
-            self.usb_write("C12880|EXPORT_DATA|MULTI")
-            logging.debug("reading multi data")
-            data_packet = []
-            for i in range(24):
-                data_packet.extend(self.usb_read_data(num_usb_bytes=48, encoding="uint32"))
+    def read_multi_data(self, next_command: str = None):
+        """ Export the summed spectrum of a multi read from the PSoC.  The returned array is reused
+        by the next multi read, so copy it if it has to be kept.
 
-            return data_packet
+        :param next_command: command to send right after the export request, i.e. the next read
+        trigger, so the device can start on it while this data is transferred.  Can also be a
+        function that writes the commands, they are batched with the export request.  The time
+        it was sent, before the data transfer, is saved in export_time
+        :return: array of 288 uint32 summed counts, or None if the read failed
+        """
+        try:
+            with self.lock:
+                with self.batch():
+                    self.usb_write("C12880|EXPORT_DATA|MULTI")
+                    if callable(next_command):
+                        next_command()
+                    elif next_command:
+                        self.usb_write(next_command)
+                self.export_time = time.time()
+                logging.debug("reading multi data")
+                if not self.multi_data_reader:
+                    self.multi_data_reader = BulkFrameReader(self.device, 'I', NUM_PIXELS)
+                return self._timed_frame_read(self.multi_data_reader)
         except Exception as error:
             logging.error(error)
 
+    def _timed_frame_read(self, reader):
+        """ Read a frame and record it under the export command, not the command sent after it """
+        start = time.perf_counter()
+        try:
+            frame = reader.read()
+        except Exception as error:
+            self.stats.record_read(0, time.perf_counter() - start,
+                                   timed_out=isinstance(error, usb.core.USBTimeoutError), error=True,
+                                   verb=EXPORT_VERB)
+            raise
+        self.stats.record_read(reader.frame_bytes, time.perf_counter() - start, verb=EXPORT_VERB)
+        return frame
+
     def start_reading(self):
         pass
 
 
+class BulkFrameReader(object):
+    """ Read a fixed size frame of data from a bulk IN endpoint into a preallocated array.
+
+    pyUSB will read straight into an array.array that is passed to it instead of a size, so
+    the frame is read with as few bulk transfers as the device allows without making new
+    objects for each packet.  Transfers are sized to a multiple of the endpoint's max packet
+    size so a full packet can never overflow the request.  If the device sends the frame in
+    short packets, the remaining packets are read into a scratch buffer and copied in place.
+    """
+    def __init__(self, device, typecode: str, num_elements: int, endpoint=IN_ENDPOINT,
+                 max_packet_size=None, timeout=3000):
+        """
+        :param device: pyUSB device, or any object with the same read(endpoint, buffer, timeout) call
+        :param typecode: array typecode of each element, 'H' for uint16 or 'I' for uint32
+        :param num_elements: number of elements in a frame
+        :param endpoint: address of the IN endpoint to read from
+        :param max_packet_size: bytes per packet of the endpoint, read from the device if None
+        :param timeout: milliseconds to wait for each transfer
+        """
+        self.device = device
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.frame = array.array(typecode, bytes(array.array(typecode).itemsize * num_elements))
+        self.frame_bytes = len(self.frame) * self.frame.itemsize
+        if not max_packet_size:
+            max_packet_size = get_max_packet_size(device, endpoint)
+        self.max_packet_size = max_packet_size
+
+        # round the transfer size up to whole packets
+        num_packets = -(-self.frame_bytes // max_packet_size)
+        self.transfer_size = num_packets * max_packet_size
+        # the frame can only be read into directly if it is made of whole packets
+        self.read_directly = (self.transfer_size == self.frame_bytes)
+        self._scratch = array.array('B', bytes(self.transfer_size))
+        self._scratch_view = memoryview(self._scratch)
+        self._frame_view = memoryview(self.frame).cast('B')
+
+    def read(self, timeout=None):
+        """ Read a frame from the device into the frame buffer.
+
+        :param timeout: milliseconds to wait for each transfer, uses the readers timeout if None
+        :return: the frame array, this is the same object on every call
+        """
+        if timeout is None:
+            timeout = self.timeout
+        bytes_filled = 0
+        while bytes_filled < self.frame_bytes:
+            if bytes_filled == 0 and self.read_directly:
+                bytes_read = self.device.read(self.endpoint, self.frame, timeout)
+            else:
+                bytes_read = self.device.read(self.endpoint, self._scratch, timeout)
+                bytes_read = min(bytes_read, self.frame_bytes - bytes_filled)
+                self._frame_view[bytes_filled:bytes_filled + bytes_read] = self._scratch_view[:bytes_read]
+            if not bytes_read:
+                raise IOError("USB device sent an empty packet after {0} of {1} bytes".format(
+                    bytes_filled, self.frame_bytes))
+            bytes_filled += bytes_read
+        if NEEDS_BYTESWAP:
+            self.frame.byteswap()
+        return self.frame
+
+
+def find_usb_devices(vendor_id=0x04B4, product_id=0x8051) -> list:
+    """ Find every connected USB device with a vendor and product id and set its configuration
+
+    :return: list of pyUSB devices, they can be given to PSoC_USB as its device
+    """
+    devices = []
+    for device in usb.core.find(find_all=True, idVendor=vendor_id, idProduct=product_id):
+        try:
+            device.set_configuration()
+        except usb.core.USBError as error:
+            logging.error("Could not configure {0}: {1}".format(device_serial(device), error))
+            continue
+        devices.append(device)
+    return devices
+
+
+def device_serial(device) -> str:
+    """ Get a name for a device that stays the same between connections, the USB serial number
+    if it has one, or where it is plugged in if not """
+    if device is None:
+        return None
+    try:
+        serial_number = device.serial_number
+        if serial_number:
+            return serial_number
+    except Exception as error:  # the string descriptor may not be readable without permission
+        logging.debug("Could not read USB serial number: {0}".format(error))
+    if hasattr(device, 'bus'):
+        return "bus{0}-{1}".format(device.bus, device.address)
+    if hasattr(device, 'port'):  # serial port
+        return device.port
+    return None
+
+
+def get_max_packet_size(device, endpoint_address: int, default=DEFAULT_MAX_PACKET_SIZE):
+    """ Look up the wMaxPacketSize of an endpoint in the device's active configuration
+
+    :param device: pyUSB device
+    :param endpoint_address: address of the endpoint, i.e. 0x81
+    :param default: packet size to use if the descriptors can not be read
+    :return: max packet size of the endpoint in bytes
+    """
+    try:
+        for interface in device.get_active_configuration():
+            for endpoint in interface:
+                if endpoint.bEndpointAddress == endpoint_address:
+                    return endpoint.wMaxPacketSize
+    except Exception as error:
+        logging.info("Could not read endpoint descriptor: {0}".format(error))
+    return default
+
+
 class ThreadedUSBDataCollector(threading.Thread):
     def __init__(self, device: PSoC_USB, master: 'psoc_spectrometer.BaseSpectrometer()',
                  data_queue: queue.Queue, data_event: threading.Event,
@@ -284,20 +651,12 @@ class ThreadedUSBDataCollector(threading.Thread):
 
 
 def find_available_ports():
+    """ Get the serial ports that can be opened, in the order the device should be looked for
 
-    # taken from http://stackoverflow.com/questions/12090503/listing-available-com-ports-with-python
-
-    if sys.platform.startswith('win'):
-        ports = ['COM%s' % (i+1) for i in range(32)]
-    elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-        ports = glob.glob('/dev/tty[A-Za-z]*')
-    elif sys.platform.startswith('darwin'):
-        ports = glob.glob('/dev/tty.*')
-    else:
-        raise EnvironmentError('Unsupported platform')
-
+    :return: list of closed serial.Serial objects
+    """
     available_ports = []
-    for port in ports:
+    for port in serial_discovery.candidate_ports():
         try:
             device = serial.Serial(port=port, write_timeout=0.5,
                                    inter_byte_timeout=1, baudrate=115200,
@@ -306,4 +665,4 @@ def find_available_ports():
             available_ports.append(device)
         except (OSError, serial.SerialException):
             pass
-    return available_ports
\ No newline at end of file
+    return available_ports
@@ -0,0 +1,184 @@
+# Copyright (c) 2018 Kyle Lopin (Naresuan University) <kylel@nu.ac.th>
+
+""" Count and time every command sent to, and every read from, the PSoC.  The numbers are kept
+for each command verb, i.e. C12880|QUERY_RUN or LED|POWER, with histograms of the write and
+read latencies, so a slow USB hub or a firmware change shows up in the numbers.  Recording a call is a few
+dictionary lookups and additions so it is left on all the time. """
+
+# standard libraries
+import json
+import logging
+import math
+import threading
+import time
+
+__author__ = 'Kyle Vitautas Lopin'
+
+HISTOGRAM_BASE = 0.00001  # seconds, upper edge of the first histogram bin
+NUM_HISTOGRAM_BINS = 24  # each bin is twice as wide as the last, so the top bin starts at ~84 seconds
+MAX_CACHED_VERBS = 1024  # messages to remember the verb of, the firmware only has a few dozen
+COMMAND_SEPARATOR = ";"  # separates the commands of a batch sent in one transfer
+BATCH_VERB = "BATCH"  # verb batches of commands are counted under
+
+
+def histogram_bin(seconds: float) -> int:
+    """ Index of the log2 spaced bin a latency goes in """
+    if seconds <= HISTOGRAM_BASE:
+        return 0
+    return min(math.frexp(seconds / HISTOGRAM_BASE)[1], NUM_HISTOGRAM_BINS - 1)
+
+
+def bin_upper_edge(index: int) -> float:
+    return HISTOGRAM_BASE * 2 ** index
+
+
+def histogram_percentile(histogram: list, percent: float) -> float:
+    """ Estimate a latency percentile from a histogram, as the upper edge of its bin """
+    total = sum(histogram)
+    if not total:
+        return 0.
+    target = total * percent / 100.
+    running_total = 0
+    for index, count in enumerate(histogram):
+        running_total += count
+        if running_total >= target:
+            return bin_upper_edge(index)
+    return bin_upper_edge(NUM_HISTOGRAM_BINS - 1)
+
+
+class CommandStats(object):
+    """ Counters of one command verb """
+
+    def __init__(self):
+        self.writes = 0
+        self.reads = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        # writes and reads are timed apart, a read waits on the device and a write mostly does not
+        self.write_time = 0.
+        self.read_time = 0.
+        self.max_write_time = 0.
+        self.max_read_time = 0.
+        self.timeouts = 0
+        self.errors = 0
+        self.retries = 0
+        self.write_histogram = [0] * NUM_HISTOGRAM_BINS
+        self.read_histogram = [0] * NUM_HISTOGRAM_BINS
+
+    def to_dict(self) -> dict:
+        return {"writes": self.writes, "reads": self.reads,
+                "bytes_written": self.bytes_written, "bytes_read": self.bytes_read,
+                "write": _timing_dict(self.writes, self.write_time, self.max_write_time,
+                                      self.write_histogram),
+                "read": _timing_dict(self.reads, self.read_time, self.max_read_time,
+                                     self.read_histogram),
+                "timeouts": self.timeouts, "errors": self.errors, "retries": self.retries}
+
+
+def _timing_dict(calls: int, total_time: float, max_time: float, histogram: list) -> dict:
+    return {"mean_ms": 1000 * total_time / calls if calls else 0.,
+            "p50_ms": 1000 * histogram_percentile(histogram, 50),
+            "p99_ms": 1000 * histogram_percentile(histogram, 99),
+            "max_ms": 1000 * max_time, "histogram": list(histogram)}
+
+
+class TransportStats(object):
+    """ Statistics of all the USB traffic of a device, keyed by command verb.  Reads are
+    counted under the verb of the last command written, as that is what they answer. """
+
+    def __init__(self):
+        self.commands = {}  # verb: CommandStats
+        self.last_verb = None
+        self.start_time = time.time()
+        self._verbs = {}  # cache of message: verb
+        self._lock = threading.Lock()
+
+    def verb(self, message) -> str:
+        """ Get the command verb of a message, the fields before any numbers or options,
+        i.e. C12880|ST_DIVIDER|00048 is C12880|ST_DIVIDER """
+        cacheable = not isinstance(message, bytearray)  # bytearrays can not be dictionary keys
+        verb = self._verbs.get(message) if cacheable else None
+        if verb is None:
+            text = message
+            if isinstance(text, (bytes, bytearray)):
+                text = text.decode('ascii', 'replace')
+            if COMMAND_SEPARATOR in text:
+                verb = BATCH_VERB
+            else:
+                verb = "|".join(text.split("|")[:2])
+            # cached under the message as given so a bytes message is found again
+            if cacheable and len(self._verbs) < MAX_CACHED_VERBS:
+                self._verbs[message] = verb
+        return verb
+
+    def _get(self, verb) -> CommandStats:
+        stats = self.commands.get(verb)
+        if stats is None:
+            stats = self.commands[verb] = CommandStats()
+        return stats
+
+    def record_write(self, message, num_bytes: int, seconds: float, error: bool = False):
+        verb = self.verb(message)
+        with self._lock:
+            self.last_verb = verb
+            stats = self._get(verb)
+            stats.writes += 1
+            stats.bytes_written += num_bytes
+            stats.write_time += seconds
+            if seconds > stats.max_write_time:
+                stats.max_write_time = seconds
+            stats.write_histogram[histogram_bin(seconds)] += 1
+            if error:
+                stats.errors += 1
+
+    def record_read(self, num_bytes: int, seconds: float, timed_out: bool = False,
+                    error: bool = False, verb: str = None):
+        with self._lock:
+            stats = self._get(verb or self.last_verb)
+            stats.reads += 1
+            stats.bytes_read += num_bytes
+            stats.read_time += seconds
+            if seconds > stats.max_read_time:
+                stats.max_read_time = seconds
+            stats.read_histogram[histogram_bin(seconds)] += 1
+            if timed_out:
+                stats.timeouts += 1
+            elif error:
+                stats.errors += 1
+
+    def record_retry(self, message=None):
+        verb = self.verb(message) if message else self.last_verb
+        with self._lock:
+            self._get(verb).retries += 1
+
+    def reset(self):
+        with self._lock:
+            self.commands = {}
+            self.start_time = time.time()
+
+    def snapshot(self) -> dict:
+        """ Get a copy of all the statistics as plain python types """
+        with self._lock:
+            return {"seconds": time.time() - self.start_time,
+                    "histogram_bin_edges_ms": [1000 * bin_upper_edge(i) for i in range(NUM_HISTOGRAM_BINS)],
+                    "commands": {str(verb): stats.to_dict() for verb, stats in self.commands.items()}}
+
+    def dump(self, filename: str = None) -> str:
+        """ Get the statistics as json, and save them to a file if a filename is given """
+        text = json.dumps(self.snapshot(), indent=2)
+        if filename:
+            with open(filename, 'w') as _file:
+                _file.write(text)
+        return text
+
+    def log_summary(self, level=logging.INFO):
+        """ Log a line for each command verb """
+        for verb, stats in sorted(self.snapshot()["commands"].items()):
+            write, read = stats["write"], stats["read"]
+            logging.log(level, "{0}: {1} writes mean {2:.3f} ms max {3:.3f} ms, {4} reads mean "
+                               "{5:.3f} ms p99 {6:.3f} ms max {7:.3f} ms, {8} bytes in, "
+                               "{9} timeouts, {10} errors, {11} retries".format(
+                                   verb, stats["writes"], write["mean_ms"], write["max_ms"],
+                                   stats["reads"], read["mean_ms"], read["p99_ms"], read["max_ms"],
+                                   stats["bytes_read"], stats["timeouts"], stats["errors"],
+                                   stats["retries"]))